@@ -0,0 +1,173 @@
+import asyncio
+import hashlib
+import io
+import os
+from collections import OrderedDict
+
+from loguru import logger
+
+from http_client import http
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Ограничения Telegram для миниатюры аудио
+THUMBNAIL_MAX_SIDE = 320
+THUMBNAIL_MAX_BYTES = 200 * 1024
+
+
+def thumbnail_url(artwork_url):
+    """Ссылка на обложку 300x300 - самый крупный вариант SoundCloud, который влезает в миниатюру"""
+    return artwork_url.replace("-large", "-t300x300")
+
+
+def make_thumbnail(data):
+    """Уменьшает и пережимает обложку под ограничения Telegram"""
+    if Image is None:
+        # Без Pillow отдаем оригинал, если он уже подходит по размеру
+        return data if len(data) <= THUMBNAIL_MAX_BYTES else None
+
+    with Image.open(io.BytesIO(data)) as image:
+        image = image.convert("RGB")
+        image.thumbnail((THUMBNAIL_MAX_SIDE, THUMBNAIL_MAX_SIDE))
+        for quality in (85, 70, 50):
+            output = io.BytesIO()
+            image.save(output, format="JPEG", quality=quality, optimize=True)
+            if output.tell() <= THUMBNAIL_MAX_BYTES:
+                return output.getvalue()
+    return None
+
+
+class ArtworkCache:
+    """Кэш готовых миниатюр обложек в памяти и на диске"""
+
+    def __init__(self):
+        self.directory = os.getenv("ARTWORK_DIR", "data/artwork")
+        self.memory_limit = int(os.getenv("ARTWORK_MEMORY_LIMIT", str(16 * 1024 * 1024)))
+        self.disk_limit = int(os.getenv("ARTWORK_DISK_LIMIT", str(256 * 1024 * 1024)))
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._in_flight = {}
+        self._disk_bytes = None
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get(self, artwork_url):
+        """Возвращает миниатюру обложки (JPEG) или None"""
+        if not artwork_url:
+            return None
+
+        key = hashlib.sha1(artwork_url.encode()).hexdigest()
+        data = self._memory.get(key)
+        if data is not None:
+            self.memory_hits += 1
+            self._memory.move_to_end(key)
+            return data
+
+        # Одну обложку одновременно загружаем только один раз
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(key, artwork_url))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "disk_bytes": self._disk_bytes or 0,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    async def _load(self, key, artwork_url):
+        path = os.path.join(self.directory, f"{key}.jpg")
+        try:
+            data = await asyncio.to_thread(self._read_file, path)
+            if data is not None:
+                self.disk_hits += 1
+                self._remember(key, data)
+                return data
+
+            self.misses += 1
+            async with http.session.get(thumbnail_url(artwork_url)) as response:
+                if response.status != 200:
+                    logger.warning(f"Не удалось загрузить обложку. Статус: {response.status}")
+                    return None
+                raw = await response.read()
+
+            # Декодирование и сжатие изображения - в отдельном потоке, чтобы не блокировать цикл событий
+            data = await asyncio.to_thread(make_thumbnail, raw)
+            if data is None:
+                return None
+
+            self._remember(key, data)
+            await asyncio.to_thread(self._write_file, path, data)
+
+            if self._disk_bytes is None:
+                self._disk_bytes = await asyncio.to_thread(self._disk_usage)
+            else:
+                self._disk_bytes += len(data)
+            if self._disk_bytes > self.disk_limit:
+                self._disk_bytes, evicted = await asyncio.to_thread(self._evict_disk)
+                self.evictions += evicted
+            return data
+        except Exception as e:
+            logger.error(f"Не удалось подготовить обложку: {e}")
+            return None
+
+    def _remember(self, key, data):
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.memory_limit and self._memory:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self.evictions += 1
+
+    def _read_file(self, path):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # Обновляем время изменения: по нему вытесняются давно не использованные файлы
+        os.utime(path)
+        return data
+
+    def _write_file(self, path, data):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _disk_usage(self):
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory))
+
+    def _evict_disk(self):
+        """Удаляет самые старые файлы. Возвращает (новый объем, число удаленных)"""
+        entries = sorted(os.scandir(self.directory), key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        # Освобождаем место с запасом, чтобы не чистить каталог на каждой записи
+        target = self.disk_limit * 0.9
+        evicted = 0
+        for entry in entries:
+            if total <= target:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        return total, evicted
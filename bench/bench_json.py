@@ -0,0 +1,166 @@
+"""Микробенчмарк разбора ответа поиска SoundCloud (limit=100)
+
+Сравнивает прежний разбор (json.loads всего ответа, затем TrackInfo из
+словарей) с decode_tracks: orjson, если установлен, и проекция каждого
+трека в TrackInfo. Для каждого способа выводится время разбора одного
+ответа, пиковая память во время разбора и память, которая остается
+занятой результатом, если хранить его целиком.
+
+    python bench/bench_json.py
+"""
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import codec
+from codec import decode_tracks
+from sessions import TrackInfo
+
+
+def make_track(i):
+    """Трек в том виде, в каком его отдает api-v2: с пользователем, кодировками и метаданными"""
+    return {
+        "artwork_url": f"https://i1.sndcdn.com/artworks-{i:012d}-large.jpg",
+        "caption": None,
+        "commentable": True,
+        "comment_count": 120 + i,
+        "created_at": "2024-03-01T12:00:00Z",
+        "description": "Описание трека " * 8,
+        "downloadable": False,
+        "download_count": 0,
+        "duration": 180000 + i * 1000,
+        "full_duration": 180000 + i * 1000,
+        "embeddable_by": "all",
+        "genre": "Electronic",
+        "has_downloads_left": False,
+        "id": 1000000000 + i,
+        "kind": "track",
+        "label_name": None,
+        "last_modified": "2024-03-02T08:30:00Z",
+        "license": "all-rights-reserved",
+        "likes_count": 5000 + i,
+        "permalink": f"track-{i}",
+        "permalink_url": f"https://soundcloud.com/artist-{i}/track-{i}",
+        "playback_count": 100000 + i * 37,
+        "public": True,
+        "publisher_metadata": {
+            "id": 1000000000 + i,
+            "urn": f"soundcloud:tracks:{1000000000 + i}",
+            "artist": f"Artist {i}",
+            "contains_music": True,
+            "isrc": f"QZ-ABC-24-{i:05d}",
+            "writer_composer": f"Writer {i}",
+            "release_title": f"Album {i // 10}",
+        },
+        "reposts_count": 300 + i,
+        "state": "finished",
+        "streamable": True,
+        "tag_list": "electronic house deep",
+        "title": f"Трек номер {i} (Extended Mix)",
+        "uri": f"https://api.soundcloud.com/tracks/{1000000000 + i}",
+        "urn": f"soundcloud:tracks:{1000000000 + i}",
+        "user_id": 2000000 + i,
+        "waveform_url": f"https://wave.sndcdn.com/{i:012d}_m.json",
+        "display_date": "2024-03-01T12:00:00Z",
+        "media": {
+            "transcodings": [
+                {
+                    "url": f"https://api-v2.soundcloud.com/media/soundcloud:tracks:{1000000000 + i}/{kind}/stream/{protocol}",
+                    "preset": preset,
+                    "duration": 180000 + i * 1000,
+                    "snipped": False,
+                    "format": {"protocol": protocol, "mime_type": mime_type},
+                    "quality": "sq",
+                }
+                for kind, protocol, preset, mime_type in (
+                    ("a1b2c3", "hls", "mp3_1_0", "audio/mpeg"),
+                    ("d4e5f6", "progressive", "mp3_1_0", "audio/mpeg"),
+                    ("g7h8i9", "hls", "opus_0_0", 'audio/ogg; codecs="opus"'),
+                )
+            ]
+        },
+        "station_urn": f"soundcloud:system-playlists:track-stations:{1000000000 + i}",
+        "track_authorization": "eyJ0eXAiOiJKV1QiLCJhbGciOiJIUzI1NiJ9." + "x" * 180,
+        "monetization_model": "NOT_APPLICABLE",
+        "policy": "ALLOW",
+        "user": {
+            "avatar_url": f"https://i1.sndcdn.com/avatars-{i:012d}-large.jpg",
+            "first_name": "",
+            "followers_count": 10000 + i,
+            "full_name": "",
+            "id": 2000000 + i,
+            "kind": "user",
+            "last_modified": "2024-01-01T00:00:00Z",
+            "permalink": f"artist-{i}",
+            "permalink_url": f"https://soundcloud.com/artist-{i}",
+            "uri": f"https://api.soundcloud.com/users/{2000000 + i}",
+            "urn": f"soundcloud:users:{2000000 + i}",
+            "username": f"Artist {i}",
+            "verified": i % 3 == 0,
+            "city": "Berlin",
+            "country_code": "DE",
+            "badges": {"pro": False, "creator_mid_tier": True, "verified": i % 3 == 0},
+        },
+    }
+
+
+def make_response(count=100):
+    return json.dumps({
+        "collection": [make_track(i) for i in range(count)],
+        "total_results": 10000,
+        "next_href": "https://api-v2.soundcloud.com/search/tracks?offset=100",
+        "query_urn": "soundcloud:search:0123456789abcdef",
+    }, ensure_ascii=False).encode()
+
+
+def legacy_parse(body):
+    """Прежний разбор: весь ответ словарями, затем TrackInfo"""
+    collection = json.loads(body).get("collection", [])
+    return collection, [TrackInfo.from_api(track) for track in collection]
+
+
+def decode_tracks_with(module, body):
+    """decode_tracks с заданным декодером: orjson или None (стандартный json)"""
+    saved = codec.orjson
+    codec.orjson = module
+    try:
+        return decode_tracks(body)
+    finally:
+        codec.orjson = saved
+
+
+def measure_memory(parse, body):
+    """Пиковая память во время разбора и память, занятая результатом после него"""
+    tracemalloc.start()
+    result = parse(body)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return peak, retained
+
+
+def main():
+    body = make_response()
+    number = 200
+
+    variants = [("Прежний: json.loads + словари", legacy_parse)]
+    variants.append(("decode_tracks (json)", lambda data: decode_tracks_with(None, data)))
+    if codec.orjson is not None:
+        variants.append(("decode_tracks (orjson)", lambda data: decode_tracks_with(codec.orjson, data)))
+    else:
+        print("orjson не установлен - сравнивается только проекция на стандартном json")
+
+    print(f"Ответ поиска: {len(body) / 1024:.0f} КБ, 100 треков\n")
+    print(f"{'способ':<32} {'разбор, мс':>11} {'пик, КБ':>9} {'остается, КБ':>13}")
+    for name, parse in variants:
+        seconds = timeit.timeit(lambda: parse(body), number=number) / number
+        peak, retained = measure_memory(parse, body)
+        print(f"{name:<32} {seconds * 1000:>11.2f} {peak / 1024:>9.0f} {retained / 1024:>13.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Микробенчмарк отрисовки страниц результатов поиска
+
+Сравнивает прежнюю отрисовку страницы на каждое перелистывание
+(конкатенация строк + InlineKeyboardBuilder) с однократной отрисовкой
+всех страниц и выдачей из PageCache.
+
+    python bench/bench_render.py
+"""
+import os
+import sys
+import timeit
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import types
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+
+from render import PageCache, render_pages
+from sessions import SearchSession, TrackInfo
+
+
+def make_session(count=100):
+    tracks = [
+        TrackInfo(i, f"Track <{i}> & remix", f"Artist {i}", 180000 + i * 1000, None, None)
+        for i in range(count)
+    ]
+    return SearchSession(str(uuid.uuid4()), tracks, "test query", 1, 1, 1)
+
+
+def legacy_render(results, page):
+    """Отрисовка одной страницы так, как это делал show_tracks_page раньше"""
+    search_id = results.search_id
+    tracks = results.tracks
+    tracks_per_page = 10
+    start_idx = (page - 1) * tracks_per_page
+    end_idx = min(start_idx + tracks_per_page, len(tracks))
+    total_pages = (len(tracks) + tracks_per_page - 1) // tracks_per_page
+
+    message_text = f"🎵 <b>Поиск:</b> {results.query}\n\n"
+    for i in range(start_idx, end_idx):
+        track = tracks[i]
+        title = (track.title or "Без названия").replace("<", "&lt;").replace(">", "&gt;")
+        artist = (track.artist or "Неизвестный").replace("<", "&lt;").replace(">", "&gt;")
+        duration_sec = track.duration // 1000
+        message_text += f"{i - start_idx + 1}. <b>{artist}</b> - {title} [{duration_sec // 60}:{duration_sec % 60:02d}]\n"
+
+    builder = InlineKeyboardBuilder()
+    current_row = []
+    for i in range(start_idx, end_idx):
+        current_row.append(types.InlineKeyboardButton(text=str(i - start_idx + 1), callback_data=f"track_{search_id}_{i}"))
+        if len(current_row) == 5:
+            builder.row(*current_row)
+            current_row = []
+    if current_row:
+        builder.row(*current_row)
+
+    nav_buttons = []
+    if page > 1:
+        nav_buttons.append(types.InlineKeyboardButton(text="⬅️", callback_data=f"page_{search_id}_{page - 1}"))
+    nav_buttons.append(types.InlineKeyboardButton(text=f"📄 {page}/{total_pages}", callback_data="noop"))
+    if page < total_pages:
+        nav_buttons.append(types.InlineKeyboardButton(text="➡️", callback_data=f"page_{search_id}_{page + 1}"))
+    builder.row(*nav_buttons)
+    return message_text, builder.as_markup()
+
+
+def main():
+    results = make_session()
+    cache = PageCache()
+    cache.get(results)
+    flips = 1000
+
+    legacy = timeit.timeit(lambda: legacy_render(results, 5), number=flips)
+    full = timeit.timeit(lambda: render_pages(results), number=flips // 10)
+    cached = timeit.timeit(lambda: cache.get(results).pages[4], number=flips)
+
+    print(f"Прежняя отрисовка страницы:   {legacy / flips * 1e6:8.1f} мкс на перелистывание")
+    print(f"Отрисовка всех 10 страниц:    {full / (flips // 10) * 1e6:8.1f} мкс на поиск")
+    print(f"Страница из PageCache:        {cached / flips * 1e6:8.1f} мкс на перелистывание")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,409 @@
+"""Локальные заглушки SoundCloud API и Telegram Bot API для бенчмарков
+
+FakeSoundCloud отдает поиск, чарты, похожие треки, плейлисты по ссылке,
+JSON трека с вариантами кодировки, progressive MP3 и HLS-плейлисты с
+сегментами.
+FakeTelegram принимает вызовы Bot API, которые делает бот, и запоминает
+последние сообщения, клавиатуры и отправленные аудио по чатам.
+
+Задержка ответов и размеры аудио настраиваются. Для ручной проверки бота
+заглушки можно запустить отдельно:
+
+    python bench/fake_services.py --port 9000 --latency 50
+
+и указать боту SOUNDCLOUD_API_URL=http://127.0.0.1:9000/sc,
+SOUNDCLOUD_MOBILE_API_URL=http://127.0.0.1:9000/mobi и
+TELEGRAM_API_URL=http://127.0.0.1:9000/tg.
+"""
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import random
+import re
+import socket
+import time
+from collections import defaultdict
+
+from aiohttp import web
+
+
+def track_ids(seed, count, start=1):
+    """Детерминированный набор ID треков для запроса"""
+    base = int(hashlib.md5(seed.encode()).hexdigest()[:6], 16)
+    return [base * 1000 + i for i in range(start, start + count)]
+
+
+class FakeSoundCloud:
+    """Заглушка SoundCloud: /sc - api-v2, /mobi - мобильный API, /cdn - аудио"""
+
+    def __init__(self, latency=0.02, results=100, audio_size=3 * 1024 * 1024,
+                 segments=20, protocol="progressive", chunk_size=64 * 1024, playlist_size=25,
+                 ranges=True, drop_rate=0.0):
+        self.latency = latency
+        # Поддержка Range для progressive MP3 и доля ответов, обрываемых на середине
+        self.ranges = ranges
+        self.drop_rate = drop_rate
+        self.dropped = 0
+        self.results = results
+        self.playlist_size = playlist_size
+        self.audio_size = audio_size
+        self.segments = segments
+        # progressive, hls или both - какие варианты кодировки отдавать в JSON трека
+        self.protocol = protocol
+        self.chunk = b"\xff" * chunk_size
+        self.base_url = None
+        self.requests = defaultdict(int)
+        self.bytes_sent = 0
+
+    def setup(self, app, base_url):
+        self.base_url = base_url
+        app.router.add_get("/sc/search/tracks", self.search)
+        app.router.add_get("/sc/charts", self.charts)
+        app.router.add_get("/sc/tracks/{id}/related", self.related)
+        app.router.add_get("/sc/resolve", self.resolve)
+        app.router.add_get("/sc/tracks", self.tracks)
+        app.router.add_get("/sc/tracks/{id}", self.track)
+        app.router.add_get("/sc/media/{id}/{protocol}", self.media)
+        app.router.add_get("/mobi/tracks/{id}", self.mobile_track)
+        app.router.add_get("/cdn/{id}.mp3", self.audio)
+        app.router.add_get("/cdn/{id}.m3u8", self.playlist)
+        app.router.add_get("/cdn/{id}/{segment}.mp3", self.segment)
+
+    def track_json(self, track_id):
+        return {
+            "id": track_id,
+            "title": f"Track {track_id}",
+            "duration": 180000 + track_id % 120000,
+            "artwork_url": None,
+            "permalink_url": f"https://soundcloud.com/bench/{track_id}",
+            "user": {"username": f"Artist {track_id % 97}"},
+        }
+
+    async def _delay(self, name):
+        self.requests[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def search(self, request):
+        await self._delay("search")
+        ids = track_ids(request.query.get("q", ""), self.results)
+        return web.json_response({"collection": [self.track_json(i) for i in ids]})
+
+    async def charts(self, request):
+        await self._delay("charts")
+        ids = track_ids("charts", self.results)
+        return web.json_response({"collection": [{"track": self.track_json(i)} for i in ids]})
+
+    async def related(self, request):
+        await self._delay("related")
+        ids = track_ids(f"related:{request.match_info['id']}", self.results)
+        return web.json_response({"collection": [self.track_json(i) for i in ids]})
+
+    async def resolve(self, request):
+        await self._delay("resolve")
+        url = request.query.get("url", "")
+        if "/sets/" not in url:
+            return web.json_response({"error": "not found"}, status=404)
+        ids = track_ids(f"playlist:{url}", self.playlist_size)
+        # Как в настоящем API: полные данные только у первых треков, дальше - только ID
+        tracks = [self.track_json(i) if n < 5 else {"id": i, "kind": "track"} for n, i in enumerate(ids)]
+        return web.json_response({"kind": "playlist", "title": f"Playlist {ids[0]}", "tracks": tracks})
+
+    async def tracks(self, request):
+        await self._delay("tracks")
+        ids = [int(i) for i in request.query.get("ids", "").split(",") if i]
+        return web.json_response([self.track_json(i) for i in ids])
+
+    async def track(self, request):
+        await self._delay("track")
+        track_id = int(request.match_info["id"])
+        transcodings = []
+        if self.protocol in ("progressive", "both"):
+            transcodings.append({
+                "url": f"{self.base_url}/sc/media/{track_id}/progressive",
+                "format": {"protocol": "progressive", "mime_type": "audio/mpeg"},
+            })
+        if self.protocol in ("hls", "both"):
+            transcodings.append({
+                "url": f"{self.base_url}/sc/media/{track_id}/hls",
+                "format": {"protocol": "hls", "mime_type": "audio/mpeg"},
+            })
+        data = self.track_json(track_id)
+        data["media"] = {"transcodings": transcodings}
+        return web.json_response(data)
+
+    async def media(self, request):
+        await self._delay("media")
+        track_id = request.match_info["id"]
+        extension = "m3u8" if request.match_info["protocol"] == "hls" else "mp3"
+        # Подпись в стиле CDN SoundCloud, чтобы StreamResolver вычислял срок жизни ссылки
+        expires = int(time.time()) + 3600
+        return web.json_response({"url": f"{self.base_url}/cdn/{track_id}.{extension}?Expires={expires}"})
+
+    async def mobile_track(self, request):
+        await self._delay("mobile")
+        track_id = request.match_info["id"]
+        return web.json_response({"stream_url": f"{self.base_url}/cdn/{track_id}.mp3"})
+
+    async def _stream(self, request, size, status=200, headers=None):
+        response = web.StreamResponse(status=status, headers={
+            "Content-Type": "audio/mpeg",
+            "Content-Length": str(size),
+            **(headers or {}),
+        })
+        await response.prepare(request)
+        # Обрыв соединения на середине ответа, как у нестабильного CDN
+        drop_at = size // 2 if self.drop_rate and random.random() < self.drop_rate else None
+        left = size
+        while left > 0:
+            chunk = self.chunk if left >= len(self.chunk) else self.chunk[:left]
+            if drop_at is not None and size - left >= drop_at:
+                self.dropped += 1
+                request.transport.close()
+                return response
+            await response.write(chunk)
+            left -= len(chunk)
+            self.bytes_sent += len(chunk)
+        await response.write_eof()
+        return response
+
+    async def audio(self, request):
+        await self._delay("audio")
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", request.headers.get("Range", ""))
+        if not self.ranges or match is None:
+            return await self._stream(request, self.audio_size)
+
+        start = int(match.group(1))
+        end = min(int(match.group(2) or self.audio_size - 1), self.audio_size - 1)
+        return await self._stream(request, end - start + 1, status=206, headers={
+            "Content-Range": f"bytes {start}-{end}/{self.audio_size}",
+        })
+
+    async def playlist(self, request):
+        await self._delay("playlist")
+        track_id = request.match_info["id"]
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:10"]
+        for i in range(self.segments):
+            lines.append("#EXTINF:10.0,")
+            lines.append(f"{track_id}/{i}.mp3")
+        lines.append("#EXT-X-ENDLIST")
+        return web.Response(text="\n".join(lines), content_type="application/vnd.apple.mpegurl")
+
+    async def segment(self, request):
+        await self._delay("segment")
+        return await self._stream(request, max(1, self.audio_size // self.segments))
+
+
+class DeliveryFailed(Exception):
+    """Бот сообщил об ошибке вместо отправки аудио"""
+
+
+class FakeTelegram:
+    """Заглушка Bot API: /tg/bot<token>/<method>
+
+    chat_rate - сколько запросов в секунду принимается в один чат; сверх
+    этого отвечает 429 с retry_after, как настоящий Telegram.
+    """
+
+    def __init__(self, latency=0.02, upload_latency=0.2, chat_rate=None):
+        self.latency = latency
+        self.upload_latency = upload_latency
+        self.chat_rate = chat_rate
+        self.requests = defaultdict(int)
+        self.flood_errors = 0
+        self.uploaded_bytes = 0
+
+        self._message_ids = itertools.count(1000)
+        self._file_ids = itertools.count(1)
+        self._chat_calls = defaultdict(list)
+        # chat_id -> последнее сообщение, клавиатура и аудио
+        self.last_message = {}
+        self.last_markup = {}
+        self.last_audio = {}
+        self._audio_waiters = defaultdict(list)
+        # callback_query_id -> ожидание аудио, которое отменяет уведомление об ошибке
+        self._alert_waiters = {}
+
+    def setup(self, app):
+        app.router.add_post("/tg/bot{token}/{method}", self.handle)
+
+    async def wait_audio(self, chat_id, timeout, callback_query_id=None):
+        """Ждет следующего аудио в чате и возвращает сообщение с ним
+
+        Если бот вместо аудио показал уведомление об ошибке в ответ на
+        callback_query_id или написал в чат предупреждение "⚠️", бросает
+        DeliveryFailed сразу, не дожидаясь таймаута.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._audio_waiters[chat_id].append(future)
+        if callback_query_id is not None:
+            self._alert_waiters[callback_query_id] = future
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._alert_waiters.pop(callback_query_id, None)
+
+    def _message(self, chat_id, message_id=None, **fields):
+        return {
+            "message_id": message_id or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "bench"},
+            **fields,
+        }
+
+    def _flooded(self, chat_id):
+        if not self.chat_rate:
+            return False
+        now = time.monotonic()
+        calls = [t for t in self._chat_calls[chat_id] if now - t < 1]
+        if len(calls) >= self.chat_rate:
+            self._chat_calls[chat_id] = calls
+            return True
+        calls.append(now)
+        self._chat_calls[chat_id] = calls
+        return False
+
+    async def handle(self, request):
+        method = request.match_info["method"].lower()
+        self.requests[method] += 1
+        data = await request.post()
+        chat_id = int(data["chat_id"]) if "chat_id" in data else None
+
+        if chat_id is not None and self._flooded(chat_id):
+            self.flood_errors += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            })
+
+        await asyncio.sleep(self.upload_latency if method == "sendaudio" else self.latency)
+
+        if method == "sendmessage":
+            message = self._message(chat_id, text=data.get("text", ""))
+            self.last_message[chat_id] = message
+            if message["text"].startswith("⚠️"):
+                for future in self._audio_waiters.pop(chat_id, []):
+                    if not future.done():
+                        future.set_exception(DeliveryFailed(message["text"]))
+            return self._ok(message)
+
+        if method == "answercallbackquery":
+            future = self._alert_waiters.get(data.get("callback_query_id"))
+            if future is not None and not future.done() and data.get("show_alert") == "true":
+                future.set_exception(DeliveryFailed(data.get("text", "")))
+            return self._ok(True)
+
+        if method == "editmessagetext":
+            if "reply_markup" in data:
+                self.last_markup[chat_id] = json.loads(data["reply_markup"])
+            message = self._message(chat_id, int(data["message_id"]), text=data.get("text", ""))
+            return self._ok(message)
+
+        if method == "sendaudio":
+            message = self._message(chat_id, audio=self._audio(data.get("audio"), data.get("title", "")))
+            if "reply_markup" in data:
+                message["reply_markup"] = json.loads(data["reply_markup"])
+            self._audio_sent(chat_id, message)
+            return self._ok(message)
+
+        if method == "sendmediagroup":
+            messages = []
+            for media in json.loads(data["media"]):
+                audio = media["media"]
+                if audio.startswith("attach://"):
+                    audio = data.get(audio[len("attach://"):])
+                messages.append(self._message(chat_id, audio=self._audio(audio, media.get("title", ""))))
+            self._audio_sent(chat_id, messages[-1])
+            return self._ok(messages)
+
+        if method == "senddocument":
+            document = data.get("document")
+            name = getattr(document, "filename", None) or "document"
+            file_id = f"bench-{next(self._file_ids)}"
+            message = self._message(chat_id, document={"file_id": file_id, "file_unique_id": file_id, "file_name": name})
+            self.last_message[chat_id] = message
+            return self._ok(message)
+
+        # deleteMessage, answerCallbackQuery и прочие вызовы просто подтверждаются
+        return self._ok(True)
+
+    def _audio(self, audio, title):
+        if hasattr(audio, "file"):
+            size = len(audio.file.read())
+            self.uploaded_bytes += size
+            file_id = f"bench-{next(self._file_ids)}"
+        else:
+            size = 0
+            file_id = str(audio)
+        return {"file_id": file_id, "file_unique_id": file_id, "duration": 180, "title": title, "file_size": size}
+
+    def _audio_sent(self, chat_id, message):
+        self.last_audio[chat_id] = message
+        for future in self._audio_waiters.pop(chat_id, []):
+            if not future.done():
+                future.set_result(message)
+
+    def _ok(self, result):
+        return web.json_response({"ok": True, "result": result})
+
+
+async def start_services(soundcloud, telegram, host="127.0.0.1", port=0):
+    """Запускает обе заглушки на одном aiohttp-сервере. Возвращает (runner, base_url)"""
+    # Telegram принимает файлы до 50 МБ
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    runner = web.AppRunner(app)
+    site_port = port
+    if not port:
+        # Свободный порт нужен до регистрации маршрутов: из него строятся ссылки на CDN
+        with socket.socket() as sock:
+            sock.bind((host, 0))
+            site_port = sock.getsockname()[1]
+    base_url = f"http://{host}:{site_port}"
+    soundcloud.setup(app, base_url)
+    telegram.setup(app)
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=site_port).start()
+    return runner, base_url
+
+
+async def serve(args):
+    soundcloud = FakeSoundCloud(
+        latency=args.latency / 1000,
+        audio_size=args.audio_size,
+        segments=args.segments,
+        protocol=args.protocol,
+        ranges=args.ranges,
+        drop_rate=args.drop_rate,
+    )
+    telegram = FakeTelegram(latency=args.latency / 1000, chat_rate=args.chat_rate)
+    runner, base_url = await start_services(soundcloud, telegram, port=args.port)
+    print(f"SoundCloud: {base_url}/sc, {base_url}/mobi; Telegram: {base_url}/tg")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def add_service_arguments(parser):
+    parser.add_argument("--latency", type=float, default=20, help="задержка ответа API, мс")
+    parser.add_argument("--audio-size", type=int, default=3 * 1024 * 1024, help="размер трека, байт")
+    parser.add_argument("--segments", type=int, default=20, help="число сегментов HLS")
+    parser.add_argument("--protocol", choices=("progressive", "hls", "both"), default="progressive")
+    parser.add_argument("--no-ranges", dest="ranges", action="store_false", help="не поддерживать Range для MP3")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="доля ответов с аудио, обрываемых на середине")
+    parser.add_argument("--chat-rate", type=int, default=None, help="лимит запросов в чат в секунду (429 сверх него)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=9000)
+    add_service_arguments(parser)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,348 @@
+"""Нагрузочный прогон обработчиков bot.py на локальных заглушках
+
+Поднимает FakeSoundCloud и FakeTelegram (bench/fake_services.py),
+направляет на них бота и от имени множества пользователей подает в
+диспетчер апдейты: поиск, перелистывание, выбор трека, загрузка страницы
+альбомом, похожие треки и /top. Запросы выбираются по распределению Ципфа, поэтому кэши поиска и
+file_id работают как на живой нагрузке.
+
+Для каждого действия выводятся число, ошибки и перцентили задержки; для
+выбора трека задержка считается до получения аудио заглушкой Telegram.
+В конце - пропускная способность и пиковое потребление памяти процесса
+(заглушки работают в том же процессе).
+
+С --restart прогон идет в две фазы с перезапуском между ними: снимок
+записывается, сессии и кэши в памяти заменяются пустыми и восстанавливаются
+из снимка (с --cold не восстанавливаются). Вторая фаза начинается с нажатия
+кнопки трека в сообщении, отправленном до перезапуска ("reopen"); число
+запросов к SoundCloud во второй фазе показывает нагрузку на upstream после
+перезапуска.
+
+    python bench/load.py --users 50 --duration 30
+    python bench/load.py --users 20 --protocol hls --latency 100 --tracemalloc
+    python bench/load.py --users 50 --duration 10 --restart [--cold]
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from callbacks import DownloadPageCallback, PageCallback, TrackCallback
+from fake_services import FakeSoundCloud, FakeTelegram, add_service_arguments, start_services
+
+QUERIES = [f"bench query {i}" for i in range(200)]
+
+
+class Recorder:
+    """Задержки и ошибки по типам действий"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def add(self, action, seconds):
+        self.latencies[action].append(seconds)
+
+    def fail(self, action):
+        self.errors[action] += 1
+
+    def report(self, elapsed):
+        print(f"{'действие':<10} {'число':>7} {'ошибки':>7} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9} {'max, мс':>9}")
+        total = 0
+        for action in sorted(set(self.latencies) | set(self.errors)):
+            values = sorted(self.latencies[action])
+            total += len(values)
+            if values:
+                p50, p95, p99 = (percentile(values, p) * 1000 for p in (50, 95, 99))
+                peak = values[-1] * 1000
+                print(f"{action:<10} {len(values):>7} {self.errors[action]:>7} {p50:>9.1f} {p95:>9.1f} {p99:>9.1f} {peak:>9.1f}")
+            else:
+                print(f"{action:<10} {0:>7} {self.errors[action]:>7}")
+        selections = len(self.latencies["select"])
+        print(f"\nВсего действий: {total} за {elapsed:.1f} с - {total / elapsed:.1f}/с, треков: {selections / elapsed:.2f}/с")
+
+
+def percentile(values, p):
+    index = min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+def zipf_choice(rng, items, s=1.1):
+    weights = [1 / (rank ** s) for rank in range(1, len(items) + 1)]
+    return rng.choices(items, weights)[0]
+
+
+class VirtualUser:
+    def __init__(self, user_id, env, args, recorder):
+        self.user_id = user_id
+        self.chat_id = user_id
+        self.env = env
+        self.args = args
+        self.recorder = recorder
+        self.rng = random.Random(user_id)
+
+    def _user(self):
+        return {"id": self.user_id, "is_bot": False, "first_name": f"user{self.user_id}"}
+
+    async def _feed(self, update):
+        bot_module = self.env.bot_module
+        update["update_id"] = next(self.env.update_ids)
+        update = bot_module.types.Update.model_validate(update, context={"bot": bot_module.bot})
+        await bot_module.dp.feed_update(bot_module.bot, update)
+
+    async def send_text(self, text):
+        await self._feed({"message": {
+            "message_id": next(self.env.update_ids),
+            "date": int(time.time()),
+            "chat": {"id": self.chat_id, "type": "private"},
+            "from": self._user(),
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}] if text.startswith("/") else None,
+        }})
+
+    async def press(self, message, data, callback_query_id=None):
+        await self._feed({"callback_query": {
+            "id": callback_query_id or str(next(self.env.update_ids)),
+            "from": self._user(),
+            "chat_instance": str(self.chat_id),
+            "message": message,
+            "data": data,
+        }})
+
+    def _buttons(self, callback_class):
+        markup = self.env.telegram.last_markup.get(self.chat_id) or {}
+        prefix = f"{callback_class.__prefix__}:"
+        return [
+            button["callback_data"]
+            for row in markup.get("inline_keyboard", [])
+            for button in row
+            if button["callback_data"].startswith(prefix)
+        ]
+
+    async def timed(self, action, coroutine):
+        started = time.monotonic()
+        try:
+            await coroutine
+        except Exception as e:
+            self.recorder.fail(action)
+            if self.args.verbose:
+                print(f"{action}: {e!r}")
+            return False
+        self.recorder.add(action, time.monotonic() - started)
+        return True
+
+    async def select(self, results_message, data):
+        telegram = self.env.telegram
+        callback_query_id = str(next(self.env.update_ids))
+        # Ошибка загрузки (уведомление бота) завершает ожидание сразу, а не по таймауту
+        waiter = asyncio.ensure_future(telegram.wait_audio(self.chat_id, self.args.timeout, callback_query_id))
+        await self.press(results_message, data, callback_query_id)
+        await waiter
+
+    async def session(self):
+        """Один сценарий: поиск или топ, перелистывание, выбор трека, похожие"""
+        telegram = self.env.telegram
+        if self.rng.random() < self.args.top_ratio:
+            ok = await self.timed("top", self.send_text("/top"))
+        else:
+            ok = await self.timed("search", self.send_text(zipf_choice(self.rng, QUERIES)))
+        if not ok:
+            return
+
+        results_message = telegram.last_message.get(self.chat_id)
+        tracks = self._buttons(TrackCallback)
+        if not tracks:
+            self.recorder.fail("search")
+            return
+
+        if self.rng.random() < self.args.page_ratio:
+            next_pages = self._buttons(PageCallback)
+            if next_pages:
+                await self.timed("page", self.press(results_message, next_pages[-1]))
+                tracks = self._buttons(TrackCallback)
+
+        download = self._buttons(DownloadPageCallback)
+        if download and self.rng.random() < self.args.batch_ratio:
+            # Альбом считается полученным, когда заглушка Telegram приняла его последнее аудио
+            await self.timed("batch", self.select(results_message, download[0]))
+            return
+
+        # Первые позиции выдачи выбирают чаще
+        if not await self.timed("select", self.select(results_message, zipf_choice(self.rng, tracks))):
+            return
+
+        # Кнопка "Найти похожие" прикреплена к сообщению с аудио
+        audio_message = telegram.last_audio.get(self.chat_id)
+        if audio_message and "reply_markup" in audio_message and self.rng.random() < self.args.similar_ratio:
+            data = audio_message["reply_markup"]["inline_keyboard"][0][0]["callback_data"]
+            await self.timed("similar", self.press(audio_message, data))
+
+    async def reopen(self):
+        """Выбор трека в результатах, отправленных до перезапуска"""
+        results_message = self.env.telegram.last_message.get(self.chat_id)
+        tracks = self._buttons(TrackCallback)
+        if not results_message or not tracks:
+            return
+        data = zipf_choice(self.rng, tracks)
+        # Без сессии бот ответит, что результаты устарели, и аудио не придет
+        if await self.env.bot_module.search_sessions.get(TrackCallback.unpack(data).search_id) is None:
+            self.recorder.fail("reopen")
+            return
+        await self.timed("reopen", self.select(results_message, data))
+
+    async def run(self, deadline):
+        while time.monotonic() < deadline:
+            await self.session()
+            if self.args.think:
+                await asyncio.sleep(self.rng.expovariate(1 / self.args.think))
+
+
+async def run_phase(env, args, reopen=False):
+    recorder = Recorder()
+    users = [VirtualUser(1_000_000 + i, env, args, recorder) for i in range(args.users)]
+    started = time.monotonic()
+    deadline = started + args.duration
+    if reopen:
+        await asyncio.gather(*(user.reopen() for user in users))
+    await asyncio.gather(*(user.run(deadline) for user in users))
+    await env.bot_module.download_scheduler.drain(args.timeout)
+    return recorder, time.monotonic() - started
+
+
+async def restart(bot_module, cold=False):
+    """Перезапуск в том же процессе: снимок, пустые кэши в памяти, восстановление в фоне
+
+    Кэш file_id и индекс треков хранятся на диске и переживают перезапуск
+    в любом случае.
+    """
+    from render import PageCache
+    from search_cache import SearchCache
+    from sessions import MemorySessionStorage
+    from stream_resolver import StreamResolver
+
+    await bot_module.save_snapshot()
+    bot_module.search_cache = SearchCache()
+    bot_module.stream_resolver = StreamResolver()
+    bot_module.page_cache = PageCache()
+    bot_module.search_sessions = MemorySessionStorage()
+    bot_module.search_sessions.on_evict = bot_module.forget_search
+    if not cold:
+        bot_module.search_sessions.restoring = asyncio.create_task(bot_module.restore_snapshot())
+
+
+def configure(base_url, workdir):
+    """Настройки бота до импорта bot.py: все внешние адреса указывают на заглушки"""
+    os.environ.update({
+        "BOT_TOKEN": "123456:bench-token",
+        "SOUNDCLOUD_CLIENT_ID": "bench",
+        "TELEGRAM_API_URL": f"{base_url}/tg",
+        "SOUNDCLOUD_API_URL": f"{base_url}/sc",
+        "SOUNDCLOUD_MOBILE_API_URL": f"{base_url}/mobi",
+        "FILE_CACHE_PATH": os.path.join(workdir, "file_cache.sqlite3"),
+        "TRACK_INDEX_PATH": os.path.join(workdir, "track_index.sqlite3"),
+        "ARTWORK_DIR": os.path.join(workdir, "artwork"),
+        "DOWNLOAD_DIR": os.path.join(workdir, "downloads"),
+        "POSTPROCESS_DIR": os.path.join(workdir, "processed"),
+        "SNAPSHOT_PATH": os.path.join(workdir, "snapshot.json.gz"),
+    })
+    for name in ("REDIS_URL", "WEBHOOK_URL", "METRICS_PORT", "PREFETCH_CHAT_ID"):
+        os.environ.pop(name, None)
+
+
+async def main(args):
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    soundcloud = FakeSoundCloud(
+        latency=args.latency / 1000,
+        audio_size=args.audio_size,
+        segments=args.segments,
+        protocol=args.protocol,
+        ranges=args.ranges,
+        drop_rate=args.drop_rate,
+    )
+    telegram = FakeTelegram(
+        latency=args.latency / 1000,
+        upload_latency=args.upload_latency / 1000,
+        chat_rate=args.chat_rate,
+    )
+    runner, base_url = await start_services(soundcloud, telegram)
+
+    workdir = tempfile.mkdtemp(prefix="hx-bench-")
+    configure(base_url, workdir)
+
+    from loguru import logger
+    logger.remove()
+    logger.add(sys.stderr, level="DEBUG" if args.verbose else "ERROR")
+
+    import bot as bot_module
+
+    env = SimpleNamespace(bot_module=bot_module, telegram=telegram, update_ids=itertools.count(1))
+
+    bot_module.postprocessor.start()
+    await bot_module.http.start()
+    bot_module.outbound_queue.start()
+    await bot_module.download_scheduler.start()
+
+    recorder, elapsed = await run_phase(env, args)
+    recorder.report(elapsed)
+    if args.restart:
+        await restart(bot_module, cold=args.cold)
+        print(f"\nSoundCloud до перезапуска: {dict(soundcloud.requests)}")
+        soundcloud.requests.clear()
+        print(f"После {'холодного' if args.cold else 'теплого'} перезапуска:")
+        recorder, elapsed = await run_phase(env, args, reopen=True)
+        recorder.report(elapsed)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"Пиковая память процесса (RSS): {peak_rss:.1f} МБ")
+    if args.tracemalloc:
+        _, peak = tracemalloc.get_traced_memory()
+        print(f"Пиковая память Python (tracemalloc): {peak / (1024 * 1024):.1f} МБ")
+    print(f"SoundCloud: {dict(soundcloud.requests)}, отдано {soundcloud.bytes_sent / (1024 * 1024):.1f} МБ, обрывов: {soundcloud.dropped}")
+    print(f"Telegram: {dict(telegram.requests)}, 429: {telegram.flood_errors}")
+    print(f"Кэш file_id: {bot_module.file_cache.stats()}")
+    print(f"Загрузки: {bot_module.download_scheduler.stats()}")
+    print(f"Исходящая очередь: {bot_module.outbound_queue.stats()}")
+    print(f"Постобработка: {bot_module.postprocessor.stats()}")
+
+    await bot_module.download_scheduler.close()
+    bot_module.postprocessor.close()
+    await bot_module.outbound_queue.close()
+    await bot_module.bot.session.close()
+    bot_module.file_cache.close()
+    await bot_module.track_index.flush()
+    bot_module.track_index.close()
+    await bot_module.http.close()
+    await runner.cleanup()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="число одновременных пользователей")
+    parser.add_argument("--duration", type=float, default=20, help="длительность прогона, с")
+    parser.add_argument("--think", type=float, default=0.5, help="средняя пауза пользователя между сценариями, с")
+    parser.add_argument("--upload-latency", type=float, default=200, help="задержка приема аудио Telegram, мс")
+    parser.add_argument("--timeout", type=float, default=120, help="таймаут ожидания аудио, с")
+    parser.add_argument("--top-ratio", type=float, default=0.1, help="доля сценариев с /top")
+    parser.add_argument("--page-ratio", type=float, default=0.3, help="доля сценариев с перелистыванием")
+    parser.add_argument("--batch-ratio", type=float, default=0.05, help="доля сценариев с загрузкой страницы альбомом")
+    parser.add_argument("--similar-ratio", type=float, default=0.2, help="доля сценариев с поиском похожих")
+    parser.add_argument("--restart", action="store_true", help="перезапуск со снимком посередине прогона")
+    parser.add_argument("--cold", action="store_true", help="с --restart: не восстанавливать снимок")
+    parser.add_argument("--tracemalloc", action="store_true", help="дополнительно замерить память Python (медленнее)")
+    parser.add_argument("--verbose", action="store_true")
+    add_service_arguments(parser)
+    asyncio.run(main(parser.parse_args()))
@@ -2,34 +2,148 @@ import asyncio
 import os
 import aiohttp
 import io
+import re
+import tempfile
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import CommandStart, Command
+from aiogram.filters import CommandStart, Command, CommandObject
 from aiogram.enums import ParseMode
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import FSInputFile, URLInputFile, BufferedInputFile
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from dotenv import load_dotenv
 from loguru import logger
-import uuid
+import time
 
+# Модули ниже читают настройки при импорте, поэтому .env загружается до них
 load_dotenv()
 
-bot = Bot(token=os.getenv("BOT_TOKEN"))
+from artwork import ArtworkCache
+from callbacks import DownloadPageCallback, NoopCallback, PageCallback, SimilarCallback, TrackCallback
+from codec import decode_tracks
+from file_cache import FileIdCache
+from hls import SegmentError, iter_segments, parse_playlist
+from http_client import SOUNDCLOUD_API_URL, SoundCloudError, http
+from logs import redact_url, sampled_logger, sampler, setup_logging
+import metrics
+from outbound import OutboundQueue
+from postprocess import AUDIO_EXTENSIONS, PostProcessor
+from prefetch import Prefetcher
+from profiler import LoopProfiler, dump_tasks
+from ranged import DownloadError, download_file
+from scheduler import AlreadyQueued, DownloadScheduler, QuotaExceeded
+from soundcloud import soundcloud
+from render import TRACKS_PER_PAGE, PageCache, format_duration
+from search_cache import SearchCache, normalize_query
+from sessions import SearchSession, TrackInfo, create_session_storage, new_search_id
+from snapshot import Snapshot
+from stream_resolver import StreamResolver
+from track_index import TrackIndex
+from webhook import UpdateLimiter, run_webhook
+
+# TELEGRAM_API_URL - собственный сервер Bot API (локальный telegram-bot-api или стенд из bench/)
+if os.getenv("TELEGRAM_API_URL"):
+    bot = Bot(
+        token=os.getenv("BOT_TOKEN"),
+        session=AiohttpSession(api=TelegramAPIServer.from_base(os.getenv("TELEGRAM_API_URL")))
+    )
+else:
+    bot = Bot(token=os.getenv("BOT_TOKEN"))
 dp = Dispatcher()
 
-# Store user search results
-user_search_results = {}
+# Ограничение числа одновременно обрабатываемых апдейтов
+update_limiter = UpdateLimiter()
+dp.update.outer_middleware(update_limiter)
 
-async def cleanup_previous_search(user_id):
-    """Очищает предыдущие результаты поиска"""
-    if user_id in user_search_results:
-        try:
-            del user_search_results[user_id]
-        except Exception as e:
-            pass  # Полностью убираем логирование
+# Исходящие сообщения и правки идут через очередь с учетом лимитов Telegram
+outbound_queue = OutboundQueue()
+bot.session.middleware(outbound_queue)
+
+# Ограничения размера аудиофайла: Telegram принимает от ботов файлы до 50 МБ
+MIN_AUDIO_SIZE = 100 * 1024
+MAX_AUDIO_SIZE = 50 * 1024 * 1024
+
+# Треки скачиваются во временные файлы частями, а не целиком в память
+DOWNLOAD_DIR = os.getenv("DOWNLOAD_DIR", os.path.join(tempfile.gettempdir(), "hx-music-bot"))
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(64 * 1024)))
+
+# Таймауты по типам запросов: зависшее соединение обрывается по sock_read,
+# не дожидаясь общего лимита на весь файл
+PLAYLIST_TIMEOUT = aiohttp.ClientTimeout(total=float(os.getenv("HLS_PLAYLIST_TIMEOUT", "15")), sock_connect=5)
+SEGMENT_TIMEOUT = aiohttp.ClientTimeout(total=float(os.getenv("HLS_SEGMENT_TIMEOUT", "30")), sock_connect=5)
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(
+    total=float(os.getenv("DOWNLOAD_TIMEOUT", "300")),
+    sock_connect=10,
+    sock_read=float(os.getenv("DOWNLOAD_READ_TIMEOUT", "30"))
+)
+
+# Кэш file_id уже загруженных в Telegram треков
+file_cache = FileIdCache(os.getenv("FILE_CACHE_PATH", "data/file_cache.sqlite3"))
+
+# Кэш ответов SoundCloud: поиск, чарты и похожие треки
+search_cache = SearchCache()
+TOP_CACHE_KEY = "charts:top"
+TOP_REFRESH_INTERVAL = int(os.getenv("TOP_REFRESH_INTERVAL", "600"))
+
+# Локальный индекс уже виденных треков: поиск без SoundCloud и inline-подсказки
+track_index = TrackIndex(os.getenv("TRACK_INDEX_PATH", "data/track_index.sqlite3"))
+# Если локально нашлось хотя бы столько треков, SoundCloud не запрашивается (0 - всегда запрашивать)
+TRACK_INDEX_MIN_RESULTS = int(os.getenv("TRACK_INDEX_MIN_RESULTS", "30"))
+INLINE_RESULTS = int(os.getenv("INLINE_RESULTS", "20"))
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "300"))
+
+# Получение ссылок на аудиопоток с кэшированием
+stream_resolver = StreamResolver()
+
+# Миниатюры обложек, подготовленные под ограничения Telegram
+artwork_cache = ArtworkCache()
+
+# Перепаковка HLS и ID3-теги в пуле процессов, готовые файлы кэшируются по ID трека
+postprocessor = PostProcessor()
+
+# Очередь загрузок: ограничение параллельности и квоты пользователей
+download_scheduler = DownloadScheduler()
+
+# Все скачивания (выбор трека, пакеты, предзагрузка) делят DOWNLOAD_WORKERS мест:
+# пакет занимает одно место в планировщике, но скачивает треки параллельно
+download_slots = asyncio.Semaphore(download_scheduler.workers)
+# track_id -> [Lock, число ожидающих]: один трек не скачивается дважды одновременно
+track_locks = {}
+
+# Пакетная загрузка страницы или плейлиста: сколько треков одного пакета скачивается одновременно
+BATCH_CONCURRENCY = int(os.getenv("BATCH_DOWNLOAD_CONCURRENCY", "3"))
+# Telegram принимает в одном альбоме от 2 до 10 файлов
+MEDIA_GROUP_SIZE = 10
+
+# Ссылки на плейлисты и альбомы SoundCloud
+PLAYLIST_URL_RE = re.compile(r"https?://(?:www\.|m\.)?soundcloud\.com/[\w.-]+/sets/[\w.-]+", re.IGNORECASE)
+# Сколько треков плейлиста запрашивается у API за раз
+PLAYLIST_TRACKS_CHUNK = 50
+
+# Отрисованные страницы результатов поиска
+page_cache = PageCache()
+
+# Результаты поиска пользователей (в памяти процесса или в Redis)
+search_sessions = create_session_storage()
+
+# Сессии и горячие кэши сохраняются при остановке и восстанавливаются в фоне при старте
+snapshot = Snapshot()
+
+# Администраторы: им доступна команда /debug
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if user_id}
+
+# Профилирование цикла событий по команде /debug profile
+loop_profiler = LoopProfiler()
+
+# Текущее состояние очередей и хранилищ для /metrics
+metrics.Gauge("hx_active_downloads", "Загрузки, которые выполняются сейчас", fn=lambda: download_scheduler.running)
+metrics.Gauge("hx_download_queue", "Загрузки, ожидающие в очереди", fn=download_scheduler.queued)
+metrics.Gauge("hx_outbound_queue", "Сообщения, ожидающие отправки в Telegram", fn=outbound_queue.queued)
+metrics.Gauge("hx_sessions", "Поисковые сессии в хранилище", fn=lambda: search_sessions.stats().get("sessions"))
 
 @dp.message(CommandStart())
 async def cmd_start(message: types.Message):
-    await cleanup_previous_search(message.from_user.id)
     user_name = message.from_user.first_name
     
     welcome_text = (
@@ -60,56 +174,218 @@ async def cmd_start(message: types.Message):
         reply_markup=builder.as_markup()
     )
 
+async def fetch_tracks(url, params, nested=None):
+    """Запрашивает у SoundCloud API коллекцию треков и сразу сводит ее к TrackInfo"""
+    try:
+        tracks = await soundcloud.get_json(url, params, decode=lambda body: decode_tracks(body, nested))
+    except SoundCloudError:
+        metrics.errors_total.inc(stage="search")
+        raise
+    track_index.add(tracks)
+    return tracks
+
+async def fetch_top_tracks():
+    # SoundCloud Charts API
+    return await fetch_tracks(
+        f"{SOUNDCLOUD_API_URL}/charts",
+        {"kind": "top", "genre": "soundcloud:genres:all-music", "limit": 100},
+        nested="track"
+    )
+
+async def get_top_tracks():
+    """Топ треков из периодически обновляемого снимка"""
+    with metrics.search_seconds.time(kind="top"):
+        return await search_cache.get_or_fetch(TOP_CACHE_KEY, fetch_top_tracks, ttl=TOP_REFRESH_INTERVAL * 3)
+
+async def search_tracks(query):
+    """Поиск треков с кэшированием по нормализованному запросу"""
+    query = normalize_query(query)
+
+    async def fetch():
+        # Частые запросы отвечаются из локального индекса
+        if TRACK_INDEX_MIN_RESULTS:
+            tracks = await track_index.search(query, limit=100, complete=True)
+            if len(tracks) >= TRACK_INDEX_MIN_RESULTS:
+                return tracks
+
+        try:
+            return await fetch_tracks(
+                f"{SOUNDCLOUD_API_URL}/search/tracks",
+                {"q": query, "limit": 100}
+            )
+        except (SoundCloudError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # SoundCloud недоступен - отдаем то, что есть в индексе
+            tracks = await track_index.search(query, limit=100)
+            if not tracks:
+                raise
+            logger.warning(f"Поиск '{query}' выполнен по локальному индексу: {e}")
+            return tracks
+
+    with metrics.search_seconds.time(kind="search"):
+        return await search_cache.get_or_fetch(f"search:{query}", fetch)
+
+async def get_related_tracks(track_id):
+    """Похожие треки с кэшированием по ID трека"""
+    async def fetch():
+        return await fetch_tracks(
+            f"{SOUNDCLOUD_API_URL}/tracks/{track_id}/related",
+            {"limit": 100}
+        )
+
+    with metrics.search_seconds.time(kind="related"):
+        return await search_cache.get_or_fetch(f"related:{track_id}", fetch)
+
+async def get_playlist(url):
+    """Название и треки плейлиста или альбома SoundCloud по ссылке"""
+    async def fetch():
+        playlist = await soundcloud.get_json(f"{SOUNDCLOUD_API_URL}/resolve", {"url": url})
+        if playlist.get("kind") != "playlist":
+            return None, []
+        raw_tracks = playlist.get("tracks") or []
+        loaded = {track["id"]: TrackInfo.from_api(track) for track in raw_tracks if track.get("title")}
+        # Полные данные API отдает только для первых треков, у остальных есть лишь ID
+        missing = [track["id"] for track in raw_tracks if not track.get("title")]
+        for i in range(0, len(missing), PLAYLIST_TRACKS_CHUNK):
+            ids = ",".join(str(track_id) for track_id in missing[i:i + PLAYLIST_TRACKS_CHUNK])
+            for track in await soundcloud.get_json(f"{SOUNDCLOUD_API_URL}/tracks", {"ids": ids}, decode=decode_tracks):
+                loaded[track.id] = track
+        tracks = [loaded[track["id"]] for track in raw_tracks if track["id"] in loaded]
+        track_index.add(tracks)
+        return playlist.get("title") or "Плейлист", tracks
+
+    with metrics.search_seconds.time(kind="playlist"):
+        return await search_cache.get_or_fetch(f"playlist:{url}", fetch)
+
+async def refresh_top_loop():
+    """Фоновое обновление снимка /top, чтобы не запрашивать чарты на каждого пользователя"""
+    while True:
+        if soundcloud.configured:
+            try:
+                tracks = await fetch_top_tracks()
+                if tracks:
+                    search_cache.put(TOP_CACHE_KEY, tracks, ttl=TOP_REFRESH_INTERVAL * 3)
+            except Exception as e:
+                logger.error(f"Не удалось обновить топ треков: {e}")
+        await asyncio.sleep(TOP_REFRESH_INTERVAL)
+
 @dp.message(Command("top"))
 async def cmd_top(message: types.Message):
-    await cleanup_previous_search(message.from_user.id)
-    search_id = str(uuid.uuid4())  # Генерируем уникальный ID
+    search_id = new_search_id()  # Короткий ID для callback_data
     
     # Отправляем сообщение "Загружаю популярные треки..."
     search_message = await message.answer("🔍 Ищу популярные треки...")
     
     try:
-        async with aiohttp.ClientSession() as session:
-            client_id = os.getenv("SOUNDCLOUD_CLIENT_ID")
-            if not client_id:
-                await search_message.edit_text("⚠️ Ошибка: Отсутствует SoundCloud API ключ.")
-                return
-                
-            # SoundCloud Charts API
-            url = f"https://api-v2.soundcloud.com/charts?kind=top&genre=soundcloud:genres:all-music&limit=100&client_id={client_id}"
+        if not soundcloud.configured:
+            await search_message.edit_text("⚠️ Ошибка: Отсутствует SoundCloud API ключ.")
+            return
+        
+        try:
+            tracks = await get_top_tracks()
+        except SoundCloudError as e:
+            await search_message.edit_text(f"⚠️ Ошибка при загрузке топа: {e.status}")
+            return
+        
+        if not tracks:
+            await search_message.edit_text("😕 Не удалось загрузить топ треков")
+            return
+        
+        # Store results
+        results = SearchSession(
+            search_id=search_id,
+            tracks=tracks,
+            query="🔥 Топ треков",
+            message_id=search_message.message_id,
+            chat_id=search_message.chat.id,
+            user_id=message.from_user.id
+        )
+        await search_sessions.add(results)
+        
+        await show_tracks_page(results, 1)
+        prefetcher.schedule(results)
             
-            async with session.get(url) as response:
-                if response.status != 200:
-                    await search_message.edit_text(f"⚠️ Ошибка при загрузке топа: {response.status}")
-                    return
-                    
-                data = await response.json()
-                tracks = [item["track"] for item in data.get("collection", []) if "track" in item]
-                
-                if not tracks:
-                    await search_message.edit_text("😕 Не удалось загрузить топ треков")
-                    return
-                
-                # Store results
-                user_search_results[search_id] = {
-                    "tracks": tracks,
-                    "current_page": 1,
-                    "query": "🔥 Топ треков",
-                    "message_id": search_message.message_id,
-                    "chat_id": search_message.chat.id,
-                    "user_id": message.from_user.id
-                }
-                
-                await show_tracks_page(search_id, 1)
-                
     except Exception as e:
         logger.error(f"Ошибка при загрузке топа: {e}")
         await search_message.edit_text(f"⚠️ Произошла ошибка: {e}")
 
+@dp.message(Command("debug"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_debug(message: types.Message, command: CommandObject):
+    """Диагностика без перезапуска: /debug tasks - дамп задач asyncio, /debug profile [секунды] - профиль цикла событий"""
+    args = (command.args or "").split()
+    action = args[0] if args else ""
+
+    if action == "tasks":
+        report = dump_tasks()
+    elif action == "profile":
+        try:
+            seconds = float(args[1]) if len(args) > 1 else 10
+        except ValueError:
+            await message.answer("Использование: /debug profile [секунды]")
+            return
+        if loop_profiler.running:
+            await message.answer("Профилирование уже идет")
+            return
+        seconds = min(max(seconds, 1), loop_profiler.max_seconds)
+        await message.answer(f"⏱ Профилирую цикл событий {seconds:.0f} с...")
+        report = await loop_profiler.profile(seconds)
+    else:
+        await message.answer(
+            "/debug tasks - задачи asyncio и где они ждут\n"
+            "/debug profile [секунды] - сэмплирующий профиль цикла событий\n\n"
+            f"Логи: {sampler.stats()}\n"
+            f"Апдейты: {update_limiter.stats()}\n"
+            f"Загрузки: {download_scheduler.stats()}"
+        )
+        return
+
+    # Сводка - в подписи, полный отчет - файлом
+    await message.answer_document(
+        BufferedInputFile(report.encode(), filename=f"{action}-{int(time.time())}.txt"),
+        caption=report.split("\n\n", 1)[0][:1024]
+    )
+
+@dp.message(F.text.regexp(PLAYLIST_URL_RE, search=True).as_("match"))
+async def open_playlist(message: types.Message, match: re.Match):
+    search_id = new_search_id()
+    
+    search_message = await message.answer("🔍 Загружаю плейлист...")
+    
+    try:
+        if not soundcloud.configured:
+            await search_message.edit_text("⚠️ Ошибка: Отсутствует SoundCloud API ключ.")
+            return
+        
+        try:
+            title, tracks = await get_playlist(match.group(0))
+        except SoundCloudError as e:
+            await search_message.edit_text(f"⚠️ Ошибка при загрузке плейлиста: {e.status}")
+            return
+        
+        if not tracks:
+            await search_message.edit_text("😕 В плейлисте нет доступных треков")
+            return
+        
+        # Плейлист показывается как результаты поиска: по страницам и с загрузкой страницы целиком
+        results = SearchSession(
+            search_id=search_id,
+            tracks=tracks,
+            query=f"💿 {title}",
+            message_id=search_message.message_id,
+            chat_id=search_message.chat.id,
+            user_id=message.from_user.id
+        )
+        await search_sessions.add(results)
+        
+        await show_tracks_page(results, 1)
+        prefetcher.schedule(results)
+    
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке плейлиста: {e}")
+        await search_message.edit_text(f"⚠️ Произошла ошибка: {e}")
+
 @dp.message(F.text & ~F.command)
 async def search_track(message: types.Message):
-    await cleanup_previous_search(message.from_user.id)
-    search_id = str(uuid.uuid4())
+    search_id = new_search_id()
     
     query = message.text.strip()
     if not query:
@@ -120,127 +396,61 @@ async def search_track(message: types.Message):
     search_message = await message.answer(f"🔍 Ищу '{query}'...")
     
     try:
-        async with aiohttp.ClientSession() as session:
-            # SoundCloud API client ID (you'll need to get your own)
-            client_id = os.getenv("SOUNDCLOUD_CLIENT_ID")
-            if not client_id:
-                await search_message.edit_text("⚠️ Ошибка: Отсутствует SoundCloud API ключ.")
-                return
-                
-            # Search tracks via SoundCloud API
-            url = f"https://api-v2.soundcloud.com/search/tracks?q={query}&client_id={client_id}&limit=100"
+        if not soundcloud.configured:
+            await search_message.edit_text("⚠️ Ошибка: Отсутствует SoundCloud API ключ.")
+            return
+        
+        # Search tracks via SoundCloud API (одинаковые запросы берутся из кэша)
+        try:
+            tracks = await search_tracks(query)
+        except SoundCloudError as e:
+            await search_message.edit_text(f"⚠️ Ошибка при поиске: {e.status}")
+            return
+        
+        if not tracks:
+            await search_message.edit_text("😕 Ничего не найдено. Попробуйте другой запрос.")
+            return
+        
+        # Store results for this user
+        results = SearchSession(
+            search_id=search_id,
+            tracks=tracks,
+            query=query,
+            message_id=search_message.message_id,
+            chat_id=search_message.chat.id,
+            user_id=message.from_user.id
+        )
+        await search_sessions.add(results)
+        
+        # Show first page of results (в том же сообщении)
+        await show_tracks_page(results, 1)
+        prefetcher.schedule(results)
             
-            async with session.get(url) as response:
-                if response.status != 200:
-                    await search_message.edit_text(f"⚠️ Ошибка при поиске: {response.status}")
-                    return
-                    
-                data = await response.json()
-                tracks = data.get("collection", [])
-                
-                if not tracks:
-                    await search_message.edit_text("😕 Ничего не найдено. Попробуйте другой запрос.")
-                    return
-                
-                # Store results for this user
-                user_search_results[search_id] = {
-                    "tracks": tracks,
-                    "current_page": 1,
-                    "query": query,
-                    "message_id": search_message.message_id,
-                    "chat_id": search_message.chat.id,
-                    "user_id": message.from_user.id
-                }
-                
-                # Show first page of results (в том же сообщении)
-                await show_tracks_page(search_id, 1)
-                
     except Exception as e:
         logger.error(f"Ошибка при поиске треков: {e}")
         await search_message.edit_text(f"⚠️ Произошла ошибка при поиске: {e}")
 
-async def show_tracks_page(search_id, page):
-    if search_id not in user_search_results:
-        return
-        
-    results = user_search_results[search_id]
-    tracks = results["tracks"]
-    query = results["query"]
-    chat_id = results["chat_id"]
-    message_id = results["message_id"]
-    
-    results["current_page"] = page
+async def show_tracks_page(results, page):
+    # Страницы отрисовываются один раз на весь поиск
+    rendered = page_cache.get(results)
+    page = max(1, min(page, len(rendered.pages)))
     
-    tracks_per_page = 10
-    start_idx = (page - 1) * tracks_per_page
-    end_idx = min(start_idx + tracks_per_page, len(tracks))
+    if results.current_page != page:
+        results.current_page = page
+        await search_sessions.save(results)
     
-    total_pages = (len(tracks) + tracks_per_page - 1) // tracks_per_page
-    
-    # Формируем заголовок без приписки "Поиск:" для похожих треков
-    if query.startswith("Похожие на") or query == "🔥 Топ треков":
-        message_text = f"<b>{query}</b>\n\n"
-    else:
-        message_text = f"🎵 <b>Поиск:</b> {query}\n\n"
-    
-    for i in range(start_idx, end_idx):
-        track = tracks[i]
-        track_number = i - start_idx + 1
-        title = track.get("title", "Без названия").replace("<", "&lt;").replace(">", "&gt;")
-        artist = track.get("user", {}).get("username", "Неизвестный").replace("<", "&lt;").replace(">", "&gt;")
-        duration_ms = track.get("duration", 0)
-        duration_sec = duration_ms // 1000
-        minutes = duration_sec // 60
-        seconds = duration_sec % 60
-        
-        message_text += f"{track_number}. <b>{artist}</b> - {title} [{minutes}:{seconds:02d}]\n"
+    await show_rendered_page(rendered, results.chat_id, results.message_id, page)
+
+async def show_rendered_page(rendered, chat_id, message_id, page):
+    """Показывает отрисованную страницу в сообщении с результатами"""
+    page = max(1, min(page, len(rendered.pages)))
     
-    # Create inline keyboard
-    builder = InlineKeyboardBuilder()
+    # Сообщение уже показывает эту страницу - лишний запрос к Telegram не нужен
+    if rendered.shown_page == page:
+        page_cache.skipped_edits += 1
+        return
     
-    # Track selection buttons (1-10) в один ряд по 5 кнопок
-    current_row = []
-    for i in range(start_idx, end_idx):
-        track_number = i - start_idx + 1  # Номер в текущей странице (1-10)
-        current_row.append(types.InlineKeyboardButton(
-            text=str(track_number),
-            callback_data=f"track_{search_id}_{i}"
-        ))
-        
-        # Create a new row after every 5 buttons
-        if len(current_row) == 5:
-            builder.row(*current_row)
-            current_row = []
-    
-    # Add any remaining buttons
-    if current_row:
-        builder.row(*current_row)
-    
-    # Navigation buttons с нумерацией страниц
-    nav_buttons = []
-    
-    # Previous page button
-    if page > 1:
-        nav_buttons.append(types.InlineKeyboardButton(
-            text="⬅️",
-            callback_data=f"page_{search_id}_{page-1}"
-        ))
-    
-    # Page number indicator
-    nav_buttons.append(types.InlineKeyboardButton(
-        text=f"📄 {page}/{total_pages}",
-        callback_data=f"noop"  # Эта кнопка ничего не делает
-    ))
-    
-    # Next page button
-    if page < total_pages:
-        nav_buttons.append(types.InlineKeyboardButton(
-            text="➡️",
-            callback_data=f"page_{search_id}_{page+1}"
-        ))
-    
-    if nav_buttons:
-        builder.row(*nav_buttons)
+    message_text, reply_markup = rendered.pages[page - 1]
     
     # Редактируем существующее сообщение вместо отправки нового
     try:
@@ -248,382 +458,842 @@ async def show_tracks_page(search_id, page):
             chat_id=chat_id,
             message_id=message_id,
             text=message_text,
-            reply_markup=builder.as_markup(),
+            reply_markup=reply_markup,
             parse_mode=ParseMode.HTML
         )
+        rendered.shown_page = page
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e):
+            rendered.shown_page = page
+        else:
+            logger.error(f"Ошибка при редактировании сообщения: {e}")
     except Exception as e:
         logger.error(f"Ошибка при редактировании сообщения: {e}")
 
-async def get_track_stream_url(track_id, client_id):
+async def get_track_stream_url(track_id):
     """Получает прямую ссылку на аудиофайл трека"""
     try:
-        async with aiohttp.ClientSession() as session:
-            # Попытка 1: Progressive download через веб-API (предпочтительный метод)
-            track_url = f"https://api-v2.soundcloud.com/tracks/{track_id}?client_id={client_id}"
-            logger.info(f"Пробуем веб API: {track_url}")
-            
-            async with session.get(track_url) as response:
-                if response.status == 200:
-                    track_data = await response.json()
-                    logger.info("Информация о треке получена успешно")
-                    
-                    # Проверяем media transcoding
-                    if "media" in track_data and "transcodings" in track_data["media"]:
-                        transcodings = track_data["media"]["transcodings"]
-                        logger.info(f"Найдено {len(transcodings)} вариантов кодировки")
-                        
-                        # Сначала ищем progressive формат
-                        for t in transcodings:
-                            protocol = t.get("format", {}).get("protocol")
-                            mime_type = t.get("format", {}).get("mime_type")
-                            
-                            if protocol == 'progressive':
-                                logger.info(f"Найден progressive формат: {mime_type}")
-                                stream_url = t.get("url")
-                                if stream_url:
-                                    async with session.get(f"{stream_url}?client_id={client_id}") as stream_response:
-                                        if stream_response.status == 200:
-                                            stream_data = await stream_response.json()
-                                            return stream_data.get("url")
-                        
-                        # Если progressive не найден, пробуем HLS
-                        for t in transcodings:
-                            protocol = t.get("format", {}).get("protocol")
-                            mime_type = t.get("format", {}).get("mime_type")
-                            
-                            if protocol in ['hls', 'hls_secure']:
-                                logger.info(f"Найден HLS формат: {mime_type}")
-                                stream_url = t.get("url")
-                                if stream_url:
-                                    async with session.get(f"{stream_url}?client_id={client_id}") as stream_response:
-                                        if stream_response.status == 200:
-                                            stream_data = await stream_response.json()
-                                            return stream_data.get("url")
-
-            # Попытка 2: Мобильный API как запасной вариант
-            mobile_url = f"https://api-mobi.soundcloud.com/tracks/{track_id}?client_id={client_id}"
-            logger.info(f"Пробуем мобильный API: {mobile_url}")
-            
-            async with session.get(mobile_url) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    stream_url = data.get('stream_url')
-                    if stream_url:
-                        full_url = f"{stream_url}?client_id={client_id}"
-                        async with session.get(full_url, allow_redirects=True) as audio_response:
-                            if audio_response.status == 200:
-                                return str(audio_response.url)
-
+        stream_url = await stream_resolver.resolve(track_id)
+        if stream_url:
+            return stream_url
     except Exception as e:
         logger.error(f"Ошибка при получении URL потока: {e}")
     
     logger.error("Все попытки получить URL потока не удались")
     return None
 
+async def warm_track(track):
+    """Загружает популярный трек в служебный чат, чтобы получить file_id заранее"""
+    message = await upload_track(track, int(os.getenv("PREFETCH_CHAT_ID")))
+    await bot.delete_message(chat_id=message.chat.id, message_id=message.message_id)
+
+# Предзагрузка треков, которые вероятно выберут следующими
+prefetcher = Prefetcher(download_scheduler, get_track_stream_url, file_cache.peek, warm=warm_track)
+metrics.Gauge("hx_prefetch_hits", "Выборы треков, подготовленных предзагрузкой", fn=lambda: prefetcher.hits)
+metrics.Gauge(
+    "hx_prefetch_misses", "Выборы треков без предзагрузки",
+    fn=lambda: prefetcher.selections - prefetcher.hits
+)
+
+def forget_search(search_id):
+    """Сессия удалена или вытеснена: предзагрузка и отрисованные страницы больше не нужны"""
+    prefetcher.cancel(search_id)
+    page_cache.forget(search_id)
+
+search_sessions.on_evict = forget_search
+
+def create_download_file():
+    """Создает временный файл для загружаемого трека"""
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    return tempfile.NamedTemporaryFile(dir=DOWNLOAD_DIR, suffix=".mp3", delete=False)
+
+def remove_file(path):
+    """Удаляет временный файл, если он существует"""
+    if not path:
+        return
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"Не удалось удалить временный файл {path}: {e}")
+
 async def download_audio(url):
-    """Скачивает аудио по URL"""
+    """Скачивает аудио по URL во временный файл и возвращает путь к нему"""
+    audio_file = None
+    protocol = "hls" if '.m3u8' in url else "progressive"
+    started = time.monotonic()
     try:
-        timeout = aiohttp.ClientTimeout(total=300)  # 5 минут таймаут
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            logger.info(f"Начинаю загрузку аудио с URL: {url}")
-            
-            # Проверяем, является ли URL HLS плейлистом
-            if '.m3u8' in url:
-                logger.info("Обнаружен HLS поток, загружаю плейлист")
-                async with session.get(url) as response:
-                    if response.status != 200:
-                        logger.error(f"Не удалось получить HLS плейлист. Статус: {response.status}")
-                        return None
-                        
-                    playlist = await response.text()
-                    segments = []
-                    total_size = 0
-                    
-                    # Собираем все сегменты из плейлиста
-                    for line in playlist.split('\n'):
-                        if line.startswith('http') and ('.mp3' in line or '.aac' in line or '.ts' in line):
-                            segments.append(line)
-                    
-                    if not segments:
-                        logger.error("Не найдены аудио сегменты в HLS плейлисте")
-                        return None
-                    
-                    logger.info(f"Найдено {len(segments)} сегментов для загрузки")
-                    all_data = bytearray()
-                    
-                    # Скачиваем все сегменты
-                    for i, segment_url in enumerate(segments, 1):
-                        logger.info(f"Загрузка сегмента {i}/{len(segments)}")
-                        try:
-                            async with session.get(segment_url) as segment_response:
-                                if segment_response.status == 200:
-                                    segment_data = await segment_response.read()
-                                    all_data.extend(segment_data)
-                                    total_size += len(segment_data)
-                                    logger.info(f"Сегмент {i} загружен: {len(segment_data)} байт")
-                                else:
-                                    logger.error(f"Не удалось загрузить сегмент {i}. Статус: {segment_response.status}")
-                        except Exception as e:
-                            logger.error(f"Ошибка при загрузке сегмента {i}: {e}")
-                            continue
+        session = http.session
+        sampled_logger.debug(f"Начинаю загрузку аудио: {redact_url(url)}")
+        
+        # Проверяем, является ли URL HLS плейлистом
+        if protocol == "hls":
+            async with session.get(url, timeout=PLAYLIST_TIMEOUT) as response:
+                if response.status != 200:
+                    logger.error(f"Не удалось получить HLS плейлист. Статус: {response.status}")
+                    return None
                     
-                    if total_size < 100 * 1024:  # Меньше 100 KB
-                        logger.error(f"Общий размер загрузки слишком мал: {total_size} байт")
-                        return None
-                        
-                    logger.info(f"Успешно загружены все сегменты. Общий размер: {total_size / (1024*1024):.2f} МБ")
-                    return bytes(all_data)
+                playlist = await response.text()
             
-            # Для обычных URL (не HLS)
-            logger.info(f"Загрузка аудио с: {url}")
-            async with session.get(url) as response:
-                if response.status == 200:
-                    # Проверяем размер файла
-                    content_length = response.headers.get('Content-Length')
-                    if content_length:
-                        size_mb = int(content_length) / (1024 * 1024)
-                        logger.info(f"Ожидаемый размер файла: {size_mb:.2f} МБ")
-                        if size_mb < 0.1:  # Меньше 100 KB
-                            logger.error("Размер файла слишком мал")
-                            return None
-                    
-                    data = await response.read()
-                    file_size = len(data) / (1024 * 1024)
-                    logger.info(f"Загрузка завершена. Размер файла: {file_size:.2f} МБ")
-                    
-                    if len(data) < 100 * 1024:  # Меньше 100 KB
-                        logger.error("Загруженный файл слишком мал")
+            # Собираем все сегменты из плейлиста
+            segments = parse_playlist(playlist, url)
+            
+            if not segments:
+                logger.error("Не найдены аудио сегменты в HLS плейлисте")
+                return None
+            
+            sampled_logger.debug(f"Найдено {len(segments)} сегментов для загрузки")
+            audio_file = create_download_file()
+            total_size = 0
+            
+            # Скачиваем сегменты параллельно и сразу пишем их в файл по порядку
+            try:
+                async for segment_data in iter_segments(session, segments, SEGMENT_TIMEOUT):
+                    total_size += len(segment_data)
+                    if total_size > MAX_AUDIO_SIZE:
+                        logger.error(f"Размер HLS потока превышает {MAX_AUDIO_SIZE // (1024*1024)} МБ")
                         return None
-                        
-                    return data
-                else:
-                    logger.error(f"Не удалось загрузить аудио. Статус: {response.status}")
+                    audio_file.write(segment_data)
+            except SegmentError as e:
+                # Пропуск сегмента испортил бы аудио, поэтому загрузка считается неудачной
+                logger.error(f"{e}, загрузка прервана")
+                return None
+            
+            if total_size < MIN_AUDIO_SIZE:
+                logger.error(f"Общий размер загрузки слишком мал: {total_size} байт")
+                return None
+                
+            sampled_logger.info(f"Успешно загружены все сегменты. Общий размер: {total_size / (1024*1024):.2f} МБ")
+            metrics.download_seconds.observe(time.monotonic() - started, protocol=protocol)
+            metrics.download_bytes.observe(total_size, protocol=protocol)
+            audio_file.close()
+            path = audio_file.name
+            audio_file = None
+            return path
+        
+        # Для обычных URL (не HLS): частями по Range с докачкой, если сервер это поддерживает
+        audio_file = create_download_file()
+        try:
+            total_size = await download_file(session, url, audio_file, MAX_AUDIO_SIZE, DOWNLOAD_TIMEOUT, DOWNLOAD_CHUNK_SIZE)
+        except DownloadError as e:
+            logger.error(f"Не удалось загрузить аудио: {e}")
+            return None
+        
+        sampled_logger.info(f"Загрузка завершена. Размер файла: {total_size / (1024 * 1024):.2f} МБ")
+        
+        if total_size < MIN_AUDIO_SIZE:
+            logger.error("Загруженный файл слишком мал")
+            return None
+        
+        metrics.download_seconds.observe(time.monotonic() - started, protocol=protocol)
+        metrics.download_bytes.observe(total_size, protocol=protocol)
+        audio_file.close()
+        path = audio_file.name
+        audio_file = None
+        return path
     except Exception as e:
         logger.error(f"Ошибка при загрузке аудио: {e}")
+    finally:
+        # Файл остается открытым только если загрузка не удалась
+        if audio_file is not None:
+            audio_file.close()
+            remove_file(audio_file.name)
     return None
 
-@dp.callback_query(F.data.startswith("track_"))
-async def process_track_selection(callback: types.CallbackQuery):
-    parts = callback.data.split("_")
-    search_id = parts[1]
-    track_idx = int(parts[2])
+async def send_cached_audio(message, track_id, file_id, caption, reply_markup):
+    """Отправляет трек по сохраненному file_id. Возвращает True при успехе"""
+    try:
+        await message.answer_audio(
+            audio=file_id,
+            caption=caption,
+            reply_markup=reply_markup,
+            parse_mode=ParseMode.HTML
+        )
+        return True
+    except TelegramBadRequest as e:
+        # Telegram отклонил устаревший file_id - загружаем трек заново
+        logger.warning(f"Telegram отклонил file_id трека {track_id}: {e}")
+        file_cache.invalidate(track_id)
+        return False
+
+# Фоновые правки статуса: ссылки держатся до завершения задачи
+status_tasks = set()
+
+def show_status(chat_id, message_id, text):
+    """Меняет текст сообщения на статус загрузки, не дожидаясь отправки
+
+    Правки идут в исходящей очереди с низшим приоритетом, и при нагрузке
+    ожидание такой правки задерживало бы загрузку и держало место воркера.
+    """
+    async def edit():
+        try:
+            await bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=message_id,
+                text=text,
+                reply_markup=None,
+                parse_mode=ParseMode.HTML
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось показать статус загрузки в чате {chat_id}: {e}")
+
+    task = asyncio.create_task(edit())
+    status_tasks.add(task)
+    task.add_done_callback(status_tasks.discard)
+
+async def answer_alert(callback, text):
+    """Показывает пользователю уведомление об ошибке, если запрос еще не устарел"""
+    try:
+        await callback.answer(text, show_alert=True)
+    except TelegramBadRequest as e:
+        logger.warning(f"Не удалось показать уведомление: {e}")
+
+def similar_keyboard(track_id):
+    """Клавиатура с кнопкой "Найти похожие" под отправленным треком"""
+    builder = InlineKeyboardBuilder()
+    builder.row(
+        types.InlineKeyboardButton(
+            text="🔍 Найти похожие",
+            callback_data=SimilarCallback(track_id=track_id).pack()
+        )
+    )
+    return builder.as_markup()
+
+TRACK_CAPTION = f"👉 <a href='https://t.me/hxmusic_robot'>Ищи свои любимые треки в боте</a> 👈"
+
+@dp.callback_query(TrackCallback.filter())
+async def process_track_selection(callback: types.CallbackQuery, callback_data: TrackCallback):
+    started = time.monotonic()
+    track_id = callback_data.track_id
+    track_idx = callback_data.index
     
-    if search_id not in user_search_results:
-        await callback.answer("Результаты поиска устарели", show_alert=True)
+    # В личном чате кнопки нажимает только автор поиска, а ID трека есть в callback_data:
+    # трек из кэша file_id отправляется без обращения к поисковой сессии
+    answered = False
+    private = callback.message and callback.message.chat.type == "private"
+    file_id = file_cache.get(track_id) if private else None
+    if file_id:
+        await callback.answer("Загружаю трек...")
+        answered = True
+        if await send_cached_audio(callback.message, track_id, file_id, TRACK_CAPTION, similar_keyboard(track_id)):
+            sampled_logger.info(f"Трек {track_id} отправлен из кэша file_id")
+            prefetcher.record_selection(track_id)
+            track_index.record_selection(track_id)
+            metrics.selection_seconds.observe(time.monotonic() - started, source="file_id")
+            await bot.delete_message(chat_id=callback.message.chat.id, message_id=callback.message.message_id)
+            return
+    
+    results = await search_sessions.get(callback_data.search_id)
+    if results is None:
+        await answer_alert(callback, "Результаты поиска устарели")
         return
-        
-    results = user_search_results[search_id]
     
-    if results["user_id"] != callback.from_user.id:
-        await callback.answer("Это не ваш поиск!", show_alert=True)
+    if results.user_id != callback.from_user.id:
+        await answer_alert(callback, "Это не ваш поиск!")
         return
         
-    tracks = results["tracks"]
-    query = results["query"]
-    chat_id = results["chat_id"]
-    message_id = results["message_id"]
+    tracks = results.tracks
+    chat_id = results.chat_id
+    message_id = results.message_id
+    
+    if track_idx >= len(tracks) or tracks[track_idx].id != track_id:
+        await answer_alert(callback, "Трек не найден.")
+        return
+    
+    selected_track = tracks[track_idx]
+    # Страница, на которой выбран трек: на нее возвращаемся при ошибке загрузки
+    page = track_idx // TRACKS_PER_PAGE + 1
+    prefetcher.record_selection(track_id)
+    track_index.record_selection(track_id)
+    caption = TRACK_CAPTION
+    reply_markup = similar_keyboard(track_id)
+    
+    # Трек уже загружался в Telegram - отправляем по file_id без скачивания и очереди
+    file_id = None if private else file_cache.get(track_id)
+    if file_id:
+        await callback.answer("Загружаю трек...")
+        answered = True
+        if await send_cached_audio(callback.message, track_id, file_id, caption, reply_markup):
+            sampled_logger.info(f"Трек {track_id} отправлен из кэша file_id")
+            metrics.selection_seconds.observe(time.monotonic() - started, source="file_id")
+            await bot.delete_message(chat_id=chat_id, message_id=message_id)
+            return
     
-    if track_idx >= len(tracks):
-        await callback.answer("Трек не найден.", show_alert=True)
+    async def show_queue_position(position):
+        page_cache.forget_shown(results.search_id)
+        await bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=message_id,
+            text=f"🕒 <b>Трек в очереди на загрузку:</b> {position}",
+            reply_markup=None,
+            parse_mode=ParseMode.HTML
+        )
+    
+    # Загрузка выполняется в пуле планировщика, обработчик апдейта не ждет ее завершения
+    try:
+        download_scheduler.submit(
+            callback.from_user.id,
+            track_id,
+            lambda: deliver_track(callback, results, selected_track, caption, reply_markup, started, page),
+            on_position=show_queue_position
+        )
+    except AlreadyQueued:
+        await answer_alert(callback, "Этот трек уже загружается")
+        return
+    except QuotaExceeded:
+        await answer_alert(callback, "⏳ Дождитесь завершения текущих загрузок")
         return
     
     # Уведомление о скачивании в inline режиме
-    await callback.answer("Загружаю трек...")
+    if not answered:
+        await callback.answer("Загружаю трек...")
+
+class TrackUnavailable(Exception):
+    """Не удалось получить или скачать аудио трека"""
+
+async def download_track(track):
+    """Получает ссылку на поток и скачивает трек во временный файл. Возвращает путь к файлу"""
+    if not soundcloud.configured:
+        logger.error("Не найден SoundCloud client ID")
+        raise ValueError("Отсутствует SoundCloud client ID")
     
-    # Редактируем сообщение с результатами, добавляя информацию о загрузке
-    selected_track = tracks[track_idx]
-    track_title = selected_track.get("title", "Без названия")
-    artist = selected_track.get("user", {}).get("username", "Неизвестный исполнитель")
+    stream_url = await get_track_stream_url(track.id)
+    if not stream_url:
+        logger.error("Не удалось получить URL потока")
+        metrics.errors_total.inc(stage="resolve")
+        raise TrackUnavailable("❌ Не удалось получить ссылку на аудио")
     
-    # Сохраняем текущую страницу
-    current_page = results["current_page"]
+    # Скачиваем аудио во временный файл
+    audio_path = await download_audio(stream_url)
+    if not audio_path:
+        logger.error("Не удалось загрузить аудио данные")
+        metrics.errors_total.inc(stage="download")
+        raise TrackUnavailable("❌ Не удалось скачать аудио")
+    return audio_path
+
+async def prepare_audio(track, artwork_task):
+    """Файл трека для отправки. Возвращает (путь, временный файл для удаления или None)
+
+    Обработанный ранее файл берется из кэша постобработки, иначе трек
+    скачивается и обрабатывается; если обработка недоступна или не удалась,
+    отправляется скачанный файл как есть. Один и тот же трек (например, в
+    пакете и в одиночном выборе) готовится по очереди: второй вызов берет
+    результат первого из кэша постобработки.
+    """
+    entry = track_locks.setdefault(track.id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            return await prepare_audio_locked(track, artwork_task)
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del track_locks[track.id]
+
+async def prepare_audio_locked(track, artwork_task):
+    processed_path = await postprocessor.get(track.id)
+    if processed_path:
+        return processed_path, None
     
-    # Обновляем сообщение статусом загрузки
-    await bot.edit_message_text(
-        chat_id=chat_id,
-        message_id=message_id,
-        text=f"⏳ <b>Загрузка трека:</b>\n<i>{artist} - {track_title}</i>...",
-        reply_markup=None,
-        parse_mode=ParseMode.HTML
-    )
-        
+    async with download_slots:
+        audio_path = await download_track(track)
     try:
-        track_id = selected_track.get("id")
-        artwork_url = selected_track.get("artwork_url", "")
-        permalink_url = selected_track.get("permalink_url", "")
-        
-        logger.info(f"Обработка трека: {track_title} от {artist} (ID: {track_id})")
-        
-        # Если есть artwork_url, получаем версию большего размера
-        if artwork_url:
-            artwork_url = artwork_url.replace("-large", "-t500x500")
-        
-        # Получаем ссылку на аудиопоток
-        client_id = os.getenv("SOUNDCLOUD_CLIENT_ID")
-        if not client_id:
-            logger.error("Не найден SoundCloud client ID")
-            raise ValueError("Отсутствует SoundCloud client ID")
-            
-        stream_url = await get_track_stream_url(track_id, client_id)
-        
-        if not stream_url:
-            logger.error("Не удалось получить URL потока")
-            # Восстанавливаем поисковые результаты при ошибке
-            await show_tracks_page(search_id, current_page)
-            await callback.answer("❌ Не удалось получить ссылку на аудио", show_alert=True)
-            return
-        
-        # Скачиваем аудио
-        audio_data = await download_audio(stream_url)
-        
-        if not audio_data:
-            logger.error("Не удалось загрузить аудио данные")
-            # Восстанавливаем поисковые результаты при ошибке
-            await show_tracks_page(search_id, current_page)
-            await callback.answer("❌ Не удалось скачать аудио", show_alert=True)
-            return
+        processed_path = await postprocessor.process(track, audio_path, await artwork_task)
+    except BaseException:
+        remove_file(audio_path)
+        raise
+    if processed_path:
+        remove_file(audio_path)
+        return processed_path, None
+    return audio_path, audio_path
+
+def audio_filename(track_title, path):
+    extension = os.path.splitext(path)[1]
+    return f"{track_title}{extension if extension in AUDIO_EXTENSIONS else '.mp3'}"
+
+async def upload_track(track, chat_id, caption=None, reply_markup=None):
+    """Скачивает трек, отправляет его в чат и запоминает file_id. Возвращает отправленное сообщение"""
+    track_id = track.id
+    track_title = track.title or "Без названия"
+    artist = track.artist or "Неизвестный исполнитель"
+    
+    audio_path = None
+    # Обложка загружается параллельно с аудио
+    artwork_task = asyncio.create_task(artwork_cache.get(track.artwork_url))
+    try:
+        sampled_logger.info(f"Обработка трека: {track_title} от {artist} (ID: {track_id})")
+        upload_path, audio_path = await prepare_audio(track, artwork_task)
         
-        logger.info("Создание аудио файла для отправки")
-        # Создаем BufferedInputFile для отправки аудио
-        audio_file = BufferedInputFile(
-            audio_data,
-            filename=f"{track_title}.mp3"
+        sampled_logger.debug("Создание аудио файла для отправки")
+        # FSInputFile отправляет файл с диска частями
+        audio_file = FSInputFile(
+            upload_path,
+            filename=audio_filename(track_title, upload_path)
         )
         
-        # Отправляем аудио сообщение с метаданными
-        caption = (f"👉 <a href='https://t.me/hxmusic_robot'>Ищи свои любимые треки в боте</a> 👈")
-        
-        # Если есть обложка, скачиваем и ее
+        # Миниатюра обложки из кэша; если не получилось, отправляем без нее
         thumbnail = None
-        if artwork_url:
-            try:
-                logger.info("Загрузка обложки")
-                # Пробуем скачать обложку
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(artwork_url) as response:
-                        if response.status == 200:
-                            thumbnail_data = await response.read()
-                            thumbnail = BufferedInputFile(
-                                thumbnail_data,
-                                filename="thumbnail.jpg"
-                            )
-                            logger.info("Обложка успешно загружена")
-            except Exception as e:
-                logger.error(f"Не удалось загрузить обложку: {e}")
-                # Если не получилось скачать обложку, продолжаем без нее
-                pass
-        
-        # Создаем клавиатуру для кнопки "Найти похожие"
-        builder = InlineKeyboardBuilder()
-        builder.row(
-            types.InlineKeyboardButton(
-                text="🔍 Найти похожие",
-                callback_data=f"similar_{track_id}"
+        thumbnail_data = await artwork_task
+        if thumbnail_data:
+            thumbnail = BufferedInputFile(
+                thumbnail_data,
+                filename="thumbnail.jpg"
             )
-        )
         
-        logger.info("Отправка аудио сообщения")
+        sampled_logger.debug("Отправка аудио сообщения")
         # Отправляем файл с метаданными
-        await callback.message.answer_audio(
-            audio=audio_file,
-            caption=caption,
-            title=f"{track_title} | tg: hxmusic_robot",
-            performer=artist,
-            thumbnail=thumbnail,
-            reply_markup=builder.as_markup(),
-            parse_mode=ParseMode.HTML
-        )
+        try:
+            with metrics.upload_seconds.time():
+                sent_message = await bot.send_audio(
+                    chat_id=chat_id,
+                    audio=audio_file,
+                    caption=caption,
+                    title=f"{track_title} | tg: hxmusic_robot",
+                    performer=artist,
+                    thumbnail=thumbnail,
+                    reply_markup=reply_markup,
+                    parse_mode=ParseMode.HTML
+                )
+        except Exception:
+            metrics.errors_total.inc(stage="upload")
+            raise
         
-        logger.info("Аудио успешно отправлено")
+        sampled_logger.info(f"Трек {track_id} отправлен в Telegram")
+        # Запоминаем file_id, чтобы повторно отправлять трек без загрузки
+        if sent_message.audio:
+            file_cache.set(track_id, sent_message.audio.file_id, sent_message.audio.file_unique_id)
+        return sent_message
+    finally:
+        artwork_task.cancel()
+        remove_file(audio_path)
+
+async def deliver_track(callback, results, selected_track, caption, reply_markup, started, current_page):
+    """Скачивает трек и отправляет его пользователю. Возвращает True при успехе"""
+    chat_id = results.chat_id
+    message_id = results.message_id
+    track_id = selected_track.id
+    track_title = selected_track.title or "Без названия"
+    artist = selected_track.artist or "Неизвестный исполнитель"
+    
+    # Пока трек ждал в очереди, его мог загрузить другой пользователь
+    file_id = file_cache.peek(track_id)
+    if file_id and await send_cached_audio(callback.message, track_id, file_id, caption, reply_markup):
+        sampled_logger.info(f"Трек {track_id} отправлен из кэша file_id")
+        metrics.selection_seconds.observe(time.monotonic() - started, source="file_id")
+        await bot.delete_message(chat_id=chat_id, message_id=message_id)
+        return True
+    
+    # Обновляем сообщение статусом загрузки
+    page_cache.forget_shown(results.search_id)
+    show_status(chat_id, message_id, f"⏳ <b>Загрузка трека:</b>\n<i>{artist} - {track_title}</i>...")
+    
+    try:
+        await upload_track(selected_track, callback.message.chat.id, caption, reply_markup)
+        metrics.selection_seconds.observe(time.monotonic() - started, source="download")
         # Удаляем сообщение с результатами поиска
         await bot.delete_message(chat_id=chat_id, message_id=message_id)
-        
+        return True
+    
+    except TrackUnavailable as e:
+        # Восстанавливаем поисковые результаты при ошибке
+        await show_tracks_page(results, current_page)
+        await answer_alert(callback, str(e))
+        return False
     except Exception as e:
         logger.error(f"Ошибка при загрузке трека: {str(e)}")
         # Восстанавливаем поисковые результаты при ошибке
-        await show_tracks_page(search_id, current_page)
-        await callback.answer(f"❌ Ошибка при загрузке трека", show_alert=True)
+        await show_tracks_page(results, current_page)
+        await answer_alert(callback, "❌ Ошибка при загрузке трека")
+        return False
+
+class BatchItem:
+    """Трек пакетной загрузки: file_id из кэша или скачанный файл"""
+
+    __slots__ = ("track", "file_id", "path", "temp_path", "thumbnail")
+
+    def __init__(self, track, file_id=None, path=None, temp_path=None, thumbnail=None):
+        self.track = track
+        self.file_id = file_id
+        self.path = path
+        # Скачанный файл без постобработки - удаляется после отправки
+        self.temp_path = temp_path
+        self.thumbnail = thumbnail
+
+    def media(self, caption=None):
+        if self.file_id:
+            return types.InputMediaAudio(media=self.file_id, caption=caption, parse_mode=ParseMode.HTML)
+        track_title = self.track.title or "Без названия"
+        thumbnail = None
+        if self.thumbnail:
+            thumbnail = BufferedInputFile(self.thumbnail, filename="thumbnail.jpg")
+        return types.InputMediaAudio(
+            media=FSInputFile(self.path, filename=audio_filename(track_title, self.path)),
+            title=f"{track_title} | tg: hxmusic_robot",
+            performer=self.track.artist or "Неизвестный исполнитель",
+            thumbnail=thumbnail,
+            caption=caption,
+            parse_mode=ParseMode.HTML
+        )
+
+    def remember(self, message):
+        """Запоминает file_id трека, загруженного в Telegram"""
+        if not self.file_id and message.audio:
+            file_cache.set(self.track.id, message.audio.file_id, message.audio.file_unique_id)
+
+async def prepare_batch_item(track, semaphore):
+    file_id = file_cache.get(track.id)
+    if file_id:
+        return BatchItem(track, file_id=file_id)
+    
+    async with semaphore:
+        artwork_task = asyncio.create_task(artwork_cache.get(track.artwork_url))
+        try:
+            path, temp_path = await prepare_audio(track, artwork_task)
+            return BatchItem(track, path=path, temp_path=temp_path, thumbnail=await artwork_task)
+        finally:
+            artwork_task.cancel()
+
+async def send_batch_item(item, chat_id):
+    """Отправляет трек пакета отдельным сообщением. Возвращает True при успехе"""
+    media = item.media()
+    try:
+        message = await bot.send_audio(
+            chat_id=chat_id,
+            audio=media.media,
+            caption=TRACK_CAPTION,
+            title=media.title,
+            performer=media.performer,
+            thumbnail=media.thumbnail,
+            reply_markup=similar_keyboard(item.track.id),
+            parse_mode=ParseMode.HTML
+        )
+    except TelegramBadRequest as e:
+        logger.warning(f"Не удалось отправить трек {item.track.id}: {e}")
+        metrics.errors_total.inc(stage="upload")
+        if item.file_id:
+            file_cache.invalidate(item.track.id)
+        return False
+    item.remember(message)
+    return True
+
+async def send_media_group(items, chat_id):
+    """Отправляет треки одним альбомом. Возвращает число отправленных треков"""
+    if len(items) < 2:
+        return sum([await send_batch_item(item, chat_id) for item in items])
+    
+    # Подпись - только под последним треком альбома
+    media = [item.media() for item in items[:-1]] + [items[-1].media(TRACK_CAPTION)]
+    try:
+        messages = await bot.send_media_group(chat_id=chat_id, media=media)
+    except TelegramBadRequest as e:
+        # Один устаревший file_id отклоняет весь альбом - отправляем треки по одному
+        logger.warning(f"Telegram отклонил альбом: {e}")
+        return sum([await send_batch_item(item, chat_id) for item in items])
+    
+    for item, message in zip(items, messages):
+        item.remember(message)
+    return len(messages)
+
+async def send_batch(tracks, chat_id):
+    """Отправляет треки альбомами по MEDIA_GROUP_SIZE. Возвращает число отправленных треков
+
+    Треки из кэша file_id не скачиваются, остальные скачиваются параллельно,
+    не больше BATCH_CONCURRENCY одновременно. Пока отправляется один альбом,
+    треки следующих продолжают скачиваться.
+    """
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    tasks = [asyncio.create_task(prepare_batch_item(track, semaphore)) for track in tracks]
+    sent = 0
+    try:
+        for start in range(0, len(tasks), MEDIA_GROUP_SIZE):
+            prepared = await asyncio.gather(*tasks[start:start + MEDIA_GROUP_SIZE], return_exceptions=True)
+            items = []
+            for track, result in zip(tracks[start:start + MEDIA_GROUP_SIZE], prepared):
+                if isinstance(result, BaseException):
+                    logger.warning(f"Трек {track.id} пропущен при пакетной загрузке: {result}")
+                else:
+                    items.append(result)
+            sent += await send_media_group(items, chat_id)
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Скачанные файлы удаляются после отправки всего пакета или при ошибке
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(result, BatchItem):
+                remove_file(result.temp_path)
+    return sent
+
+async def deliver_batch(results, tracks, page, started):
+    """Загружает треки страницы альбомами и возвращает сообщение с результатами. True при успехе"""
+    chat_id = results.chat_id
+    message_id = results.message_id
+    
+    page_cache.forget_shown(results.search_id)
+    show_status(chat_id, message_id, f"⏳ <b>Загрузка страницы:</b> {len(tracks)} треков...")
+    
+    try:
+        sent = await send_batch(tracks, chat_id)
+    finally:
+        # Результаты остаются доступны, чтобы скачать другие страницы
+        await show_tracks_page(results, page)
+    
+    logger.info(f"Пакетная загрузка: отправлено {sent} из {len(tracks)} треков")
+    metrics.selection_seconds.observe(time.monotonic() - started, source="batch")
+    if sent < len(tracks):
+        await bot.send_message(chat_id, f"⚠️ Не удалось загрузить треков: {len(tracks) - sent} из {len(tracks)}")
+    return sent > 0
+
+@dp.callback_query(DownloadPageCallback.filter())
+async def process_page_download(callback: types.CallbackQuery, callback_data: DownloadPageCallback):
+    started = time.monotonic()
+    results = await search_sessions.get(callback_data.search_id)
+    if results is None:
+        await callback.answer("Результаты поиска устарели", show_alert=True)
+        return
+    
+    if results.user_id != callback.from_user.id:
+        await callback.answer("Это не ваш поиск!", show_alert=True)
+        return
+    
+    page = callback_data.page
+    start_idx = (page - 1) * TRACKS_PER_PAGE
+    tracks = results.tracks[start_idx:start_idx + TRACKS_PER_PAGE]
+    if not tracks:
+        await callback.answer("Треки не найдены.", show_alert=True)
+        return
+    
+    # Пакет занимает в планировщике одно место, как выбор одного трека; его скачивания
+    # учитываются в общем лимите download_slots
+    try:
+        download_scheduler.submit(
+            callback.from_user.id,
+            f"page:{results.search_id}:{page}",
+            lambda: deliver_batch(results, tracks, page, started)
+        )
+    except AlreadyQueued:
+        await callback.answer("Эта страница уже загружается", show_alert=True)
+        return
+    except QuotaExceeded:
+        await callback.answer("⏳ Дождитесь завершения текущих загрузок", show_alert=True)
+        return
+    
+    await callback.answer(f"Загружаю {len(tracks)} треков...")
+
+@dp.inline_query()
+async def inline_search(inline_query: types.InlineQuery):
+    """Подсказки по локальному индексу в режиме @bot запрос"""
+    query = inline_query.query.strip()
+    if len(query) < 2:
+        await inline_query.answer([], cache_time=INLINE_CACHE_TIME)
+        return
 
-@dp.callback_query(F.data.startswith("page_"))
-async def process_page_navigation(callback: types.CallbackQuery):
-    parts = callback.data.split("_")
-    search_id = parts[1]
-    page = int(parts[2])
+    with metrics.search_seconds.time(kind="inline"):
+        tracks = await track_index.search(query, limit=INLINE_RESULTS)
+
+    results = []
+    for track in tracks:
+        title = track.title or "Без названия"
+        artist = track.artist or "Неизвестный исполнитель"
+        # Загруженный ранее трек отправляется сразу, остальные - как поисковый запрос боту
+        file_id = file_cache.peek(track.id)
+        if file_id:
+            results.append(types.InlineQueryResultCachedAudio(
+                id=f"audio_{track.id}",
+                audio_file_id=file_id
+            ))
+        else:
+            results.append(types.InlineQueryResultArticle(
+                id=f"track_{track.id}",
+                title=title,
+                description=f"{artist} · {format_duration(track.duration)}",
+                thumbnail_url=track.artwork_url,
+                input_message_content=types.InputTextMessageContent(message_text=f"{artist} - {title}")
+            ))
+
+    await inline_query.answer(results, cache_time=INLINE_CACHE_TIME)
+
+@dp.callback_query(PageCallback.filter())
+async def process_page_navigation(callback: types.CallbackQuery, callback_data: PageCallback):
+    # Страницы уже отрисованы - сообщение известно из самого callback, сессия не нужна
+    rendered = page_cache.peek(callback_data.search_id)
+    if rendered is not None and callback.message:
+        await show_rendered_page(rendered, callback.message.chat.id, callback.message.message_id, callback_data.page)
+        await callback.answer()
+        return
     
-    if search_id not in user_search_results:
+    results = await search_sessions.get(callback_data.search_id)
+    if results is None:
         await callback.answer("Результаты поиска устарели", show_alert=True)
         return
     
     # Показываем новую страницу (редактируя существующее сообщение)
-    await show_tracks_page(search_id, page)
+    await show_tracks_page(results, callback_data.page)
     await callback.answer()
 
 # Обработчик для кнопки с номером страницы (которая ничего не делает)
-@dp.callback_query(F.data == "noop")
+@dp.callback_query(NoopCallback.filter())
 async def process_noop(callback: types.CallbackQuery):
     await callback.answer("Текущая страница")
 
+@dp.callback_query(SimilarCallback.filter())
+async def process_similar(callback: types.CallbackQuery, callback_data: SimilarCallback):
+    await find_similar_tracks(callback, callback_data.track_id)
+
+# Кнопки "Найти похожие" под треками, отправленными до перехода на CallbackData
 @dp.callback_query(F.data.startswith("similar_"))
-async def find_similar_tracks(callback: types.CallbackQuery):
-    track_id = callback.data.split("_")[1]
-    search_id = str(uuid.uuid4())
+async def process_legacy_similar(callback: types.CallbackQuery):
+    await find_similar_tracks(callback, int(callback.data.split("_")[1]))
+
+async def find_similar_tracks(callback, track_id):
+    search_id = new_search_id()
     
     # Отправляем сообщение о начале поиска
     search_message = await callback.message.answer("🔍 Ищу похожие треки...")
     
     try:
-        async with aiohttp.ClientSession() as session:
-            client_id = os.getenv("SOUNDCLOUD_CLIENT_ID")
-            if not client_id:
-                await search_message.edit_text("⚠️ Ошибка: Отсутствует SoundCloud API ключ.")
-                return
-
-            # API для получения похожих треков
-            url = f"https://api-v2.soundcloud.com/tracks/{track_id}/related?client_id={client_id}&limit=100"
+        if not soundcloud.configured:
+            await search_message.edit_text("⚠️ Ошибка: Отсутствует SoundCloud API ключ.")
+            return
+
+        # API для получения похожих треков
+        try:
+            tracks = await get_related_tracks(track_id)
+        except SoundCloudError as e:
+            await search_message.edit_text(f"⚠️ Ошибка при поиске: {e.status}")
+            return
+        
+        if not tracks:
+            await search_message.edit_text("😕 Похожих треков не найдено")
+            return
+        
+        # Сохраняем результаты
+        results = SearchSession(
+            search_id=search_id,
+            tracks=tracks,
+            query=f"Похожие на {callback.message.audio.title}",
+            message_id=search_message.message_id,
+            chat_id=search_message.chat.id,
+            user_id=callback.from_user.id
+        )
+        await search_sessions.add(results)
+        
+        await show_tracks_page(results, 1)
+        prefetcher.schedule(results)
             
-            async with session.get(url) as response:
-                if response.status != 200:
-                    await search_message.edit_text(f"⚠️ Ошибка при поиске: {response.status}")
-                    return
-                    
-                data = await response.json()
-                tracks = data.get("collection", [])
-                
-                if not tracks:
-                    await search_message.edit_text("😕 Похожих треков не найдено")
-                    return
-                
-                # Сохраняем результаты
-                user_search_results[search_id] = {
-                    "tracks": tracks,
-                    "current_page": 1,
-                    "query": f"Похожие на {callback.message.audio.title}",
-                    "message_id": search_message.message_id,
-                    "chat_id": search_message.chat.id,
-                    "user_id": callback.from_user.id
-                }
-                
-                await show_tracks_page(search_id, 1)
-                
     except Exception as e:
         logger.error(f"Ошибка при поиске похожих треков: {e}")
         await search_message.edit_text(f"⚠️ Произошла ошибка: {e}")
     await callback.answer()
 
+def encode_cached(value):
+    """Значение кэша поиска для снимка: список треков или (название, треки) плейлиста"""
+    if isinstance(value, tuple):
+        title, tracks = value
+        return {"title": title, "t": [track.to_record() for track in tracks]}
+    return [track.to_record() for track in value]
+
+def decode_cached(entries):
+    """Записи кэша поиска из снимка; выполняется в потоке чтения снимка"""
+    decoded = []
+    for key, expires, value in entries:
+        if isinstance(value, dict):
+            value = value["title"], [TrackInfo.from_record(record) for record in value["t"]]
+        else:
+            value = [TrackInfo.from_record(record) for record in value]
+        decoded.append([key, expires, value])
+    return decoded
+
+async def restore_snapshot():
+    """Восстанавливает сессии и кэши из снимка прошлого запуска"""
+    try:
+        sections = await snapshot.load({"search": decode_cached})
+        if not sections:
+            return
+        search_sessions.restore(sections.get("sessions") or [])
+        cached = search_cache.restore(sections.get("search") or [])
+        streams = stream_resolver.restore(sections.get("streams") or {})
+        logger.info(
+            f"Из снимка восстановлено: сессий {len(sections.get('sessions') or [])}, "
+            f"ответов SoundCloud {cached}, записей о потоках {streams}"
+        )
+    except Exception as e:
+        logger.error(f"Не удалось восстановить снимок: {e}")
+
+async def save_snapshot():
+    try:
+        await snapshot.save({
+            "sessions": search_sessions.snapshot(),
+            "search": search_cache.snapshot(encode_cached),
+            "streams": stream_resolver.snapshot(),
+        })
+    except Exception as e:
+        logger.error(f"Не удалось записать снимок: {e}")
+
 async def main():
+    # Процессы постобработки создаются первыми, пока в процессе нет других потоков
+    postprocessor.start()
+    # Логи пишутся из фонового потока, цикл событий только ставит их в очередь
+    setup_logging()
     logger.info("Бот запущен")
-    await bot.delete_webhook(drop_pending_updates=True)
+    await http.start()
+    outbound_queue.start()
+    await download_scheduler.start()
+    # Снимок читается в фоне: апдейты обрабатываются сразу, промах по сессии ждет окончания чтения
+    restore_task = asyncio.create_task(restore_snapshot())
+    search_sessions.restoring = restore_task
+    top_refresh_task = asyncio.create_task(refresh_top_loop())
+    metrics_runner = await metrics.start_metrics_server()
     
     try:
-        await dp.start_polling(bot)
+        if os.getenv("WEBHOOK_URL"):
+            await run_webhook(bot, dp, update_limiter, drain_hooks=[download_scheduler.drain])
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            # Сессию бота закрываем сами, после завершения текущих загрузок
+            await dp.start_polling(bot, close_bot_session=False)
+            await update_limiter.drain()
+            await download_scheduler.drain()
     except (KeyboardInterrupt, SystemExit):
         logger.info("Бот останавливается...")
-        await bot.session.close()
-        await dp.storage.close()
+        await update_limiter.drain()
+        await download_scheduler.drain()
     except Exception as e:
         logger.error(f"Критическая ошибка: {e}")
     finally:
+        top_refresh_task.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await prefetcher.close()
+        await download_scheduler.close()
+        postprocessor.close()
+        logger.info(f"Постобработка: {postprocessor.stats()}")
+        await outbound_queue.close()
+        logger.info(f"Исходящая очередь: {outbound_queue.stats()}")
+        await bot.session.close()
+        await dp.storage.close()
+        stats = file_cache.stats()
+        logger.info(f"Кэш file_id: {stats['hits']} попаданий, {stats['misses']} промахов")
+        file_cache.close()
+        await track_index.flush()
+        logger.info(f"Индекс треков: {track_index.stats()}")
+        track_index.close()
+        pool = http.stats()
+        logger.info(f"HTTP пул: {pool['requests']} запросов, повторное использование соединений {pool['reuse_ratio']:.0%}")
+        await http.close()
+        # Снимок пишется после окончания восстановления, иначе невостребованные записи прошлого снимка потеряются
+        await restore_task
+        await save_snapshot()
+        logger.info(f"Поисковые сессии: {search_sessions.stats()}")
+        await search_sessions.close()
+        logger.info(f"Кэш поиска: {search_cache.stats()}")
+        logger.info(f"Получение ссылок на поток: {stream_resolver.stats()['strategies']}")
+        logger.info(f"SoundCloud API: {soundcloud.stats()}")
+        logger.info(f"Предзагрузка: {prefetcher.stats()}")
+        logger.info(f"Логи: {sampler.stats()}")
         logger.info("Бот успешно остановлен")
+        # Дописываем сообщения, оставшиеся в очереди логов
+        await logger.complete()
 
 if __name__ == "__main__":
     try:
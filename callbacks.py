@@ -0,0 +1,40 @@
+from aiogram.filters.callback_data import CallbackData
+
+# Telegram ограничивает callback_data 64 байтами, поэтому префиксы однобуквенные,
+# а поиск обозначается коротким search_id (см. sessions.new_search_id)
+
+
+class TrackCallback(CallbackData, prefix="t"):
+    """Выбор трека из результатов поиска
+
+    Помимо позиции в выдаче несет ID трека: если трек уже есть в кэше
+    file_id, его можно отправить, не загружая поисковую сессию.
+    """
+
+    search_id: str
+    index: int
+    track_id: int
+
+
+class PageCallback(CallbackData, prefix="p"):
+    """Переход на страницу результатов"""
+
+    search_id: str
+    page: int
+
+
+class DownloadPageCallback(CallbackData, prefix="d"):
+    """Загрузка всех треков страницы одним альбомом"""
+
+    search_id: str
+    page: int
+
+
+class SimilarCallback(CallbackData, prefix="s"):
+    """Кнопка "Найти похожие" под отправленным треком"""
+
+    track_id: int
+
+
+class NoopCallback(CallbackData, prefix="noop"):
+    """Кнопка с номером текущей страницы"""
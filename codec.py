@@ -0,0 +1,35 @@
+import json
+
+from sessions import TrackInfo
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(body):
+    """Разбирает JSON из bytes: через orjson, если он установлен, иначе стандартным json"""
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def decode_tracks(body, nested=None):
+    """Разбирает ответ со списком треков и оставляет от каждого только TrackInfo
+
+    Ответ на limit=100 - сотни килобайт JSON с пользователями, вариантами
+    кодировки и метаданными издателя. Словари живут только до конца вызова,
+    дальше хранятся компактные записи. Принимает и {"collection": [...]},
+    и голый список (/tracks?ids=). nested - ключ, под которым лежит трек
+    в элементе коллекции (в чартах - "track").
+    """
+    data = loads(body)
+    items = data.get("collection", []) if isinstance(data, dict) else data
+    tracks = []
+    for item in items:
+        if nested is not None:
+            item = item.get(nested)
+        if item:
+            tracks.append(TrackInfo.from_api(item))
+    return tracks
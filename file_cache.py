@@ -0,0 +1,97 @@
+import os
+import sqlite3
+import time
+
+from loguru import logger
+
+
+class FileIdCache:
+    """Постоянный кэш соответствия ID трека SoundCloud -> file_id Telegram"""
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS audio_files ("
+            "track_id TEXT PRIMARY KEY, "
+            "file_id TEXT NOT NULL, "
+            "file_unique_id TEXT, "
+            "created_at INTEGER NOT NULL, "
+            "used_at INTEGER NOT NULL, "
+            "uses INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._conn.commit()
+
+    def get(self, track_id):
+        """Возвращает file_id для трека или None"""
+        row = self._conn.execute(
+            "SELECT file_id FROM audio_files WHERE track_id = ?",
+            (str(track_id),)
+        ).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._conn.execute(
+            "UPDATE audio_files SET used_at = ?, uses = uses + 1 WHERE track_id = ?",
+            (int(time.time()), str(track_id))
+        )
+        self._conn.commit()
+        return row[0]
+
+    def peek(self, track_id):
+        """Возвращает file_id без учета в счетчиках и статистике использования"""
+        row = self._conn.execute(
+            "SELECT file_id FROM audio_files WHERE track_id = ?",
+            (str(track_id),)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, track_id, file_id, file_unique_id=None):
+        """Сохраняет file_id, полученный после загрузки трека в Telegram"""
+        now = int(time.time())
+        self._conn.execute(
+            "INSERT OR REPLACE INTO audio_files "
+            "(track_id, file_id, file_unique_id, created_at, used_at, uses) "
+            "VALUES (?, ?, ?, ?, ?, 0)",
+            (str(track_id), file_id, file_unique_id, now, now)
+        )
+        self._conn.commit()
+
+    def invalidate(self, track_id):
+        """Удаляет запись, если Telegram больше не принимает file_id"""
+        cursor = self._conn.execute(
+            "DELETE FROM audio_files WHERE track_id = ?",
+            (str(track_id),)
+        )
+        self._conn.commit()
+        if cursor.rowcount:
+            self.invalidations += 1
+            logger.warning(f"file_id для трека {track_id} удален из кэша")
+
+    def stats(self):
+        """Счетчики попаданий и промахов кэша"""
+        total = self.hits + self.misses
+        size = self._conn.execute("SELECT COUNT(*) FROM audio_files").fetchone()[0]
+        return {
+            "entries": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,72 @@
+import asyncio
+import os
+from urllib.parse import urljoin
+
+from loguru import logger
+
+
+class SegmentError(Exception):
+    """Сегмент HLS не удалось загрузить после всех попыток"""
+
+
+def parse_playlist(playlist, base_url):
+    """Возвращает список URL аудиосегментов из m3u8 плейлиста"""
+    segments = []
+    for line in playlist.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if '.mp3' in line or '.aac' in line or '.ts' in line or '.m4a' in line:
+            segments.append(urljoin(base_url, line))
+    return segments
+
+
+async def fetch_segment(session, url, index, retries, timeout):
+    """Скачивает один сегмент, повторяя попытку при ошибке"""
+    delay = 0.5
+    for attempt in range(1, retries + 1):
+        try:
+            async with session.get(url, timeout=timeout) as response:
+                if response.status == 200:
+                    data = await response.read()
+                    if data:
+                        return data
+                    logger.warning(f"Сегмент {index} пустой (попытка {attempt}/{retries})")
+                else:
+                    logger.warning(f"Сегмент {index}: статус {response.status} (попытка {attempt}/{retries})")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Ошибка при загрузке сегмента {index} (попытка {attempt}/{retries}): {e}")
+
+        if attempt < retries:
+            await asyncio.sleep(delay)
+            delay *= 2
+
+    raise SegmentError(f"Не удалось загрузить сегмент {index}")
+
+
+async def iter_segments(session, urls, timeout, concurrency=None, retries=None):
+    """Параллельно скачивает сегменты и отдает их строго по порядку
+
+    Одновременно загружается не больше concurrency сегментов, поэтому в памяти
+    находится только окно из уже скачанных, но еще не отданных сегментов.
+    """
+    concurrency = concurrency or int(os.getenv("HLS_CONCURRENCY", "8"))
+    retries = retries or int(os.getenv("HLS_SEGMENT_RETRIES", "3"))
+
+    tasks = {}
+    next_index = 0
+    try:
+        for index in range(len(urls)):
+            while next_index < len(urls) and next_index < index + concurrency:
+                tasks[next_index] = asyncio.create_task(
+                    fetch_segment(session, urls[next_index], next_index + 1, retries, timeout)
+                )
+                next_index += 1
+            yield await tasks.pop(index)
+    finally:
+        for task in tasks.values():
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
@@ -0,0 +1,116 @@
+import os
+import time
+
+import aiohttp
+from loguru import logger
+
+# Адреса API можно переопределить, например, для локального стенда из bench/
+SOUNDCLOUD_API_URL = os.getenv("SOUNDCLOUD_API_URL", "https://api-v2.soundcloud.com").rstrip("/")
+SOUNDCLOUD_MOBILE_API_URL = os.getenv("SOUNDCLOUD_MOBILE_API_URL", "https://api-mobi.soundcloud.com").rstrip("/")
+
+
+class SoundCloudError(Exception):
+    """SoundCloud API ответил ошибкой"""
+
+    def __init__(self, status):
+        super().__init__(f"SoundCloud API вернул статус {status}")
+        self.status = status
+
+
+class HttpClient:
+    """Общий пул соединений aiohttp для SoundCloud API и CDN"""
+
+    def __init__(self):
+        self.limit = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+        self.limit_per_host = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "20"))
+        self.dns_ttl = int(os.getenv("HTTP_DNS_TTL", "300"))
+        self.keepalive_timeout = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "30"))
+
+        self._session = None
+        self._connector = None
+
+        # Статистика пула
+        self.requests = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.queued = 0
+        self.queue_wait_total = 0.0
+
+    async def start(self):
+        if self._session is not None:
+            return
+
+        self._connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=self.dns_ttl,
+            use_dns_cache=True,
+            keepalive_timeout=self.keepalive_timeout,
+            enable_cleanup_closed=True
+        )
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_connection_create_end.append(self._on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reuseconn)
+        trace_config.on_connection_queued_start.append(self._on_connection_queued_start)
+        trace_config.on_connection_queued_end.append(self._on_connection_queued_end)
+
+        self._session = aiohttp.ClientSession(
+            connector=self._connector,
+            trace_configs=[trace_config]
+        )
+        logger.info(
+            f"HTTP пул запущен: limit={self.limit}, limit_per_host={self.limit_per_host}"
+        )
+
+    async def close(self):
+        if self._session is None:
+            return
+        await self._session.close()
+        self._session = None
+        self._connector = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            raise RuntimeError("HTTP клиент не запущен")
+        return self._session
+
+    def stats(self):
+        """Текущее состояние пула соединений"""
+        opened = self.connections_created + self.connections_reused
+        open_connections = 0
+        if self._connector is not None:
+            # _conns хранит свободные keep-alive соединения, _acquired - занятые
+            idle = sum(len(conns) for conns in self._connector._conns.values())
+            open_connections = idle + len(self._connector._acquired)
+
+        return {
+            "requests": self.requests,
+            "open_connections": open_connections,
+            "connections_created": self.connections_created,
+            "connections_reused": self.connections_reused,
+            "reuse_ratio": self.connections_reused / opened if opened else 0.0,
+            "queued": self.queued,
+            "queue_wait_avg": self.queue_wait_total / self.queued if self.queued else 0.0,
+        }
+
+    async def _on_request_start(self, session, ctx, params):
+        self.requests += 1
+
+    async def _on_connection_create_end(self, session, ctx, params):
+        self.connections_created += 1
+
+    async def _on_connection_reuseconn(self, session, ctx, params):
+        self.connections_reused += 1
+
+    async def _on_connection_queued_start(self, session, ctx, params):
+        ctx.queued_at = time.monotonic()
+
+    async def _on_connection_queued_end(self, session, ctx, params):
+        self.queued += 1
+        self.queue_wait_total += time.monotonic() - getattr(ctx, "queued_at", time.monotonic())
+
+
+http = HttpClient()
@@ -0,0 +1,103 @@
+import json
+import os
+import sys
+import time
+from urllib.parse import urlsplit
+
+from loguru import logger
+
+from metrics import logs_suppressed_total
+
+# Сообщения горячих путей (по одному на трек, загрузку, отправку): частота
+# ограничивается на каждое место вызова, см. SiteSampler
+sampled_logger = logger.bind(sampled=True)
+
+WARNING_LEVEL = logger.level("WARNING").no
+
+
+def redact_url(url):
+    """Адрес без параметров запроса: в них client_id и подписи ссылок на поток"""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}{parts.path}"
+
+
+class SiteSampler:
+    """Фильтр loguru: не больше rate сообщений в секунду с одного места вызова
+
+    Ограничиваются только сообщения sampled_logger уровня ниже WARNING:
+    предупреждения и ошибки проходят всегда. Число пропущенных добавляется
+    к следующему сообщению с того же места (поле suppressed).
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate if rate is not None else float(os.getenv("LOG_SAMPLE_RATE", "5"))
+        # (модуль, строка) -> [начало секунды, сообщений в ней, пропущено]
+        self._sites = {}
+        self.suppressed = 0
+
+    def __call__(self, record):
+        if not self.rate or not record["extra"].get("sampled") or record["level"].no >= WARNING_LEVEL:
+            return True
+
+        now = time.monotonic()
+        site = self._sites.setdefault((record["name"], record["line"]), [now, 0, 0])
+        if now - site[0] >= 1:
+            site[0] = now
+            site[1] = 0
+        if site[1] >= self.rate:
+            site[2] += 1
+            self.suppressed += 1
+            logs_suppressed_total.inc()
+            return False
+
+        site[1] += 1
+        if site[2]:
+            record["extra"]["suppressed"] = site[2]
+            site[2] = 0
+        return True
+
+    def stats(self):
+        return {"rate": self.rate, "sites": len(self._sites), "suppressed": self.suppressed}
+
+
+class JsonSink:
+    """Запись сообщений строками JSON; вызывается в фоновом потоке loguru"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, message):
+        record = message.record
+        entry = {
+            "time": record["time"].isoformat(),
+            "level": record["level"].name,
+            "message": record["message"],
+            "module": record["name"],
+            "function": record["function"],
+            "line": record["line"],
+        }
+        entry.update((key, value) for key, value in record["extra"].items() if key != "sampled")
+        if record["exception"] is not None:
+            # С format="{message}" loguru дописывает трассировку после текста сообщения
+            entry["exception"] = str(message)[len(record["message"]):].strip()
+        self.stream.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+        self.stream.flush()
+
+
+sampler = SiteSampler()
+
+
+def setup_logging():
+    """Заменяет синхронный вывод loguru на запись через очередь в фоновом потоке
+
+    LOG_FORMAT=json - одна строка JSON на сообщение, иначе обычный текст.
+    Форматирование и запись в stderr выполняются в потоке loguru, цикл
+    событий только кладет сообщение в очередь. Поток создается здесь,
+    поэтому процессы постобработки нужно запускать раньше.
+    """
+    level = os.getenv("LOG_LEVEL", "INFO")
+    logger.remove()
+    if os.getenv("LOG_FORMAT", "text") == "json":
+        logger.add(JsonSink(sys.stderr), level=level, format="{message}", filter=sampler, enqueue=True)
+    else:
+        logger.add(sys.stderr, level=level, filter=sampler, enqueue=True)
@@ -0,0 +1,186 @@
+import bisect
+import os
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+from loguru import logger
+
+# Границы корзин гистограмм по умолчанию: от десятков миллисекунд до минуты
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = tuple(mb * 1024 * 1024 for mb in (1, 2, 5, 10, 20, 50))
+
+
+class Metric:
+    """Метрика в формате Prometheus: значения хранятся по набору меток"""
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def _format_labels(self, key, extra=None):
+        pairs = list(zip(self.labels, key))
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        body = ",".join(f'{label}="{_escape(value)}"' for label, value in pairs)
+        return "{" + body + "}"
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield f"{self.name}{self._format_labels(key)} {_format_value(value)}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Текущее значение. С fn значение считается при каждом запросе метрик"""
+
+    type = "gauge"
+
+    def __init__(self, name, help, labels=(), fn=None):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def samples(self):
+        if self.fn is not None:
+            value = self.fn()
+            if value is not None:
+                yield f"{self.name} {_format_value(value)}"
+            return
+        yield from super().samples()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # Счетчики по корзинам (последняя - +Inf), сумма и число наблюдений
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Замеряет время выполнения блока в секундах"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def samples(self):
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                labels = self._format_labels(key, ("le", _format_value(bound)))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            yield f"{self.name}_sum{self._format_labels(key)} {_format_value(total)}"
+            yield f"{self.name}_count{self._format_labels(key)} {count}"
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+REGISTRY = []
+
+
+def render():
+    """Все метрики в текстовом формате Prometheus"""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+async def metrics_handler(request):
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server():
+    """Поднимает отдельный HTTP-сервер с /metrics, если задан METRICS_PORT. Возвращает runner или None"""
+    port = os.getenv("METRICS_PORT")
+    if not port:
+        return None
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    # По умолчанию метрики видны только локально: в них размеры очередей и число пользователей
+    host = os.getenv("METRICS_HOST", "127.0.0.1")
+    await web.TCPSite(runner, host=host, port=int(port)).start()
+    logger.info(f"Метрики доступны на {host}:{port}/metrics")
+    return runner
+
+
+# Метрики конвейера трека: поиск -> ссылка на поток -> загрузка -> отправка в Telegram
+search_seconds = Histogram(
+    "hx_search_seconds", "Время получения результатов поиска, топа и похожих треков", ("kind",)
+)
+stream_resolve_seconds = Histogram(
+    "hx_stream_resolve_seconds", "Время получения ссылки на поток по стратегиям", ("strategy", "result")
+)
+queue_wait_seconds = Histogram(
+    "hx_queue_wait_seconds", "Время ожидания загрузки в очереди планировщика"
+)
+download_seconds = Histogram(
+    "hx_download_seconds", "Время скачивания аудио", ("protocol",)
+)
+download_bytes = Histogram(
+    "hx_download_bytes", "Размер скачанного аудио, байт", ("protocol",), buckets=SIZE_BUCKETS
+)
+postprocess_seconds = Histogram(
+    "hx_postprocess_seconds", "Время постобработки аудио по этапам: ожидание процесса, перепаковка, теги", ("stage",)
+)
+upload_seconds = Histogram(
+    "hx_upload_seconds", "Время отправки аудио в Telegram"
+)
+selection_seconds = Histogram(
+    "hx_selection_seconds", "Время от выбора трека до отправки аудио", ("source",)
+)
+download_resumes_total = Counter(
+    "hx_download_resumes_total", "Повторные запросы части файла после обрыва или ошибки"
+)
+errors_total = Counter(
+    "hx_errors_total", "Ошибки по этапам обработки", ("stage",)
+)
+logs_suppressed_total = Counter(
+    "hx_logs_suppressed_total", "Сообщения горячих путей, пропущенные ограничением частоты логов"
+)
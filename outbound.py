@@ -0,0 +1,274 @@
+import asyncio
+import itertools
+import os
+import time
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    DeleteMessage,
+    EditMessageReplyMarkup,
+    EditMessageText,
+    SendAudio,
+    SendMediaGroup,
+    SendMessage,
+)
+from loguru import logger
+
+# Чем меньше число, тем раньше уходит запрос: аудио важнее косметических правок
+PRIORITIES = {
+    SendAudio: 0,
+    SendMediaGroup: 0,
+    SendMessage: 1,
+    DeleteMessage: 2,
+    EditMessageText: 3,
+    EditMessageReplyMarkup: 3,
+}
+
+# Правки одного сообщения, которые еще не отправлены, заменяются последней
+COALESCED = (EditMessageText, EditMessageReplyMarkup)
+
+
+class TokenBucket:
+    """Ведро токенов: rate запросов в секунду с запасом burst"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, now):
+        """Через сколько секунд появится токен"""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, now, seconds):
+        """Telegram попросил подождать (RetryAfter) - токенов не будет до конца паузы"""
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.tokens = 0
+        self.updated = self.blocked_until
+
+
+class OutboundJob:
+    __slots__ = ("priority", "seq", "chat_id", "method", "make_request", "bot", "futures", "attempts")
+
+    def __init__(self, priority, seq, chat_id, method, make_request, bot):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.method = method
+        self.make_request = make_request
+        self.bot = bot
+        self.futures = [asyncio.get_running_loop().create_future()]
+        self.attempts = 0
+
+
+class OutboundQueue(BaseRequestMiddleware):
+    """Очередь исходящих запросов к Bot API с учетом лимитов Telegram
+
+    Подключается как middleware сессии бота, поэтому вызовы bot.send_audio,
+    bot.edit_message_text и т.п. не меняются. Отправка сообщений в чат
+    ограничивается ведром токенов на чат и общим ведром на бота. Из очереди
+    первым уходит запрос с наивысшим приоритетом среди чатов, у которых есть
+    токен. Повторные правки одного сообщения склеиваются, а на RetryAfter
+    чат ставится на паузу и запрос повторяется. Остальные методы (ответы на
+    callback, getUpdates, служебные вызовы) проходят без очереди.
+    """
+
+    def __init__(self):
+        self.global_rate = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+        self.chat_rate = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+        self.chat_burst = float(os.getenv("OUTBOUND_CHAT_BURST", "3"))
+        self.max_retries = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+
+        self._global = TokenBucket(self.global_rate, self.global_rate)
+        # chat_id -> ведро токенов; пустые и полные ведра удаляются
+        self._buckets = {}
+        # chat_id -> список заявок в порядке (приоритет, очередность)
+        self._pending = {}
+        # (chat_id, message_id) -> неотправленная правка сообщения
+        self._edits = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._in_flight = set()
+        self._trimmed_at = time.monotonic()
+
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.throttled = 0
+
+    async def __call__(self, make_request, bot, method):
+        priority = PRIORITIES.get(type(method))
+        chat_id = getattr(method, "chat_id", None)
+        if priority is None or chat_id is None or self._task is None:
+            return await make_request(bot, method)
+
+        if isinstance(method, COALESCED) and method.message_id is not None:
+            key = (chat_id, method.message_id)
+            job = self._edits.get(key)
+            if job is not None and type(job.method) is type(method):
+                # Предыдущая правка еще не ушла - отправим только последнюю версию
+                job.method = method
+                future = asyncio.get_running_loop().create_future()
+                job.futures.append(future)
+                self.coalesced += 1
+                return await future
+        else:
+            key = None
+
+        job = OutboundJob(priority, next(self._seq), chat_id, method, make_request, bot)
+        if key is not None:
+            self._edits[key] = job
+        self._push(job)
+        return await job.futures[0]
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for jobs in self._pending.values():
+            for job in jobs:
+                for future in job.futures:
+                    future.cancel()
+        self._pending.clear()
+        self._edits.clear()
+
+    def queued(self):
+        return sum(len(jobs) for jobs in self._pending.values())
+
+    def stats(self):
+        return {
+            "queued": self.queued(),
+            "in_flight": len(self._in_flight),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "retried": self.retried,
+            "throttled": self.throttled,
+        }
+
+    def _push(self, job):
+        jobs = self._pending.setdefault(job.chat_id, [])
+        jobs.append(job)
+        jobs.sort(key=lambda j: (j.priority, j.seq))
+        self._wakeup.set()
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _pick(self, now):
+        """Лучшая заявка среди чатов с токенами и время ожидания, если таких нет"""
+        best = None
+        wait = None
+        for chat_id, jobs in self._pending.items():
+            delay = self._bucket(chat_id).delay(now)
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            head = jobs[0]
+            if best is None or (head.priority, head.seq) < (best.priority, best.seq):
+                best = head
+        return best, wait
+
+    async def _loop(self):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            job, wait = self._pick(now)
+            if job is not None:
+                global_delay = self._global.delay(now)
+                if global_delay > 0:
+                    wait = global_delay
+                    job = None
+
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._global.take()
+            self._bucket(job.chat_id).take()
+            jobs = self._pending[job.chat_id]
+            jobs.pop(0)
+            if not jobs:
+                del self._pending[job.chat_id]
+            self._forget_edit(job)
+
+            task = asyncio.create_task(self._send(job))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+            self._trim_buckets(now)
+
+    async def _send(self, job):
+        job.attempts += 1
+        try:
+            result = await job.make_request(job.bot, job.method)
+        except TelegramRetryAfter as e:
+            self.throttled += 1
+            self._bucket(job.chat_id).block(time.monotonic(), e.retry_after)
+            if job.attempts > self.max_retries:
+                self._resolve(job, exception=e)
+                return
+            logger.warning(f"Ограничение Telegram в чате {job.chat_id}: повтор через {e.retry_after} с")
+            self.retried += 1
+            self._push(job)
+            return
+        except Exception as e:
+            self._resolve(job, exception=e)
+            return
+        self.sent += 1
+        self._resolve(job, result=result)
+
+    def _forget_edit(self, job):
+        if isinstance(job.method, COALESCED):
+            key = (job.chat_id, job.method.message_id)
+            if self._edits.get(key) is job:
+                del self._edits[key]
+
+    def _resolve(self, job, result=None, exception=None):
+        for future in job.futures:
+            if future.done():
+                continue
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+    def _trim_buckets(self, now):
+        # Ведра простаивающих чатов не нужны: новое ведро создается полным
+        if now - self._trimmed_at < 60:
+            return
+        self._trimmed_at = now
+        idle = [
+            chat_id for chat_id, bucket in self._buckets.items()
+            if chat_id not in self._pending and bucket.delay(now) == 0 and bucket.tokens >= bucket.burst
+        ]
+        for chat_id in idle:
+            del self._buckets[chat_id]
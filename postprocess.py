@@ -0,0 +1,252 @@
+import asyncio
+import multiprocessing
+import os
+import shutil
+import subprocess
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from loguru import logger
+
+import metrics
+
+try:
+    from mutagen.id3 import APIC, ID3, TIT2, TPE1, ID3NoHeaderError
+except ImportError:
+    ID3 = None
+
+# Расширения файлов, которые Telegram показывает как аудио
+AUDIO_EXTENSIONS = (".mp3", ".m4a")
+
+
+def detect_format(path):
+    """Формат скачанного аудио по первым байтам: mp3, aac (ADTS), ts или None"""
+    with open(path, "rb") as f:
+        head = f.read(4096)
+    if head.startswith(b"ID3"):
+        return "mp3"
+    if len(head) > 188 and head[0] == 0x47 and head[188] == 0x47:
+        # MPEG-TS: пакеты по 188 байт с синхробайтом 0x47
+        return "ts"
+    if len(head) > 1 and head[0] == 0xFF:
+        if head[1] & 0xF6 == 0xF0:
+            return "aac"
+        if head[1] & 0xE0 == 0xE0:
+            return "mp3"
+    return None
+
+
+def run_ffmpeg(ffmpeg, src, dst, container, title, artist, cover_path, timeout):
+    """Перепаковывает аудио без перекодирования и записывает теги и обложку"""
+    command = [ffmpeg, "-hide_banner", "-loglevel", "error", "-y", "-i", src]
+    if cover_path:
+        command += ["-i", cover_path, "-map", "0:a", "-map", "1:v", "-disposition:v", "attached_pic"]
+    else:
+        command += ["-map", "0:a"]
+    command += ["-c", "copy", "-metadata", f"title={title}", "-metadata", f"artist={artist}"]
+    if container == "mp3":
+        command += ["-id3v2_version", "3", "-f", "mp3"]
+    else:
+        command += ["-bsf:a", "aac_adtstoasc", "-f", "ipod"]
+    subprocess.run(command + [dst], check=True, capture_output=True, timeout=timeout)
+
+
+def write_id3(path, title, artist, cover):
+    try:
+        tags = ID3(path)
+    except ID3NoHeaderError:
+        tags = ID3()
+    tags.setall("TIT2", [TIT2(encoding=3, text=title)])
+    tags.setall("TPE1", [TPE1(encoding=3, text=artist)])
+    if cover:
+        tags.setall("APIC", [APIC(encoding=3, mime="image/jpeg", type=3, desc="Cover", data=cover)])
+    tags.save(path, v2_version=3)
+
+
+def process_file(src, dst_base, title, artist, cover, ffmpeg, timeout):
+    """Выполняется в процессе пула. Возвращает (путь к результату или None, {этап: секунды})
+
+    MP3 (progressive или склеенные сегменты HLS mp3) получает ID3-теги на
+    месте и переносится в кэш. AAC и MPEG-TS из HLS перепаковываются ffmpeg
+    в M4A (или MP3, если внутри TS mp3) без перекодирования.
+    """
+    timings = {}
+    started = time.perf_counter()
+    kind = detect_format(src)
+
+    if kind == "mp3" and ID3 is not None:
+        write_id3(src, title, artist, cover)
+        timings["tag"] = time.perf_counter() - started
+        dst = f"{dst_base}.mp3"
+        shutil.move(src, dst)
+        return dst, timings
+
+    if kind is None or not ffmpeg:
+        return None, timings
+
+    cover_path = None
+    if cover:
+        cover_path = f"{dst_base}.cover.jpg"
+        with open(cover_path, "wb") as f:
+            f.write(cover)
+    try:
+        # В TS может лежать и mp3, и AAC: сначала пробуем MP3, затем M4A
+        containers = ("mp3", "m4a") if kind == "ts" else ("m4a",) if kind == "aac" else ("mp3",)
+        for container in containers:
+            dst = f"{dst_base}.{container}"
+            try:
+                run_ffmpeg(ffmpeg, src, f"{dst}.tmp", container, title, artist, cover_path, timeout)
+            except subprocess.CalledProcessError:
+                if container == containers[-1]:
+                    raise
+                continue
+            os.replace(f"{dst}.tmp", dst)
+            timings["remux"] = time.perf_counter() - started
+            return dst, timings
+    finally:
+        for path in (cover_path, f"{dst_base}.mp3.tmp", f"{dst_base}.m4a.tmp"):
+            if path and os.path.exists(path):
+                os.remove(path)
+    return None, timings
+
+
+class PostProcessor:
+    """Перепаковка HLS и запись ID3-тегов в пуле процессов с дисковым кэшем по ID трека
+
+    Обработка (ffmpeg и mutagen) выполняется в отдельных процессах и не
+    блокирует цикл событий. Готовые файлы хранятся в POSTPROCESS_DIR:
+    повторная загрузка трека (например, после устаревшего file_id) берет
+    их без скачивания. Без ffmpeg и mutagen обработка отключается и трек
+    отправляется как скачан.
+    """
+
+    def __init__(self):
+        self.enabled = os.getenv("POSTPROCESS_ENABLED", "1") == "1"
+        self.workers = int(os.getenv("POSTPROCESS_WORKERS", "2"))
+        self.timeout = float(os.getenv("POSTPROCESS_TIMEOUT", "60"))
+        self.directory = os.getenv("POSTPROCESS_DIR", "data/processed")
+        self.disk_limit = int(os.getenv("POSTPROCESS_DISK_LIMIT", str(1024 * 1024 * 1024)))
+        self.ffmpeg = shutil.which(os.getenv("FFMPEG_PATH", "ffmpeg"))
+        self.available = self.enabled and bool(self.ffmpeg or ID3 is not None)
+
+        self._executor = None
+        # track_id -> путь к обработанному файлу, от давно использованных к недавним
+        self._files = None
+        self._disk_bytes = 0
+
+        self.hits = 0
+        self.processed = 0
+        self.skipped = 0
+        self.failed = 0
+        self.evictions = 0
+
+    def start(self):
+        """Запускает процессы пула. Вызывается при старте, пока в процессе нет других потоков"""
+        if not self.available:
+            logger.info("Постобработка аудио отключена: нет ffmpeg и mutagen")
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        # fork, а не spawn: spawn заново импортирует bot.py со всеми его ресурсами в каждом процессе
+        method = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+        self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context(method))
+        # С fork все процессы создаются при первой задаче - создаем их сейчас
+        self._executor.submit(os.getpid)
+        logger.info(f"Постобработка аудио: {self.workers} процессов, ffmpeg: {self.ffmpeg or 'нет'}, mutagen: {ID3 is not None}")
+
+    async def get(self, track_id):
+        """Путь к уже обработанному файлу трека или None"""
+        if self._executor is None:
+            return None
+        if self._files is None:
+            self._files, self._disk_bytes = await asyncio.to_thread(self._scan)
+        path = self._files.get(track_id)
+        if path is None:
+            return None
+        if not os.path.exists(path):
+            del self._files[track_id]
+            return None
+        self.hits += 1
+        self._files.move_to_end(track_id)
+        return path
+
+    async def process(self, track, src, cover=None):
+        """Обрабатывает скачанный файл. Возвращает путь к результату в кэше или None"""
+        if self._executor is None:
+            return None
+
+        started = time.monotonic()
+        try:
+            path, timings = await asyncio.get_running_loop().run_in_executor(
+                self._executor,
+                process_file,
+                src,
+                os.path.join(self.directory, str(track.id)),
+                track.title or "Без названия",
+                track.artist or "Неизвестный исполнитель",
+                cover,
+                self.ffmpeg,
+                self.timeout
+            )
+        except Exception as e:
+            self.failed += 1
+            metrics.errors_total.inc(stage="postprocess")
+            logger.error(f"Не удалось обработать трек {track.id}: {e}")
+            return None
+
+        # Ожидание свободного процесса - все, что не ушло на саму обработку
+        metrics.postprocess_seconds.observe(max(0.0, time.monotonic() - started - sum(timings.values())), stage="wait")
+        for stage, seconds in timings.items():
+            metrics.postprocess_seconds.observe(seconds, stage=stage)
+
+        if path is None:
+            self.skipped += 1
+            return None
+
+        self.processed += 1
+        await self._remember(track.id, path)
+        return path
+
+    def stats(self):
+        return {
+            "available": self.available,
+            "files": len(self._files or ()),
+            "disk_bytes": self._disk_bytes,
+            "hits": self.hits,
+            "processed": self.processed,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "evictions": self.evictions,
+        }
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _remember(self, track_id, path):
+        if self._files is None:
+            self._files, self._disk_bytes = await asyncio.to_thread(self._scan)
+        self._files[track_id] = path
+        self._files.move_to_end(track_id)
+        self._disk_bytes += os.path.getsize(path)
+        while self._disk_bytes > self.disk_limit and len(self._files) > 1:
+            # Самые давно использованные файлы вытесняются; только что обработанный остается
+            _, evicted = self._files.popitem(last=False)
+            try:
+                self._disk_bytes -= os.path.getsize(evicted)
+                os.remove(evicted)
+            except FileNotFoundError:
+                pass
+            self.evictions += 1
+
+    def _scan(self):
+        """Файлы, обработанные до перезапуска, от старых к новым"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            name, extension = os.path.splitext(entry.name)
+            if extension in AUDIO_EXTENSIONS and name.isdigit():
+                entries.append((entry.stat().st_mtime, int(name), entry.path, entry.stat().st_size))
+        entries.sort()
+        files = OrderedDict((track_id, path) for _, track_id, path, _ in entries)
+        return files, sum(size for *_, size in entries)
@@ -0,0 +1,125 @@
+import asyncio
+import os
+from collections import OrderedDict
+
+from loguru import logger
+
+
+class Prefetcher:
+    """Заранее готовит треки, которые пользователь скорее всего выберет
+
+    Для первых треков выдачи в фоне получаются ссылки на аудиопоток (они
+    остаются в кэше StreamResolver). Популярные треки, которые выбирают
+    часто, дополнительно загружаются в служебный чат PREFETCH_CHAT_ID, чтобы
+    следующий выбор отправлялся по file_id. Предзагрузка уступает место
+    пользовательским загрузкам и отменяется вместе с вытесненной сессией.
+    """
+
+    def __init__(self, scheduler, resolve, is_cached, warm=None):
+        self.enabled = os.getenv("PREFETCH_ENABLED", "0") == "1"
+        self.top_n = int(os.getenv("PREFETCH_TOP_N", "3"))
+        self.popular_min = int(os.getenv("PREFETCH_POPULAR_MIN", "3"))
+        self.max_tracked = int(os.getenv("PREFETCH_TRACKED_MAX", "10000"))
+
+        self.scheduler = scheduler
+        # resolve(track_id) - получает ссылку на поток, is_cached(track_id) - есть ли file_id,
+        # warm(track) - загружает трек в служебный чат
+        self.resolve = resolve
+        self.is_cached = is_cached
+        self.warm = warm if os.getenv("PREFETCH_CHAT_ID") else None
+
+        self._semaphore = asyncio.Semaphore(int(os.getenv("PREFETCH_CONCURRENCY", "2")))
+        # search_id -> задача предзагрузки
+        self._tasks = {}
+        # ID треков, для которых ссылка уже получена заранее
+        self._prefetched = OrderedDict()
+        # ID трека -> число выборов пользователями
+        self._selections = OrderedDict()
+
+        self.resolved = 0
+        self.skipped_busy = 0
+        self.warmed = 0
+        self.cancelled = 0
+        self.selections = 0
+        self.hits = 0
+
+    def schedule(self, results):
+        """Запускает предзагрузку для новой выдачи"""
+        if not self.enabled or self.top_n <= 0:
+            return
+        self.cancel(results.search_id)
+        task = asyncio.create_task(self._prefetch(results.tracks[:self.top_n]))
+        self._tasks[results.search_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(results.search_id, None))
+
+    def cancel(self, search_id):
+        """Отменяет предзагрузку вытесненной или удаленной сессии"""
+        task = self._tasks.pop(search_id, None)
+        if task is not None and not task.done():
+            task.cancel()
+            self.cancelled += 1
+
+    def record_selection(self, track_id):
+        """Учитывает выбор трека: доля выборов среди заранее подготовленных треков и популярность"""
+        self.selections += 1
+        if track_id in self._prefetched:
+            self.hits += 1
+        self._remember(self._selections, track_id, self._selections.get(track_id, 0) + 1)
+
+    async def close(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "active": len(self._tasks),
+            "resolved": self.resolved,
+            "skipped_busy": self.skipped_busy,
+            "warmed": self.warmed,
+            "cancelled": self.cancelled,
+            "selections": self.selections,
+            "hit_ratio": self.hits / self.selections if self.selections else 0.0,
+        }
+
+    async def _prefetch(self, tracks):
+        for track in tracks:
+            if self.is_cached(track.id):
+                continue
+            # Пользовательские загрузки важнее - не нагружаем SoundCloud лишними запросами
+            if self.scheduler.is_busy():
+                self.skipped_busy += 1
+                return
+
+            async with self._semaphore:
+                try:
+                    if not await self.resolve(track.id):
+                        continue
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.warning(f"Не удалось заранее получить ссылку на трек {track.id}: {e}")
+                    continue
+            self.resolved += 1
+            self._remember(self._prefetched, track.id, True)
+
+            if self.warm is not None and self._selections.get(track.id, 0) >= self.popular_min:
+                ticket = self.scheduler.submit_background(track.id, lambda track=track: self._warm(track))
+                if ticket is not None:
+                    logger.info(f"Популярный трек {track.id} поставлен на фоновую загрузку")
+
+    async def _warm(self, track):
+        # Трек могли загрузить, пока заявка ждала в очереди
+        if self.is_cached(track.id):
+            return True
+        await self.warm(track)
+        self.warmed += 1
+        return True
+
+    def _remember(self, entries, key, value):
+        entries[key] = value
+        entries.move_to_end(key)
+        while len(entries) > self.max_tracked:
+            entries.popitem(last=False)
@@ -0,0 +1,113 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# Сколько кадров стека сохраняется на выборку и на задачу в дампе
+STACK_LIMIT = 40
+# Шаг замера задержки цикла событий, секунд
+LAG_INTERVAL = 0.01
+
+
+def format_frame(frame):
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}:{frame.f_lineno}"
+
+
+def dump_tasks():
+    """Текстовый дамп задач asyncio: имя, корутина и место, где каждая задача ждет"""
+    tasks = sorted(asyncio.all_tasks(), key=lambda task: task.get_name())
+    lines = [f"Задач asyncio: {len(tasks)}", ""]
+    for task in tasks:
+        coro = task.get_coro()
+        lines.append(f"{task.get_name()}: {getattr(coro, '__qualname__', coro)}")
+        # get_stack возвращает кадры от внешнего к внутреннему, где задача сейчас ждет
+        for frame in task.get_stack(limit=STACK_LIMIT):
+            lines.append(f"    {format_frame(frame)}")
+    return "\n".join(lines)
+
+
+class LoopProfiler:
+    """Сэмплирующий профилировщик потока цикла событий
+
+    Отдельный поток каждые interval секунд снимает стек потока цикла
+    событий (sys._current_frames), а корутина в цикле замеряет, насколько
+    позже заданного просыпается asyncio.sleep - это задержка цикла. Стеки
+    выборок, пришедшихся на большие задержки, показывают, что блокирует
+    цикл. В отчете - сводка по задержкам, самые частые функции и стеки в
+    свернутом формате (collapsed stacks) для flamegraph.pl и speedscope.
+    Одновременно работает не больше одного профилирования.
+    """
+
+    def __init__(self, interval=None, max_seconds=None):
+        self.interval = interval or float(os.getenv("PROFILE_INTERVAL", "0.005"))
+        self.max_seconds = max_seconds or float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+        self.running = False
+
+    async def profile(self, seconds):
+        """Профилирует seconds секунд (не больше max_seconds) и возвращает текстовый отчет"""
+        if self.running:
+            raise RuntimeError("Профилирование уже идет")
+        seconds = min(max(seconds, 1), self.max_seconds)
+        self.running = True
+
+        loop_thread = threading.get_ident()
+        stacks = Counter()
+        stop = threading.Event()
+
+        def sample():
+            while not stop.wait(self.interval):
+                frame = sys._current_frames().get(loop_thread)
+                stack = []
+                while frame is not None and len(stack) < STACK_LIMIT:
+                    stack.append(format_frame(frame))
+                    frame = frame.f_back
+                stacks[";".join(reversed(stack))] += 1
+
+        sampler = threading.Thread(target=sample, name="loop-profiler", daemon=True)
+        loop = asyncio.get_running_loop()
+        lags = []
+        started = time.monotonic()
+        sampler.start()
+        try:
+            deadline = loop.time() + seconds
+            while loop.time() < deadline:
+                expected = loop.time() + LAG_INTERVAL
+                await asyncio.sleep(LAG_INTERVAL)
+                lags.append(max(0.0, loop.time() - expected))
+        finally:
+            stop.set()
+            await asyncio.to_thread(sampler.join)
+            self.running = False
+        return self._report(stacks, lags, time.monotonic() - started)
+
+    def _report(self, stacks, lags, elapsed):
+        total = sum(stacks.values()) or 1
+        # Верхний кадр select/poll - цикл событий ждет ввода-вывода, т.е. простаивает
+        idle = sum(count for stack, count in stacks.items() if stack.rsplit(";", 1)[-1].startswith("selectors.py:"))
+        leaves = Counter()
+        for stack, count in stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+
+        lags.sort()
+        lines = [
+            f"Профилирование {elapsed:.1f} с, выборок: {total} (шаг {self.interval * 1000:.0f} мс)",
+            f"Цикл событий занят: {(total - idle) / total:.0%}",
+        ]
+        if lags:
+            p99 = lags[min(len(lags) - 1, int(len(lags) * 0.99))]
+            stalls = sum(1 for lag in lags if lag > 0.1)
+            lines.append(
+                f"Задержка цикла: p50 {lags[len(lags) // 2] * 1000:.1f} мс, p99 {p99 * 1000:.1f} мс, "
+                f"max {lags[-1] * 1000:.1f} мс, блокировок дольше 100 мс: {stalls}"
+            )
+
+        lines += ["", "Функции, в которых чаще всего находился цикл (без простоя):"]
+        for leaf, count in leaves.most_common(21):
+            if not leaf.startswith("selectors.py:"):
+                lines.append(f"{count / total:7.1%}  {leaf}")
+
+        lines += ["", "Стеки (collapsed stacks):"]
+        lines.extend(f"{stack} {count}" for stack, count in stacks.most_common())
+        return "\n".join(lines)
@@ -0,0 +1,152 @@
+import asyncio
+import os
+import re
+
+import aiohttp
+from loguru import logger
+
+from metrics import download_resumes_total
+
+CONTENT_RANGE_RE = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+
+class DownloadError(Exception):
+    """Файл не удалось скачать целиком"""
+
+
+def parse_content_range(value):
+    """(начало, конец включительно, полный размер или None) из Content-Range, либо None"""
+    match = CONTENT_RANGE_RE.fullmatch((value or "").strip())
+    if match is None:
+        return None
+    start, end, total = match.groups()
+    return int(start), int(end), None if total == "*" else int(total)
+
+
+def write_at(file, offset, data):
+    file.seek(offset)
+    file.write(data)
+
+
+async def fetch_part(session, url, file, start, end, retries, timeout, chunk_size, response=None):
+    """Скачивает байты [start, end) в файл по тем же смещениям
+
+    После обрыва следующая попытка запрашивает только недостающий хвост
+    части. response - уже открытый ответ на первую попытку (первая часть
+    приходит в ответе на пробный запрос).
+    """
+    offset = start
+    delay = 0.5
+    for attempt in range(1, retries + 1):
+        try:
+            if response is None:
+                headers = {"Range": f"bytes={offset}-{end - 1}"}
+                async with session.get(url, headers=headers, timeout=timeout) as retry_response:
+                    offset = await read_part(retry_response, file, offset, end, chunk_size)
+            else:
+                offset = await read_part(response, file, offset, end, chunk_size)
+            if offset == end:
+                return
+            logger.warning(f"Часть {start}-{end - 1} оборвалась на {offset} (попытка {attempt}/{retries})")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Ошибка при загрузке части {start}-{end - 1} (попытка {attempt}/{retries}): {e!r}")
+        finally:
+            response = None
+
+        if attempt < retries:
+            download_resumes_total.inc()
+            await asyncio.sleep(delay)
+            delay *= 2
+
+    raise DownloadError(f"Не удалось загрузить байты {offset}-{end - 1}")
+
+
+async def read_part(response, file, offset, end, chunk_size):
+    """Пишет тело ответа на Range-запрос с offset. Возвращает смещение после последнего записанного байта"""
+    if response.status != 206:
+        raise DownloadError(f"Сервер ответил {response.status} на запрос части")
+    content_range = parse_content_range(response.headers.get("Content-Range"))
+    if content_range is None or content_range[0] != offset:
+        raise DownloadError(f"Сервер вернул не ту часть файла: {response.headers.get('Content-Range')}")
+
+    try:
+        async for chunk in response.content.iter_chunked(chunk_size):
+            if offset + len(chunk) > end:
+                raise DownloadError("Сервер отдал больше байт, чем запрошено")
+            write_at(file, offset, chunk)
+            offset += len(chunk)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        # Записанное сохраняется - следующая попытка продолжит с этого места
+        logger.debug(f"Обрыв на смещении {offset}: {e!r}")
+    return offset
+
+
+async def stream_body(response, file, max_size, chunk_size):
+    """Обычная загрузка одним потоком. Возвращает число байт"""
+    content_length = response.headers.get("Content-Length")
+    if content_length and int(content_length) > max_size:
+        raise DownloadError("Размер файла превышает лимит Telegram")
+
+    total_size = 0
+    async for chunk in response.content.iter_chunked(chunk_size):
+        total_size += len(chunk)
+        if total_size > max_size:
+            raise DownloadError("Размер файла превышает лимит Telegram")
+        file.write(chunk)
+
+    if content_length and total_size != int(content_length):
+        raise DownloadError(f"Получено {total_size} байт из {content_length}")
+    return total_size
+
+
+async def download_file(session, url, file, max_size, timeout, chunk_size,
+                        part_size=None, concurrency=None, retries=None):
+    """Скачивает url в file и возвращает размер; при неудаче бросает DownloadError
+
+    Первый запрос просит первые part_size байт. Если сервер поддерживает
+    Range (206 с полным размером в Content-Range), остальной файл
+    скачивается частями параллельно, не больше concurrency соединений;
+    оборванная часть докачивается с последнего записанного байта. Итог
+    сверяется с размером из Content-Range. Если Range не поддерживается
+    (200), файл скачивается одним потоком как раньше.
+    """
+    part_size = part_size or int(os.getenv("RANGE_PART_SIZE", str(1024 * 1024)))
+    concurrency = concurrency or int(os.getenv("RANGE_CONCURRENCY", "4"))
+    retries = retries or int(os.getenv("RANGE_RETRIES", "3"))
+
+    async with session.get(url, headers={"Range": f"bytes=0-{part_size - 1}"}, timeout=timeout) as response:
+        if response.status == 200:
+            return await stream_body(response, file, max_size, chunk_size)
+        if response.status != 206:
+            raise DownloadError(f"Статус: {response.status}")
+
+        content_range = parse_content_range(response.headers.get("Content-Range"))
+        if content_range is None or content_range[0] != 0 or content_range[2] is None:
+            raise DownloadError(f"Неподдерживаемый Content-Range: {response.headers.get('Content-Range')}")
+        total = content_range[2]
+        if total > max_size:
+            raise DownloadError("Размер файла превышает лимит Telegram")
+
+        first_end = content_range[1] + 1
+        parts = [(start, min(start + part_size, total)) for start in range(first_end, total, part_size)]
+        # Первая часть уже идет в этом ответе и занимает одно из соединений
+        semaphore = asyncio.Semaphore(max(1, concurrency - 1))
+
+        async def fetch_limited(start, end):
+            async with semaphore:
+                await fetch_part(session, url, file, start, end, retries, timeout, chunk_size)
+
+        tasks = [asyncio.create_task(fetch_limited(start, end)) for start, end in parts]
+        try:
+            await fetch_part(session, url, file, 0, first_end, retries, timeout, chunk_size, response=response)
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    file.seek(0, os.SEEK_END)
+    if file.tell() != total:
+        raise DownloadError(f"Размер файла {file.tell()} не совпадает с заявленным {total}")
+    return total
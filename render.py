@@ -0,0 +1,140 @@
+import html
+import os
+from collections import OrderedDict
+
+from aiogram import types
+
+from callbacks import DownloadPageCallback, NoopCallback, PageCallback, TrackCallback
+
+TRACKS_PER_PAGE = 10
+BUTTONS_PER_ROW = 5
+
+
+def format_duration(duration_ms):
+    duration_sec = duration_ms // 1000
+    return f"{duration_sec // 60}:{duration_sec % 60:02d}"
+
+
+def render_header(query):
+    # Формируем заголовок без приписки "Поиск:" для похожих треков, топа и плейлистов
+    if query.startswith("Похожие на") or query.startswith("💿 ") or query == "🔥 Топ треков":
+        return f"<b>{html.escape(query, quote=False)}</b>\n\n"
+    return f"🎵 <b>Поиск:</b> {html.escape(query, quote=False)}\n\n"
+
+
+def render_page(search_id, tracks, header, page, total_pages):
+    """Текст и клавиатура одной страницы результатов"""
+    start_idx = (page - 1) * TRACKS_PER_PAGE
+    end_idx = min(start_idx + TRACKS_PER_PAGE, len(tracks))
+
+    lines = [header]
+    buttons = []
+    for i in range(start_idx, end_idx):
+        track = tracks[i]
+        track_number = i - start_idx + 1
+        title = html.escape(track.title or "Без названия", quote=False)
+        artist = html.escape(track.artist or "Неизвестный", quote=False)
+        lines.append(f"{track_number}. <b>{artist}</b> - {title} [{format_duration(track.duration)}]\n")
+        buttons.append(types.InlineKeyboardButton(
+            text=str(track_number),
+            callback_data=TrackCallback(search_id=search_id, index=i, track_id=track.id).pack()
+        ))
+
+    # Кнопки выбора трека по 5 в ряд
+    keyboard = [buttons[i:i + BUTTONS_PER_ROW] for i in range(0, len(buttons), BUTTONS_PER_ROW)]
+    if len(buttons) > 1:
+        keyboard.append([types.InlineKeyboardButton(
+            text="⬇️ Скачать страницу",
+            callback_data=DownloadPageCallback(search_id=search_id, page=page).pack()
+        )])
+
+    # Навигация с нумерацией страниц
+    nav_buttons = []
+    if page > 1:
+        nav_buttons.append(types.InlineKeyboardButton(
+            text="⬅️",
+            callback_data=PageCallback(search_id=search_id, page=page - 1).pack()
+        ))
+    nav_buttons.append(types.InlineKeyboardButton(
+        text=f"📄 {page}/{total_pages}",
+        callback_data=NoopCallback().pack()
+    ))
+    if page < total_pages:
+        nav_buttons.append(types.InlineKeyboardButton(
+            text="➡️",
+            callback_data=PageCallback(search_id=search_id, page=page + 1).pack()
+        ))
+    keyboard.append(nav_buttons)
+
+    return "".join(lines), types.InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+def render_pages(results):
+    """Все страницы результатов поиска"""
+    total_pages = max(1, (len(results.tracks) + TRACKS_PER_PAGE - 1) // TRACKS_PER_PAGE)
+    header = render_header(results.query)
+    return [
+        render_page(results.search_id, results.tracks, header, page, total_pages)
+        for page in range(1, total_pages + 1)
+    ]
+
+
+class RenderedSearch:
+    """Готовые страницы поиска и номер страницы, которая сейчас показана в сообщении"""
+
+    __slots__ = ("pages", "shown_page")
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.shown_page = None
+
+
+class PageCache:
+    """LRU-кэш отрисованных страниц результатов поиска"""
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries or int(os.getenv("PAGE_CACHE_MAX", "2000"))
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.skipped_edits = 0
+
+    def get(self, results):
+        """Возвращает страницы поиска, отрисовывая их один раз при первом обращении"""
+        rendered = self._entries.get(results.search_id)
+        if rendered is not None:
+            self.hits += 1
+            self._entries.move_to_end(results.search_id)
+            return rendered
+
+        self.misses += 1
+        rendered = RenderedSearch(render_pages(results))
+        self._entries[results.search_id] = rendered
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return rendered
+
+    def peek(self, search_id):
+        """Уже отрисованные страницы поиска или None - без обращения к сессии"""
+        rendered = self._entries.get(search_id)
+        if rendered is not None:
+            self.hits += 1
+            self._entries.move_to_end(search_id)
+        return rendered
+
+    def forget(self, search_id):
+        self._entries.pop(search_id, None)
+
+    def forget_shown(self, search_id):
+        """Сообщение с результатами изменено другим текстом - следующую страницу нужно отправить заново"""
+        rendered = self._entries.get(search_id)
+        if rendered is not None:
+            rendered.shown_page = None
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "skipped_edits": self.skipped_edits,
+        }
@@ -0,0 +1,300 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+
+from loguru import logger
+
+from metrics import queue_wait_seconds
+
+
+class QuotaExceeded(Exception):
+    """У пользователя слишком много незавершенных загрузок"""
+
+
+class AlreadyQueued(Exception):
+    """Пользователь уже ждет загрузку этого трека"""
+
+
+class Ticket:
+    """Заявка пользователя на загрузку трека"""
+
+    __slots__ = ("user_id", "key", "job", "on_position", "primary", "followers", "last_position", "queued_at")
+
+    def __init__(self, user_id, key, job, on_position=None):
+        self.user_id = user_id
+        self.key = key
+        self.job = job
+        self.on_position = on_position
+        # Заявка, к загрузке которой присоединилась эта (тот же трек у другого пользователя)
+        self.primary = None
+        self.followers = []
+        self.last_position = None
+        self.queued_at = time.monotonic()
+
+
+class DownloadScheduler:
+    """Пул загрузок с честной очередью между пользователями
+
+    Одновременно выполняется не больше workers загрузок. Очередь обходится по
+    кругу: каждый пользователь получает по одной загрузке за проход, поэтому
+    один пользователь не может занять все места. Повторный запрос трека,
+    который уже загружается, не ставится в очередь, а ждет первую загрузку и
+    затем выполняется сразу (трек к этому моменту уже есть в кэше file_id).
+
+    Фоновые заявки (предзагрузка) выполняются, только когда очереди
+    пользователей пусты, и занимают не больше background_limit воркеров.
+    """
+
+    def __init__(self, workers=None, per_user=None):
+        self.workers = workers or int(os.getenv("DOWNLOAD_WORKERS", "8"))
+        self.per_user = per_user or int(os.getenv("DOWNLOAD_PER_USER", "2"))
+        self.notify_interval = float(os.getenv("QUEUE_NOTIFY_INTERVAL", "3"))
+        self.background_limit = int(os.getenv("DOWNLOAD_BACKGROUND_WORKERS", "1"))
+
+        # user_id -> deque заявок; порядок ключей задает очередность обхода
+        self._queues = OrderedDict()
+        self._background = deque()
+        self._background_running = 0
+        # key -> заявка, которая загружает трек сейчас или стоит в очереди
+        self._primary = {}
+        self._user_tickets = {}
+        self._pending = asyncio.Event()
+        self._tasks = []
+        self._follower_tasks = set()
+
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.deduplicated = 0
+        self.rejected = 0
+
+    async def start(self):
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+        self._tasks.append(asyncio.create_task(self._notify_loop()))
+        logger.info(f"Планировщик загрузок запущен: {self.workers} воркеров, {self.per_user} загрузки на пользователя")
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def submit(self, user_id, key, job, on_position=None):
+        """Ставит загрузку в очередь. job - корутинная функция, возвращающая True при успехе"""
+        active = self._user_tickets.get(user_id, 0)
+        if active >= self.per_user:
+            self.rejected += 1
+            raise QuotaExceeded(f"У пользователя {user_id} уже {active} загрузки")
+
+        primary = self._primary.get(key)
+        if primary is not None and primary in self._background:
+            # Трек ждет фоновой загрузки - пользователь забирает его в обычную очередь
+            self._background.remove(primary)
+            primary = None
+        if primary is not None and any(
+            t.user_id == user_id for t in (primary, *primary.followers)
+        ):
+            raise AlreadyQueued(f"Трек {key} уже загружается для пользователя {user_id}")
+
+        ticket = Ticket(user_id, key, job, on_position)
+        self._user_tickets[user_id] = active + 1
+
+        if primary is not None:
+            ticket.primary = primary
+            primary.followers.append(ticket)
+            self.deduplicated += 1
+        else:
+            self._enqueue(ticket)
+        return ticket
+
+    def submit_background(self, key, job):
+        """Ставит фоновую загрузку с низким приоритетом. Возвращает None, если трек уже в работе"""
+        if key in self._primary:
+            return None
+        ticket = Ticket(None, key, job)
+        self._primary[key] = ticket
+        self._background.append(ticket)
+        self._update_pending()
+        return ticket
+
+    def position(self, ticket):
+        """Позиция в очереди: 0 - загрузка уже выполняется"""
+        if ticket.primary is not None:
+            ticket = ticket.primary
+
+        queue = self._queues.get(ticket.user_id)
+        if not queue or ticket not in queue:
+            return 0
+
+        # Заявка стоит в проходе номер depth; впереди все заявки предыдущих
+        # проходов и заявки этого прохода у пользователей раньше по кругу
+        depth = queue.index(ticket)
+        ahead = 0
+        before = True
+        for user_id, user_queue in self._queues.items():
+            if user_id == ticket.user_id:
+                before = False
+            ahead += min(len(user_queue), depth)
+            if before and len(user_queue) > depth:
+                ahead += 1
+        return ahead + 1
+
+    def queued(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def is_busy(self):
+        """Пользовательские загрузки занимают воркеры или ждут в очереди"""
+        return bool(self._queues) or self.running - self._background_running >= self.workers - self.background_limit
+
+    async def drain(self, timeout=None):
+        """Ждет завершения всех поставленных загрузок"""
+        timeout = timeout or float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "60"))
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        # Фоновые загрузки, которые еще не начались, при остановке не нужны
+        while self._background:
+            self._primary.pop(self._background.popleft().key, None)
+        self._update_pending()
+        while self._primary or self._follower_tasks or self.running:
+            if loop.time() >= deadline:
+                logger.warning(f"Не дождались завершения {self.running + self.queued()} загрузок")
+                return False
+            await asyncio.sleep(0.2)
+        return True
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "running": self.running,
+            "queued": self.queued(),
+            "background_running": self._background_running,
+            "background_queued": len(self._background),
+            "completed": self.completed,
+            "failed": self.failed,
+            "deduplicated": self.deduplicated,
+            "rejected": self.rejected,
+        }
+
+    def _enqueue(self, ticket):
+        self._primary[ticket.key] = ticket
+        self._queues.setdefault(ticket.user_id, deque()).append(ticket)
+        self._update_pending()
+
+    def _update_pending(self):
+        has_work = bool(self._queues) or (
+            bool(self._background) and self._background_running < self.background_limit
+        )
+        if has_work:
+            self._pending.set()
+        else:
+            self._pending.clear()
+
+    def _next_ticket(self):
+        if not self._queues:
+            ticket = self._background.popleft()
+            self._background_running += 1
+            self._update_pending()
+            return ticket
+
+        user_id, queue = next(iter(self._queues.items()))
+        ticket = queue.popleft()
+        if queue:
+            # Пользователь уходит в конец круга
+            self._queues.move_to_end(user_id)
+        else:
+            del self._queues[user_id]
+        self._update_pending()
+        return ticket
+
+    def _release(self, ticket):
+        if ticket.user_id is None:
+            self._background_running -= 1
+            self._update_pending()
+            return
+        left = self._user_tickets.get(ticket.user_id, 1) - 1
+        if left > 0:
+            self._user_tickets[ticket.user_id] = left
+        else:
+            self._user_tickets.pop(ticket.user_id, None)
+
+    async def _run(self, ticket):
+        try:
+            return bool(await ticket.job())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка загрузки {ticket.key}: {e}")
+            return False
+
+    async def _worker(self):
+        while True:
+            await self._pending.wait()
+            if not self._pending.is_set():
+                continue
+
+            ticket = self._next_ticket()
+            if ticket.user_id is not None:
+                queue_wait_seconds.observe(time.monotonic() - ticket.queued_at)
+            self.running += 1
+            try:
+                success = await self._run(ticket)
+            finally:
+                self.running -= 1
+                self._primary.pop(ticket.key, None)
+                self._release(ticket)
+
+            if success:
+                self.completed += 1
+            else:
+                self.failed += 1
+            self._dispatch_followers(ticket, success)
+
+    def _dispatch_followers(self, ticket, success):
+        followers = ticket.followers
+        ticket.followers = []
+        if not followers:
+            return
+
+        if not success:
+            # Первая загрузка не удалась - следующий ожидающий загружает трек сам
+            primary, *rest = followers
+            primary.primary = None
+            primary.followers = rest
+            for follower in rest:
+                follower.primary = primary
+            self._enqueue(primary)
+            return
+
+        for follower in followers:
+            follower.primary = None
+            task = asyncio.create_task(self._run_follower(follower))
+            self._follower_tasks.add(task)
+            task.add_done_callback(self._follower_tasks.discard)
+
+    async def _run_follower(self, ticket):
+        try:
+            await self._run(ticket)
+        finally:
+            self._release(ticket)
+
+    async def _notify_loop(self):
+        """Периодически сообщает ожидающим пользователям их позицию в очереди"""
+        while True:
+            await asyncio.sleep(self.notify_interval)
+            tickets = [ticket for queue in self._queues.values() for ticket in queue]
+            tickets += [f for ticket in tickets for f in ticket.followers]
+            for ticket in tickets:
+                if ticket.on_position is None:
+                    continue
+                # Пока ждали правку предыдущей заявки, эта могла уже начаться: позиция 0
+                # затерла бы статус загрузки
+                position = self.position(ticket)
+                if position == 0 or position == ticket.last_position:
+                    continue
+                ticket.last_position = position
+                try:
+                    await ticket.on_position(position)
+                except Exception as e:
+                    logger.error(f"Не удалось обновить позицию в очереди: {e}")
@@ -0,0 +1,125 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+
+def normalize_query(query):
+    """Приводит запрос к виду для ключа кэша: регистр и лишние пробелы не важны"""
+    return " ".join(query.lower().split())
+
+
+class SearchCache:
+    """TTL-кэш ответов SoundCloud с объединением одинаковых параллельных запросов"""
+
+    def __init__(self, ttl=None, max_entries=None):
+        self.ttl = ttl or float(os.getenv("SEARCH_CACHE_TTL", "600"))
+        self.max_entries = max_entries or int(os.getenv("SEARCH_CACHE_MAX", "500"))
+
+        # key -> (expires_at, tracks)
+        self._entries = OrderedDict()
+        # key -> Future запроса, который уже выполняется
+        self._in_flight = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    async def get_or_fetch(self, key, fetch, ttl=None):
+        """Возвращает закэшированный результат или вызывает fetch() один раз на все ожидающие запросы"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return value
+            del self._entries[key]
+
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            value = await fetch()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение уже передано ожидающим, помечаем его как полученное
+            future.exception()
+            raise
+        else:
+            self.put(key, value, ttl)
+            future.set_result(value)
+            return value
+        finally:
+            del self._in_flight[key]
+
+    def get(self, key):
+        """Возвращает значение без запроса к SoundCloud или None"""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value, ttl=None):
+        self._entries[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def snapshot(self, encode=None):
+        """Непросроченные записи для снимка: [ключ, срок истечения по часам, значение]
+
+        Сроки переводятся из time.monotonic() во время по часам: monotonic
+        после перезапуска процесса отсчитывается заново.
+        """
+        now = time.monotonic()
+        wall = time.time()
+        return [
+            [key, wall + expires_at - now, encode(value) if encode else value]
+            for key, (expires_at, value) in self._entries.items()
+            if expires_at > now
+        ]
+
+    def restore(self, entries):
+        """Добавляет записи снимка (значения уже разобраны). Возвращает число восстановленных
+
+        Записи, полученные после старта, новее снимка и не перезаписываются;
+        восстановленные считаются самыми давними и вытесняются первыми.
+        """
+        now = time.monotonic()
+        wall = time.time()
+        restored = 0
+        for key, expires, value in reversed(entries):
+            ttl = expires - wall
+            if ttl <= 0 or key in self._entries:
+                continue
+            self._entries[key] = (now + ttl, value)
+            self._entries.move_to_end(key, last=False)
+            restored += 1
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            restored -= 1
+        return restored
+
+    def stats(self):
+        total = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_ratio": (self.hits + self.coalesced) / total if total else 0.0,
+        }
@@ -0,0 +1,407 @@
+import asyncio
+import json
+import os
+import secrets
+import sys
+import time
+from collections import OrderedDict
+
+from loguru import logger
+
+
+def new_search_id():
+    """Короткий случайный ID поиска: 8 символов base64url (48 бит) вместо 36 символов UUID"""
+    return secrets.token_urlsafe(6)
+
+
+class TrackInfo:
+    """Компактная запись трека: только поля, которые использует бот"""
+
+    __slots__ = ("id", "title", "artist", "duration", "artwork_url", "permalink_url", "playback_count")
+
+    def __init__(self, id, title, artist, duration, artwork_url, permalink_url, playback_count=0):
+        self.id = id
+        self.title = title
+        self.artist = artist
+        self.duration = duration
+        self.artwork_url = artwork_url
+        self.permalink_url = permalink_url
+        # Нужно только для ранжирования в локальном индексе, в сессии не сохраняется
+        self.playback_count = playback_count
+
+    @classmethod
+    def from_api(cls, track):
+        """Создает запись из JSON трека SoundCloud"""
+        return cls(
+            id=track.get("id"),
+            title=track.get("title"),
+            artist=(track.get("user") or {}).get("username"),
+            duration=track.get("duration") or 0,
+            artwork_url=track.get("artwork_url"),
+            permalink_url=track.get("permalink_url"),
+            playback_count=track.get("playback_count") or 0
+        )
+
+    def to_record(self):
+        """Компактное представление для внешнего хранилища"""
+        return [self.id, self.title, self.artist, self.duration, self.artwork_url, self.permalink_url]
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(*record)
+
+    def size(self):
+        """Приблизительный объем памяти записи в байтах"""
+        return sys.getsizeof(self) + sum(
+            sys.getsizeof(getattr(self, name)) for name in self.__slots__
+        )
+
+
+class SearchSession:
+    """Результаты одного поиска, привязанные к сообщению с кнопками"""
+
+    __slots__ = (
+        "search_id", "tracks", "query", "current_page",
+        "message_id", "chat_id", "user_id", "created_at", "accessed_at"
+    )
+
+    def __init__(self, search_id, tracks, query, message_id, chat_id, user_id, current_page=1):
+        now = time.monotonic()
+        self.search_id = search_id
+        self.tracks = tracks
+        self.query = query
+        self.current_page = current_page
+        self.message_id = message_id
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.created_at = now
+        self.accessed_at = now
+
+    def to_record(self):
+        """Компактное представление сессии без search_id"""
+        return {
+            "q": self.query,
+            "p": self.current_page,
+            "m": self.message_id,
+            "c": self.chat_id,
+            "u": self.user_id,
+            "t": [track.to_record() for track in self.tracks],
+        }
+
+    @classmethod
+    def from_record(cls, search_id, data):
+        return cls(
+            search_id=search_id,
+            tracks=[TrackInfo.from_record(record) for record in data["t"]],
+            query=data["q"],
+            message_id=data["m"],
+            chat_id=data["c"],
+            user_id=data["u"],
+            current_page=data["p"]
+        )
+
+    def dumps(self):
+        """Сериализует сессию в компактный JSON"""
+        return json.dumps(self.to_record(), ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def loads(cls, search_id, raw):
+        return cls.from_record(search_id, json.loads(raw))
+
+    def size(self):
+        """Приблизительный объем памяти сессии в байтах"""
+        return (
+            sys.getsizeof(self)
+            + sys.getsizeof(self.tracks)
+            + sys.getsizeof(self.query)
+            + sum(track.size() for track in self.tracks)
+        )
+
+
+class SessionStorage:
+    """Интерфейс хранилища поисковых сессий"""
+
+    def __init__(self, ttl=None, per_user=None):
+        self.ttl = ttl or float(os.getenv("SESSION_TTL", "3600"))
+        self.per_user = per_user or int(os.getenv("SESSION_PER_USER", "3"))
+        # Вызывается с search_id, когда сессия удалена или вытеснена
+        self.on_evict = None
+        # Задача восстановления из снимка: пока она идет, промах ждет ее завершения
+        self.restoring = None
+
+    async def add(self, session):
+        """Сохраняет сессию и вытесняет лишние"""
+        raise NotImplementedError
+
+    async def get(self, search_id):
+        """Возвращает сессию или None, если она устарела или вытеснена"""
+        raise NotImplementedError
+
+    async def save(self, session):
+        """Сохраняет изменения сессии (например, текущую страницу)"""
+        raise NotImplementedError
+
+    async def remove(self, search_id):
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+    def snapshot(self):
+        """Сессии для снимка при остановке или None, если хранилище сохраняет их само"""
+        return None
+
+    def restore(self, records):
+        """Принимает сессии из снимка прошлого запуска"""
+
+    def _notify_evicted(self, search_id):
+        if self.on_evict is not None:
+            self.on_evict(search_id)
+
+    async def close(self):
+        pass
+
+
+class MemorySessionStorage(SessionStorage):
+    """Хранилище поисковых сессий в памяти процесса с ограничением размера, LRU и TTL"""
+
+    def __init__(self, max_sessions=None, ttl=None, per_user=None):
+        super().__init__(ttl=ttl, per_user=per_user)
+        self.max_sessions = max_sessions or int(os.getenv("SESSION_MAX", "5000"))
+
+        self._sessions = OrderedDict()
+        self._by_user = {}
+        self._bytes = 0
+        # Сессии из снимка прошлого запуска: search_id -> (время обращения по часам, запись).
+        # Разбираются при первом обращении, а не все сразу при старте
+        self._snapshot = {}
+
+        self.evicted_lru = 0
+        self.evicted_ttl = 0
+        self.evicted_user = 0
+        self.restored = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    async def add(self, session):
+        self._expire()
+
+        user_sessions = self._by_user.get(session.user_id, ())
+        while len(user_sessions) >= self.per_user:
+            self._remove(user_sessions[0])
+            self.evicted_user += 1
+
+        self._insert(session)
+
+    async def get(self, search_id):
+        session = self._sessions.get(search_id)
+        if session is None:
+            session = await self._from_snapshot(search_id)
+            if session is None:
+                return None
+
+        now = time.monotonic()
+        if now - session.accessed_at > self.ttl:
+            self._remove(search_id)
+            self.evicted_ttl += 1
+            return None
+
+        session.accessed_at = now
+        self._sessions.move_to_end(search_id)
+        return session
+
+    async def save(self, session):
+        # Сессия хранится по ссылке, изменения уже применены
+        pass
+
+    async def remove(self, search_id):
+        self._snapshot.pop(search_id, None)
+        if search_id in self._sessions:
+            self._remove(search_id)
+
+    def stats(self):
+        """Метрики памяти и вытеснения"""
+        return {
+            "backend": "memory",
+            "sessions": len(self._sessions),
+            "users": len(self._by_user),
+            "bytes": self._bytes,
+            "evicted_lru": self.evicted_lru,
+            "evicted_ttl": self.evicted_ttl,
+            "evicted_user": self.evicted_user,
+            "snapshot": len(self._snapshot),
+            "restored": self.restored,
+        }
+
+    def snapshot(self):
+        """[search_id, время последнего обращения по часам, запись] от давних сессий к недавним"""
+        now = time.monotonic()
+        wall = time.time()
+        deadline = wall - self.ttl
+        # Сессии из прошлого снимка, к которым так и не обратились, переносятся в следующий
+        records = [
+            [search_id, accessed, record]
+            for search_id, (accessed, record) in self._snapshot.items()
+            if accessed > deadline
+        ]
+        records.extend(
+            [search_id, wall - (now - session.accessed_at), session.to_record()]
+            for search_id, session in self._sessions.items()
+        )
+        return records
+
+    def restore(self, records):
+        deadline = time.time() - self.ttl
+        for search_id, accessed, record in records[-self.max_sessions:]:
+            if accessed > deadline and search_id not in self._sessions:
+                self._snapshot[search_id] = (accessed, record)
+
+    async def _from_snapshot(self, search_id):
+        if self.restoring is not None and not self.restoring.done():
+            await asyncio.shield(self.restoring)
+            # Пока шло восстановление, сессию мог разобрать параллельный запрос
+            session = self._sessions.get(search_id)
+            if session is not None:
+                return session
+
+        entry = self._snapshot.pop(search_id, None)
+        if entry is None:
+            return None
+        accessed, record = entry
+        idle = time.time() - accessed
+        if idle > self.ttl:
+            return None
+
+        session = SearchSession.from_record(search_id, record)
+        session.accessed_at = time.monotonic() - idle
+        self._expire()
+        self._insert(session, restored=True)
+        self.restored += 1
+        return session
+
+    def _expire(self):
+        # Сессии упорядочены по времени последнего обращения, устаревшие - в начале
+        deadline = time.monotonic() - self.ttl
+        while self._sessions:
+            search_id, session = next(iter(self._sessions.items()))
+            if session.accessed_at > deadline:
+                break
+            self._remove(search_id)
+            self.evicted_ttl += 1
+
+    def _insert(self, session, restored=False):
+        self._sessions[session.search_id] = session
+        user_sessions = self._by_user.setdefault(session.user_id, [])
+        if restored:
+            # Сессия из снимка старше текущих сессий пользователя: она не вытесняет
+            # их, а встает первой в очередь на вытеснение
+            user_sessions.insert(0, session.search_id)
+        else:
+            user_sessions.append(session.search_id)
+        self._bytes += session.size()
+
+        while len(self._sessions) > self.max_sessions:
+            oldest = next(iter(self._sessions))
+            self._remove(oldest)
+            self.evicted_lru += 1
+
+    def _remove(self, search_id):
+        session = self._sessions.pop(search_id)
+        self._bytes -= session.size()
+
+        user_sessions = self._by_user.get(session.user_id)
+        if user_sessions is not None:
+            try:
+                user_sessions.remove(search_id)
+            except ValueError:
+                logger.warning(f"Сессия {search_id} не найдена в списке пользователя")
+            if not user_sessions:
+                del self._by_user[session.user_id]
+        self._notify_evicted(search_id)
+
+
+class RedisSessionStorage(SessionStorage):
+    """Хранилище сессий в Redis, общее для нескольких процессов бота
+
+    client - объект с интерфейсом redis.asyncio.Redis (get, set, delete,
+    expire, rpush, lpop, llen), поэтому вместо Redis можно подставить
+    локальную заглушку с теми же методами (см. tests/fake_redis.py).
+    """
+
+    def __init__(self, client, prefix="hx", ttl=None, per_user=None):
+        super().__init__(ttl=ttl, per_user=per_user)
+        self.client = client
+        self.prefix = prefix
+        self.evicted_user = 0
+        self.misses = 0
+
+    def _session_key(self, search_id):
+        return f"{self.prefix}:search:{search_id}"
+
+    def _user_key(self, user_id):
+        return f"{self.prefix}:user:{user_id}"
+
+    async def add(self, session):
+        ttl = int(self.ttl)
+        await self.client.set(self._session_key(session.search_id), session.dumps(), ex=ttl)
+
+        user_key = self._user_key(session.user_id)
+        await self.client.rpush(user_key, session.search_id)
+        await self.client.expire(user_key, ttl)
+
+        while await self.client.llen(user_key) > self.per_user:
+            oldest = await self.client.lpop(user_key)
+            if oldest is None:
+                break
+            if isinstance(oldest, bytes):
+                oldest = oldest.decode()
+            await self.client.delete(self._session_key(oldest))
+            self.evicted_user += 1
+            self._notify_evicted(oldest)
+
+    async def get(self, search_id):
+        key = self._session_key(search_id)
+        raw = await self.client.get(key)
+        if raw is None:
+            self.misses += 1
+            return None
+
+        # Продлеваем TTL при каждом обращении
+        await self.client.expire(key, int(self.ttl))
+        return SearchSession.loads(search_id, raw)
+
+    async def save(self, session):
+        await self.client.set(self._session_key(session.search_id), session.dumps(), ex=int(self.ttl))
+
+    async def remove(self, search_id):
+        await self.client.delete(self._session_key(search_id))
+        self._notify_evicted(search_id)
+
+    def stats(self):
+        return {
+            "backend": "redis",
+            "evicted_user": self.evicted_user,
+            "misses": self.misses,
+        }
+
+    async def close(self):
+        close = getattr(self.client, "aclose", None) or getattr(self.client, "close", None)
+        if close is not None:
+            await close()
+
+
+def create_session_storage():
+    """Создает хранилище сессий по настройкам окружения"""
+    redis_url = os.getenv("REDIS_URL")
+    if not redis_url:
+        return MemorySessionStorage()
+
+    try:
+        import redis.asyncio as redis
+    except ImportError:
+        logger.error("REDIS_URL задан, но пакет redis не установлен, используется память процесса")
+        return MemorySessionStorage()
+
+    logger.info("Поисковые сессии хранятся в Redis")
+    return RedisSessionStorage(redis.from_url(redis_url))
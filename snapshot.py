@@ -0,0 +1,97 @@
+import asyncio
+import gzip
+import json
+import os
+import tempfile
+import time
+
+from loguru import logger
+
+from codec import loads
+
+# Меняется, когда меняется формат разделов; снимок другой версии игнорируется
+SNAPSHOT_VERSION = 1
+
+
+class Snapshot:
+    """Снимок сессий и горячих кэшей для перезапуска без холодного старта
+
+    При остановке то, что живет только в памяти процесса (поисковые сессии,
+    ответы SoundCloud, ссылки на поток), записывается в сжатый JSON. При
+    старте файл читается и разбирается в отдельном потоке: бот сразу
+    принимает апдейты, а записи появляются в кэшах по мере готовности.
+    Сроки жизни хранятся по часам, поэтому истекшее за время перезапуска
+    отбрасывается. Старше SNAPSHOT_MAX_AGE снимок не восстанавливается.
+    """
+
+    def __init__(self, path=None):
+        self.enabled = os.getenv("SNAPSHOT_ENABLED", "1") == "1"
+        self.path = path or os.getenv("SNAPSHOT_PATH", "data/snapshot.json.gz")
+        self.max_age = float(os.getenv("SNAPSHOT_MAX_AGE", "3600"))
+
+    async def load(self, decoders=None):
+        """Разделы снимка прошлого запуска или {}
+
+        decoders - {раздел: функция}: преобразование раздела выполняется в
+        том же потоке, что и чтение, а не в цикле событий.
+        """
+        if not self.enabled:
+            return {}
+        return await asyncio.to_thread(self._read, decoders or {})
+
+    async def save(self, sections):
+        """Записывает разделы; None (хранилище сохраняет данные само) пропускается"""
+        if not self.enabled:
+            return
+        sections = {name: data for name, data in sections.items() if data is not None}
+        await asyncio.to_thread(self._write, sections)
+
+    def _read(self, decoders):
+        started = time.monotonic()
+        try:
+            with gzip.open(self.path, "rb") as f:
+                data = loads(f.read())
+        except FileNotFoundError:
+            return {}
+        except (OSError, EOFError, ValueError) as e:
+            logger.warning(f"Снимок {self.path} поврежден и не будет восстановлен: {e}")
+            return {}
+
+        age = time.time() - data.get("saved_at", 0)
+        if data.get("version") != SNAPSHOT_VERSION or age > self.max_age:
+            logger.info(f"Снимок {self.path} устарел ({age:.0f} с) и не восстанавливается")
+            return {}
+
+        sections = data.get("sections") or {}
+        for name, decode in decoders.items():
+            if name in sections:
+                sections[name] = decode(sections[name])
+        logger.info(f"Снимок прочитан за {time.monotonic() - started:.2f} с (сохранен {age:.0f} с назад)")
+        return sections
+
+    def _write(self, sections):
+        started = time.monotonic()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        body = json.dumps(
+            {"version": SNAPSHOT_VERSION, "saved_at": time.time(), "sections": sections},
+            ensure_ascii=False, separators=(",", ":")
+        ).encode()
+        # Запись во временный файл и замена: оборванная запись не портит прошлый снимок.
+        # Имя уникально - процессы вебхука останавливаются одновременно и пишут в один каталог
+        fd, temp_path = tempfile.mkstemp(dir=directory or ".", prefix=".snapshot-")
+        try:
+            with os.fdopen(fd, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6) as f:
+                f.write(body)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            try:
+                os.unlink(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        logger.info(
+            f"Снимок записан за {time.monotonic() - started:.2f} с: "
+            f"{os.path.getsize(self.path) / 1024:.0f} КБ в {self.path}"
+        )
@@ -0,0 +1,245 @@
+import asyncio
+import os
+import time
+
+import aiohttp
+from loguru import logger
+
+from codec import loads
+from http_client import SoundCloudError, http
+
+# Ответы, которые означают проблему с конкретным client_id, а не с API
+CLIENT_ID_REJECTED = (401, 403)
+RATE_LIMITED = 429
+
+
+class CircuitOpen(SoundCloudError):
+    """Автомат семейства API разомкнут - запрос не выполняется"""
+
+    def __init__(self, family):
+        super().__init__(503)
+        self.family = family
+
+
+class CircuitBreaker:
+    """Размыкается после threshold ошибок подряд и пропускает пробный запрос через reset_timeout"""
+
+    def __init__(self, name, threshold=None, reset_timeout=None):
+        self.name = name
+        self.threshold = threshold or int(os.getenv("SOUNDCLOUD_BREAKER_THRESHOLD", "5"))
+        self.reset_timeout = reset_timeout or float(os.getenv("SOUNDCLOUD_BREAKER_RESET", "30"))
+        self.failures = 0
+        self.opened_at = None
+        self._probe = False
+
+        self.rejected = 0
+        self.trips = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        """Проверяет, можно ли выполнить запрос; при разомкнутом автомате сразу бросает CircuitOpen"""
+        state = self.state
+        if state == "closed":
+            return
+        if state == "half_open" and not self._probe:
+            # Один пробный запрос решает, замкнуть автомат или снова разомкнуть
+            self._probe = True
+            return
+        self.rejected += 1
+        raise CircuitOpen(self.name)
+
+    def success(self):
+        if self.opened_at is not None:
+            logger.info(f"SoundCloud {self.name}: автомат замкнут")
+        self.failures = 0
+        self.opened_at = None
+        self._probe = False
+
+    def failure(self):
+        self.failures += 1
+        if self._probe or (self.opened_at is None and self.failures >= self.threshold):
+            self.trips += 1
+            logger.warning(f"SoundCloud {self.name}: автомат разомкнут на {self.reset_timeout:.0f} с после {self.failures} ошибок")
+            self.opened_at = time.monotonic()
+            self._probe = False
+
+    def cancelled(self):
+        # Пробный запрос завершился, не дав ответа об API - следующий запрос станет пробным
+        self._probe = False
+
+    def stats(self):
+        return {"state": self.state, "failures": self.failures, "trips": self.trips, "rejected": self.rejected}
+
+
+class ClientIdStats:
+    __slots__ = ("requests", "rejections", "error_rate", "cooldown_until")
+
+    def __init__(self):
+        self.requests = 0
+        self.rejections = 0
+        # Экспоненциальное среднее доли ответов 401/403/429
+        self.error_rate = 0.0
+        self.cooldown_until = 0.0
+
+
+class ClientIdPool:
+    """Набор client_id SoundCloud с выбором самого здорового
+
+    Отклоненный ключ (401/403) надолго выводится из ротации, ключ, упершийся
+    в лимит (429), - на короткое время. Среди доступных выбирается ключ с
+    наименьшей долей отказов, при равенстве - по кругу.
+    """
+
+    def __init__(self, client_ids=None):
+        if client_ids is None:
+            raw = os.getenv("SOUNDCLOUD_CLIENT_IDS") or os.getenv("SOUNDCLOUD_CLIENT_ID") or ""
+            client_ids = [client_id.strip() for client_id in raw.split(",") if client_id.strip()]
+        self.client_ids = list(client_ids)
+        self.rejected_cooldown = float(os.getenv("SOUNDCLOUD_CLIENT_ID_COOLDOWN", "600"))
+        self.limited_cooldown = float(os.getenv("SOUNDCLOUD_RATE_LIMIT_COOLDOWN", "60"))
+        self._stats = {client_id: ClientIdStats() for client_id in self.client_ids}
+        self._turn = 0
+
+    def __bool__(self):
+        return bool(self.client_ids)
+
+    def pick(self, exclude=()):
+        candidates = [client_id for client_id in self.client_ids if client_id not in exclude]
+        if not candidates:
+            return None
+
+        now = time.monotonic()
+        available = [client_id for client_id in candidates if self._stats[client_id].cooldown_until <= now]
+        if not available:
+            # Все ключи на паузе - берем тот, чья пауза закончится раньше
+            return min(candidates, key=lambda client_id: self._stats[client_id].cooldown_until)
+
+        self._turn += 1
+        best = min(self._stats[client_id].error_rate for client_id in available)
+        healthiest = [client_id for client_id in available if self._stats[client_id].error_rate - best < 0.05]
+        return healthiest[self._turn % len(healthiest)]
+
+    def report(self, client_id, status):
+        stats = self._stats.get(client_id)
+        if stats is None:
+            return
+        stats.requests += 1
+        rejected = status in CLIENT_ID_REJECTED or status == RATE_LIMITED
+        stats.error_rate = stats.error_rate * 0.9 + (0.1 if rejected else 0.0)
+        if not rejected:
+            return
+
+        stats.rejections += 1
+        cooldown = self.rejected_cooldown if status in CLIENT_ID_REJECTED else self.limited_cooldown
+        stats.cooldown_until = time.monotonic() + cooldown
+        logger.warning(f"client_id ...{client_id[-4:]} получил {status}, исключен из ротации на {cooldown:.0f} с")
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            f"...{client_id[-4:]}": {
+                "requests": stats.requests,
+                "rejections": stats.rejections,
+                "error_rate": round(stats.error_rate, 3),
+                "cooling_down": stats.cooldown_until > now,
+            }
+            for client_id, stats in self._stats.items()
+        }
+
+
+class SoundCloudApi:
+    """Запросы к API SoundCloud через автоматы по семействам API и пул client_id"""
+
+    FAMILIES = ("api-v2", "api-mobi")
+
+    def __init__(self):
+        self.client_ids = ClientIdPool()
+        self.breakers = {family: CircuitBreaker(family) for family in self.FAMILIES}
+        # Короткие таймауты для JSON API: зависший запрос не должен держать воркер
+        self.timeout = aiohttp.ClientTimeout(
+            total=float(os.getenv("SOUNDCLOUD_API_TIMEOUT", "10")),
+            sock_connect=float(os.getenv("SOUNDCLOUD_CONNECT_TIMEOUT", "5"))
+        )
+
+    @property
+    def configured(self):
+        return bool(self.client_ids)
+
+    async def get_json(self, url, params=None, family="api-v2", decode=loads):
+        """GET с client_id; возвращает разобранный decode(body) ответ или бросает SoundCloudError"""
+        async def read(response):
+            return decode(await response.read())
+
+        return await self._request(url, params, family, read)
+
+    async def get_final_url(self, url, params=None, family="api-mobi"):
+        """GET с переходом по редиректам; возвращает итоговый URL без чтения тела"""
+        async def read(response):
+            return str(response.url)
+
+        return await self._request(url, params, family, read)
+
+    async def _request(self, url, params, family, read):
+        breaker = self.breakers[family]
+        breaker.allow()
+
+        tried = []
+        while True:
+            client_id = self.client_ids.pick(exclude=tried)
+            if client_id is None:
+                raise SoundCloudError(401)
+            tried.append(client_id)
+
+            try:
+                async with http.session.get(
+                    url,
+                    params={**(params or {}), "client_id": client_id},
+                    timeout=self.timeout
+                ) as response:
+                    status = response.status
+                    self.client_ids.report(client_id, status)
+                    if status == 200:
+                        result = await read(response)
+            except asyncio.CancelledError:
+                breaker.cancelled()
+                raise
+            except Exception:
+                # Сетевая ошибка или тело 200, которое не разбирается (HTML, капча) - сбой API.
+                # Любой выход без решения оставил бы пробный запрос занятым навсегда
+                breaker.failure()
+                raise
+
+            if status == 200:
+                breaker.success()
+                return result
+            if status in CLIENT_ID_REJECTED or status == RATE_LIMITED:
+                # Проблема в ключе - пробуем следующий; автомат считает только сбои API
+                if len(tried) < len(self.client_ids.client_ids):
+                    continue
+                if status == RATE_LIMITED:
+                    breaker.failure()
+                else:
+                    # Все ключи отклонены - об API это ничего не говорит, пробным станет следующий запрос
+                    breaker.cancelled()
+            elif status >= 500:
+                breaker.failure()
+            else:
+                # 404 и подобные - нормальный ответ API
+                breaker.success()
+            raise SoundCloudError(status)
+
+    def stats(self):
+        return {
+            "breakers": {family: breaker.stats() for family, breaker in self.breakers.items()},
+            "client_ids": self.client_ids.stats(),
+        }
+
+
+soundcloud = SoundCloudApi()
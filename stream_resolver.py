@@ -0,0 +1,200 @@
+import asyncio
+import base64
+import json
+import os
+import time
+from urllib.parse import parse_qs, urlparse
+
+from loguru import logger
+
+from http_client import SOUNDCLOUD_API_URL, SOUNDCLOUD_MOBILE_API_URL, SoundCloudError
+from metrics import stream_resolve_seconds
+from search_cache import SearchCache
+from soundcloud import soundcloud
+
+
+def signed_url_expiry(url):
+    """Время истечения подписанной ссылки CDN (unix time) или None"""
+    params = parse_qs(urlparse(url).query)
+
+    for name in ("Expires", "expires"):
+        if name in params:
+            try:
+                return int(params[name][0])
+            except ValueError:
+                return None
+
+    # CloudFront custom policy: срок действия лежит внутри base64 JSON
+    if "Policy" in params:
+        try:
+            raw = params["Policy"][0].replace("-", "+").replace("_", "=").replace("~", "/")
+            policy = json.loads(base64.b64decode(raw))
+            return int(policy["Statement"][0]["Condition"]["DateLessThan"]["AWS:EpochTime"])
+        except Exception:
+            return None
+
+    return None
+
+
+class StrategyStats:
+    """Счетчики попыток, успехов и задержки одной стратегии получения ссылки"""
+
+    __slots__ = ("attempts", "successes", "failures", "total_time")
+
+    def __init__(self):
+        self.attempts = 0
+        self.successes = 0
+        self.failures = 0
+        self.total_time = 0.0
+
+    def as_dict(self):
+        return {
+            "attempts": self.attempts,
+            "successes": self.successes,
+            "failures": self.failures,
+            "avg_time": self.total_time / self.attempts if self.attempts else 0.0,
+        }
+
+
+class StreamResolver:
+    """Получение прямой ссылки на аудиопоток трека с кэшированием"""
+
+    STRATEGIES = ("progressive", "hls", "mobile")
+
+    def __init__(self):
+        self.race = os.getenv("STREAM_RACE", "0") == "1"
+        # Запас до истечения подписи, чтобы ссылка не протухла во время загрузки
+        self.expiry_margin = int(os.getenv("STREAM_URL_EXPIRY_MARGIN", "60"))
+        self.default_url_ttl = int(os.getenv("STREAM_URL_TTL", "60"))
+
+        self.track_cache = SearchCache(
+            ttl=float(os.getenv("TRACK_CACHE_TTL", "3600")),
+            max_entries=int(os.getenv("TRACK_CACHE_MAX", "5000"))
+        )
+        self.url_cache = SearchCache(
+            ttl=self.default_url_ttl,
+            max_entries=int(os.getenv("STREAM_URL_CACHE_MAX", "5000"))
+        )
+        self._counters = {name: StrategyStats() for name in self.STRATEGIES}
+
+    async def resolve(self, track_id):
+        """Возвращает прямую ссылку на аудиофайл трека или None"""
+        url = self.url_cache.get(str(track_id))
+        if url:
+            return url
+
+        if self.race:
+            # Progressive и мобильный API запрашиваются одновременно, побеждает первый успешный
+            url = await self._first_valid([
+                self._run("progressive", track_id),
+                self._run("mobile", track_id),
+            ])
+            if not url:
+                url = await self._run("hls", track_id)
+        else:
+            for strategy in self.STRATEGIES:
+                url = await self._run(strategy, track_id)
+                if url:
+                    break
+
+        if url:
+            self.url_cache.put(str(track_id), url, ttl=self._url_ttl(url))
+        return url
+
+    def stats(self):
+        return {
+            "strategies": {name: counters.as_dict() for name, counters in self._counters.items()},
+            "track_cache": self.track_cache.stats(),
+            "url_cache": self.url_cache.stats(),
+        }
+
+    def snapshot(self):
+        """Кодировки треков и непросроченные ссылки на поток для снимка"""
+        return {"tracks": self.track_cache.snapshot(), "urls": self.url_cache.snapshot()}
+
+    def restore(self, data):
+        return self.track_cache.restore(data.get("tracks", [])) + self.url_cache.restore(data.get("urls", []))
+
+    def _url_ttl(self, url):
+        expires = signed_url_expiry(url)
+        if expires is None:
+            return self.default_url_ttl
+        return max(1, expires - int(time.time()) - self.expiry_margin)
+
+    async def _first_valid(self, coroutines):
+        tasks = [asyncio.create_task(coroutine) for coroutine in coroutines]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                url = await finished
+                if url:
+                    return url
+            return None
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _run(self, strategy, track_id):
+        stats = self._counters[strategy]
+        stats.attempts += 1
+        started = time.monotonic()
+        try:
+            url = await getattr(self, f"_resolve_{strategy}")(track_id)
+        except asyncio.CancelledError:
+            stats.attempts -= 1
+            raise
+        except Exception as e:
+            logger.warning(f"Стратегия {strategy} для трека {track_id} завершилась ошибкой: {e}")
+            url = None
+        elapsed = time.monotonic() - started
+        stats.total_time += elapsed
+        if url:
+            stats.successes += 1
+        else:
+            stats.failures += 1
+        stream_resolve_seconds.observe(elapsed, strategy=strategy, result="ok" if url else "fail")
+        return url
+
+    async def _get_transcodings(self, track_id):
+        """Варианты кодировки трека из веб-API (кэшируются)"""
+        async def fetch():
+            # Ошибка не кэшируется: следующая попытка снова обратится к API
+            track_data = await soundcloud.get_json(f"{SOUNDCLOUD_API_URL}/tracks/{track_id}")
+            return track_data.get("media", {}).get("transcodings", [])
+
+        return await self.track_cache.get_or_fetch(str(track_id), fetch)
+
+    async def _resolve_transcoding(self, track_id, protocols):
+        transcodings = await self._get_transcodings(track_id)
+        for t in transcodings:
+            if t.get("format", {}).get("protocol") not in protocols:
+                continue
+            stream_url = t.get("url")
+            if not stream_url:
+                continue
+            try:
+                stream_data = await soundcloud.get_json(stream_url)
+            except SoundCloudError:
+                continue
+            if stream_data.get("url"):
+                return stream_data["url"]
+        return None
+
+    async def _resolve_progressive(self, track_id):
+        return await self._resolve_transcoding(track_id, ("progressive",))
+
+    async def _resolve_hls(self, track_id):
+        return await self._resolve_transcoding(track_id, ("hls", "hls_secure"))
+
+    async def _resolve_mobile(self, track_id):
+        try:
+            data = await soundcloud.get_json(f"{SOUNDCLOUD_MOBILE_API_URL}/tracks/{track_id}", family="api-mobi")
+        except SoundCloudError:
+            return None
+
+        stream_url = data.get("stream_url")
+        if not stream_url:
+            return None
+        try:
+            return await soundcloud.get_final_url(stream_url, family="api-mobi")
+        except SoundCloudError:
+            return None
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Модули бота лежат в корне репозитория, как и для скриптов bench/; заглушки - рядом с тестами
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
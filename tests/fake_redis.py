@@ -0,0 +1,72 @@
+import time
+
+
+class FakeRedis:
+    """Локальная замена redis.asyncio.Redis для RedisSessionStorage
+
+    Поддерживает только используемые хранилищем команды. Как и настоящий
+    клиент без decode_responses, возвращает значения в bytes; сроки жизни
+    ключей (ex, expire) соблюдаются.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._expires = {}
+        self.closed = False
+
+    def _alive(self, key):
+        expires = self._expires.get(key)
+        if expires is not None and expires <= time.monotonic():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+
+    @staticmethod
+    def _encode(value):
+        return value if isinstance(value, bytes) else str(value).encode()
+
+    async def get(self, key):
+        return self._data[key] if self._alive(key) else None
+
+    async def set(self, key, value, ex=None):
+        self._data[key] = self._encode(value)
+        if ex is not None:
+            self._expires[key] = time.monotonic() + ex
+        else:
+            self._expires.pop(key, None)
+        return True
+
+    async def delete(self, *keys):
+        removed = 0
+        for key in keys:
+            if self._alive(key):
+                del self._data[key]
+                self._expires.pop(key, None)
+                removed += 1
+        return removed
+
+    async def expire(self, key, seconds):
+        if not self._alive(key):
+            return False
+        self._expires[key] = time.monotonic() + seconds
+        return True
+
+    async def rpush(self, key, *values):
+        items = self._data[key] if self._alive(key) else []
+        items.extend(self._encode(value) for value in values)
+        self._data[key] = items
+        return len(items)
+
+    async def lpop(self, key):
+        if not self._alive(key) or not self._data[key]:
+            return None
+        value = self._data[key].pop(0)
+        if not self._data[key]:
+            await self.delete(key)
+        return value
+
+    async def llen(self, key):
+        return len(self._data[key]) if self._alive(key) else 0
+
+    async def aclose(self):
+        self.closed = True
@@ -0,0 +1,66 @@
+import asyncio
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from sessions import TrackInfo
+
+
+@pytest.fixture(scope="module")
+def bot_module():
+    """bot.py с путями во временном каталоге; запросы к Telegram никуда не уходят"""
+    workdir = tempfile.mkdtemp(prefix="hx-test-")
+    os.environ.update({
+        "BOT_TOKEN": "123456:test-token",
+        "FILE_CACHE_PATH": os.path.join(workdir, "file_cache.sqlite3"),
+        "TRACK_INDEX_PATH": os.path.join(workdir, "track_index.sqlite3"),
+        "ARTWORK_DIR": os.path.join(workdir, "artwork"),
+        "DOWNLOAD_DIR": os.path.join(workdir, "downloads"),
+        "POSTPROCESS_DIR": os.path.join(workdir, "processed"),
+        "SNAPSHOT_PATH": os.path.join(workdir, "snapshot.json.gz"),
+    })
+    for name in ("REDIS_URL", "WEBHOOK_URL", "METRICS_PORT", "PREFETCH_CHAT_ID", "TELEGRAM_API_URL"):
+        os.environ.pop(name, None)
+    import bot
+    return bot
+
+
+def test_congested_outbound_queue_does_not_delay_download(bot_module, monkeypatch):
+    chat_id = 42
+    track = TrackInfo(777, "Трек", "Автор", 180000, None, "https://soundcloud.com/a/777")
+    results = SimpleNamespace(chat_id=chat_id, message_id=10, search_id="abc")
+    callback = SimpleNamespace(message=SimpleNamespace(chat=SimpleNamespace(id=chat_id)))
+    uploaded = None
+
+    async def upload_track(selected_track, target_chat_id, caption=None, reply_markup=None):
+        nonlocal uploaded
+        uploaded.set_result(time.monotonic())
+
+    monkeypatch.setattr(bot_module, "upload_track", upload_track)
+
+    async def scenario():
+        nonlocal uploaded
+        uploaded = asyncio.get_running_loop().create_future()
+        queue = bot_module.outbound_queue
+        # Чат на паузе после RetryAfter: правка статуса застревает в очереди
+        queue._bucket(chat_id).block(time.monotonic(), 60)
+        queue.start()
+        started = time.monotonic()
+        delivery = asyncio.create_task(
+            bot_module.deliver_track(callback, results, track, "", None, started, 1)
+        )
+        try:
+            upload_started = await asyncio.wait_for(asyncio.shield(uploaded), 1)
+            # Правка статуса так и не отправлена, а загрузка уже началась
+            assert queue.queued()
+        finally:
+            delivery.cancel()
+            await asyncio.gather(delivery, return_exceptions=True)
+            await queue.close()
+            await asyncio.gather(*bot_module.status_tasks, return_exceptions=True)
+        return upload_started - started
+
+    assert asyncio.run(scenario()) < 0.5
@@ -0,0 +1,36 @@
+import asyncio
+
+from scheduler import DownloadScheduler
+
+
+def test_notify_skips_ticket_started_during_previous_edit():
+    async def scenario():
+        scheduler = DownloadScheduler(workers=1, per_user=2)
+        scheduler.notify_interval = 0.05
+        positions = {}
+
+        async def job():
+            await asyncio.sleep(0.1)
+            return True
+
+        def on_position(key, delay):
+            async def show(position):
+                positions.setdefault(key, []).append(position)
+                # Медленная правка сообщения: за это время воркер берет следующие заявки
+                await asyncio.sleep(delay)
+            return show
+
+        await scheduler.start()
+        try:
+            scheduler.submit(1, "a", job)
+            scheduler.submit(2, "b", job, on_position=on_position("b", 0.2))
+            scheduler.submit(3, "c", job, on_position=on_position("c", 0))
+            assert await scheduler.drain(timeout=2)
+        finally:
+            await scheduler.close()
+        return positions
+
+    positions = asyncio.run(scenario())
+    assert positions["b"] == [1]
+    # Заявка c началась, пока ждали правку для b, и не должна получить позицию 0
+    assert 0 not in positions.get("c", [])
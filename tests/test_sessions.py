@@ -0,0 +1,97 @@
+import asyncio
+
+from fake_redis import FakeRedis
+from sessions import MemorySessionStorage, RedisSessionStorage, SearchSession, TrackInfo
+
+
+def make_session(search_id, user_id, tracks=3):
+    return SearchSession(
+        search_id,
+        [TrackInfo(i, f"Трек {i}", "Автор", 180000, None, f"https://soundcloud.com/a/{i}") for i in range(tracks)],
+        "запрос",
+        message_id=10,
+        chat_id=user_id,
+        user_id=user_id
+    )
+
+
+def test_redis_storage_round_trip_and_save():
+    async def scenario():
+        storage = RedisSessionStorage(FakeRedis(), ttl=60, per_user=3)
+        await storage.add(make_session("abc", user_id=1))
+
+        session = await storage.get("abc")
+        assert session.query == "запрос"
+        assert [track.id for track in session.tracks] == [0, 1, 2]
+        assert session.tracks[1].title == "Трек 1"
+
+        session.current_page = 2
+        await storage.save(session)
+        assert (await storage.get("abc")).current_page == 2
+
+        await storage.remove("abc")
+        assert await storage.get("abc") is None
+        assert storage.stats()["misses"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_redis_storage_per_user_eviction():
+    async def scenario():
+        evicted = []
+        storage = RedisSessionStorage(FakeRedis(), ttl=60, per_user=2)
+        storage.on_evict = evicted.append
+
+        for search_id in ("a", "b", "c"):
+            await storage.add(make_session(search_id, user_id=1))
+        await storage.add(make_session("other", user_id=2))
+
+        # У первого пользователя остаются два последних поиска, чужие сессии не затронуты
+        assert await storage.get("a") is None
+        assert await storage.get("b") is not None
+        assert await storage.get("c") is not None
+        assert await storage.get("other") is not None
+        assert evicted == ["a"]
+        assert storage.stats()["evicted_user"] == 1
+
+        await storage.close()
+        assert storage.client.closed
+
+    asyncio.run(scenario())
+
+
+def test_redis_storage_expires_sessions():
+    async def scenario():
+        storage = RedisSessionStorage(FakeRedis(), ttl=60)
+        await storage.add(make_session("abc", user_id=1))
+        # Истекший в Redis ключ - устаревшая сессия
+        await storage.client.expire(storage._session_key("abc"), 0)
+        assert await storage.get("abc") is None
+
+    asyncio.run(scenario())
+
+
+def test_memory_storage_restore_keeps_newer_sessions():
+    async def scenario():
+        before = MemorySessionStorage(ttl=60, per_user=2)
+        await before.add(make_session("old", user_id=1))
+        records = before.snapshot()
+
+        # После перезапуска пользователь уже сделал два новых поиска
+        storage = MemorySessionStorage(ttl=60, per_user=2)
+        storage.restore(records)
+        await storage.add(make_session("b", user_id=1))
+        await storage.add(make_session("c", user_id=1))
+
+        # Открыл старое сообщение: оно работает и не вытесняет новые сессии
+        assert await storage.get("old") is not None
+        assert await storage.get("b") is not None
+        assert await storage.get("c") is not None
+
+        # Следующий поиск первой вытесняет восстановленную сессию
+        await storage.add(make_session("d", user_id=1))
+        assert await storage.get("old") is None
+        assert await storage.get("c") is not None
+        assert await storage.get("d") is not None
+
+    asyncio.run(scenario())
@@ -0,0 +1,34 @@
+import asyncio
+import os
+
+import pytest
+
+from snapshot import Snapshot
+
+
+def test_concurrent_writers_publish_whole_snapshot(tmp_path):
+    path = tmp_path / "snapshot.json.gz"
+
+    async def scenario():
+        # Процессы вебхука сохраняют снимок в один файл одновременно
+        writers = [Snapshot(str(path)) for _ in range(4)]
+        await asyncio.gather(*(
+            writer.save({"sessions": [[f"id{i}", 0, {"n": "x" * 100_000}]]})
+            for i, writer in enumerate(writers)
+        ))
+        return await Snapshot(str(path)).load()
+
+    sections = asyncio.run(scenario())
+    assert len(sections["sessions"]) == 1
+    assert os.listdir(tmp_path) == ["snapshot.json.gz"]
+
+
+def test_failed_write_removes_temp_file(tmp_path, monkeypatch):
+    def replace(src, dst):
+        raise OSError("нет места на диске")
+
+    monkeypatch.setattr(os, "replace", replace)
+    snapshot = Snapshot(str(tmp_path / "snapshot.json.gz"))
+    with pytest.raises(OSError):
+        asyncio.run(snapshot.save({"sessions": []}))
+    assert os.listdir(tmp_path) == []
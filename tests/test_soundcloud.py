@@ -0,0 +1,89 @@
+import asyncio
+import json
+
+import pytest
+from aiohttp import web
+
+from http_client import http
+from soundcloud import CircuitBreaker, CircuitOpen, ClientIdPool, SoundCloudApi
+
+
+async def serve(responses):
+    """Локальный сервер, отдающий ответы из списка по очереди (последний - повторяется)"""
+    async def handle(request):
+        status, body, content_type = responses.pop(0) if len(responses) > 1 else responses[0]
+        return web.Response(status=status, body=body, content_type=content_type)
+
+    app = web.Application()
+    app.router.add_get("/api", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/api"
+
+
+def make_api():
+    api = SoundCloudApi()
+    api.client_ids = ClientIdPool(["key"])
+    api.breakers["api-v2"] = CircuitBreaker("api-v2", threshold=1, reset_timeout=0.05)
+    return api
+
+
+def test_probe_with_undecodable_body_reopens_breaker():
+    async def scenario():
+        runner, url = await serve([
+            (500, b"error", "text/plain"),
+            (200, b"<html>captcha</html>", "text/html"),
+            (200, json.dumps({"ok": True}).encode(), "application/json"),
+        ])
+        await http.start()
+        api = make_api()
+        breaker = api.breakers["api-v2"]
+        try:
+            with pytest.raises(Exception):
+                await api.get_json(url)
+            assert breaker.state == "open"
+
+            # Пробный запрос получает 200 с HTML: это сбой, автомат снова размыкается
+            await asyncio.sleep(0.06)
+            with pytest.raises(ValueError):
+                await api.get_json(url)
+            assert breaker.state == "open"
+
+            # Следующий пробный запрос проходит и замыкает автомат
+            await asyncio.sleep(0.06)
+            assert await api.get_json(url) == {"ok": True}
+            assert breaker.state == "closed"
+            assert await api.get_json(url) == {"ok": True}
+        finally:
+            await http.close()
+            await runner.cleanup()
+
+    asyncio.run(scenario())
+
+
+def test_probe_rejected_by_all_keys_frees_probe():
+    async def scenario():
+        runner, url = await serve([
+            (500, b"error", "text/plain"),
+            (401, b"", "text/plain"),
+            (200, json.dumps([1]).encode(), "application/json"),
+        ])
+        await http.start()
+        api = make_api()
+        try:
+            with pytest.raises(Exception):
+                await api.get_json(url)
+            await asyncio.sleep(0.06)
+            with pytest.raises(Exception) as error:
+                await api.get_json(url)
+            assert not isinstance(error.value, CircuitOpen)
+            # Ответ 401 ничего не говорит об API: следующий запрос снова пробный, а не CircuitOpen
+            assert await api.get_json(url) == [1]
+        finally:
+            await http.close()
+            await runner.cleanup()
+
+    asyncio.run(scenario())
@@ -0,0 +1,41 @@
+import asyncio
+
+from sessions import TrackInfo
+from track_index import TrackIndex
+
+
+def build_index(path, scan=10000):
+    async def fill():
+        index = TrackIndex(str(path))
+        index.scan = scan
+        index.add([TrackInfo(1000, "Love Story", "Taylor", 200000, None, None, 500_000_000)])
+        # Много менее популярных совпадений с большими ID (новее)
+        index.add([
+            TrackInfo(10_000 + i, f"love remix {i}", "dj", 200000, None, None, i)
+            for i in range(1500)
+        ])
+        await index.flush()
+        return index
+
+    return asyncio.run(fill())
+
+
+def test_popular_track_survives_many_newer_matches(tmp_path):
+    index = build_index(tmp_path / "index.sqlite3")
+    try:
+        results = asyncio.run(index.search("love", limit=100))
+        assert len(results) == 100
+        assert results[0].id == 1000
+        assert asyncio.run(index.search("love", limit=100, complete=True))[0].id == 1000
+    finally:
+        index.close()
+
+
+def test_complete_search_refuses_truncated_window(tmp_path):
+    index = build_index(tmp_path / "index.sqlite3", scan=500)
+    try:
+        # Совпадений больше окна - неполный ответ не выдается за окончательный
+        assert asyncio.run(index.search("love", limit=100, complete=True)) == []
+        assert len(asyncio.run(index.search("love", limit=100))) == 100
+    finally:
+        index.close()
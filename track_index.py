@@ -0,0 +1,269 @@
+import asyncio
+import math
+import os
+import pathlib
+import re
+import sqlite3
+import threading
+import time
+
+from loguru import logger
+
+from sessions import TrackInfo
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+MAX_QUERY_TOKENS = 8
+
+
+def query_tokens(query):
+    return TOKEN_RE.findall(query.lower())[:MAX_QUERY_TOKENS]
+
+
+def match_expression(tokens):
+    """Запрос FTS5: все слова обязательны, последнее - как префикс (пользователь его еще набирает)"""
+    if not tokens:
+        return ""
+    return " ".join([f'"{token}"' for token in tokens[:-1]] + [f'"{tokens[-1]}"*'])
+
+
+def score(tokens, phrase, title, artist, playback_count, selections):
+    """Оценка совпадения: целые слова в названии важнее префиксов и имени автора"""
+    title_words = TOKEN_RE.findall(title.lower())
+    artist_words = TOKEN_RE.findall(artist.lower())
+    value = 0.0
+    for token in tokens:
+        if token in title_words:
+            value += 2
+        elif any(word.startswith(token) for word in title_words):
+            value += 1
+        if token in artist_words:
+            value += 1
+    if phrase in f"{artist} {title}".lower():
+        value += 3
+    return value + 0.3 * math.log1p(playback_count) + math.log1p(selections)
+
+
+class TrackIndex:
+    """Локальный полнотекстовый индекс треков, которые бот уже получал от SoundCloud
+
+    Треки из поиска, чартов и похожих добавляются пачками в фоновом потоке.
+    Поиск тоже выполняется в потоке, чтобы не блокировать цикл событий, по
+    отдельным соединениям только для чтения - по одному на поток (WAL
+    позволяет читать параллельно с записью). Результаты ранжируются по релевантности
+    FTS5 с поправкой на число прослушиваний на SoundCloud и выборов в боте.
+
+    Для коротких префиксов совпадений могут быть сотни тысяч, поэтому
+    ранжируются не все: из первых TRACK_INDEX_SCAN совпадений (обход FTS
+    по rowid) берутся TRACK_INDEX_CANDIDATES самых популярных - выбранных
+    в боте, затем по прослушиваниям. Так подсказка укладывается в
+    миллисекунды, а популярный трек не теряется среди тысяч похожих.
+    Если совпадений больше окна, выдача неполная: search(complete=True)
+    в этом случае возвращает пустой список.
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.max_tracks = int(os.getenv("TRACK_INDEX_MAX", "1000000"))
+        self.candidates = int(os.getenv("TRACK_INDEX_CANDIDATES", "1000"))
+        self.scan = int(os.getenv("TRACK_INDEX_SCAN", "10000"))
+
+        self._writer = sqlite3.connect(path, check_same_thread=False)
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        self._writer.execute("PRAGMA synchronous=NORMAL")
+        self._writer.executescript(
+            "CREATE TABLE IF NOT EXISTS tracks ("
+            "id INTEGER PRIMARY KEY, "
+            "title TEXT NOT NULL, "
+            "artist TEXT NOT NULL, "
+            "duration INTEGER NOT NULL, "
+            "artwork_url TEXT, "
+            "permalink_url TEXT, "
+            "playback_count INTEGER NOT NULL DEFAULT 0, "
+            "selections INTEGER NOT NULL DEFAULT 0, "
+            "seen_at INTEGER NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS tracks_seen_at ON tracks (seen_at);"
+            "CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5("
+            "title, artist, content='tracks', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2', prefix='2 3');"
+            # Триггеры поддерживают FTS-таблицу в соответствии с основной
+            "CREATE TRIGGER IF NOT EXISTS tracks_ai AFTER INSERT ON tracks BEGIN "
+            "INSERT INTO tracks_fts (rowid, title, artist) VALUES (new.id, new.title, new.artist); END;"
+            "CREATE TRIGGER IF NOT EXISTS tracks_ad AFTER DELETE ON tracks BEGIN "
+            "INSERT INTO tracks_fts (tracks_fts, rowid, title, artist) VALUES ('delete', old.id, old.title, old.artist); END;"
+            "CREATE TRIGGER IF NOT EXISTS tracks_au AFTER UPDATE OF title, artist ON tracks BEGIN "
+            "INSERT INTO tracks_fts (tracks_fts, rowid, title, artist) VALUES ('delete', old.id, old.title, old.artist); "
+            "INSERT INTO tracks_fts (rowid, title, artist) VALUES (new.id, new.title, new.artist); END;"
+        )
+        self._writer.commit()
+        self._lock = threading.Lock()
+        # Соединения для чтения создаются в потоках пула по мере надобности
+        self._read_uri = f"{pathlib.Path(path).resolve().as_uri()}?mode=ro"
+        self._local = threading.local()
+        self._readers = []
+
+        self._pending = {}
+        self._pending_selections = {}
+        self._flush_task = None
+        self._written_since_prune = 0
+
+        self.indexed = 0
+        self.queries = 0
+        self.query_time = 0.0
+
+    def add(self, tracks):
+        """Ставит треки (TrackInfo) в очередь на индексацию (запись - в фоне)"""
+        now = int(time.time())
+        for track in tracks:
+            if not track.id or not track.title:
+                continue
+            self._pending[track.id] = (
+                track.id,
+                track.title,
+                track.artist or "",
+                track.duration,
+                track.artwork_url,
+                track.permalink_url,
+                track.playback_count,
+                now,
+            )
+        self._schedule_flush()
+
+    def record_selection(self, track_id):
+        """Учитывает выбор трека пользователем в ранжировании"""
+        self._pending_selections[track_id] = self._pending_selections.get(track_id, 0) + 1
+        self._schedule_flush()
+
+    async def search(self, query, limit=20, complete=False):
+        """Треки, подходящие под запрос, от самых релевантных и популярных
+
+        complete=True - только если все совпадения поместились в окно
+        ранжирования, иначе пустой список (ответ индекса мог бы пропустить
+        популярный трек, и запрос стоит отправить в SoundCloud).
+        """
+        return await asyncio.to_thread(self._search, query, limit, complete)
+
+    def _search(self, query, limit, complete):
+        tokens = query_tokens(query)
+        if not tokens:
+            return []
+
+        started = time.perf_counter()
+        try:
+            reader = self._reader()
+            expression = match_expression(tokens)
+            if complete:
+                matches = reader.execute(
+                    "SELECT count(*) FROM (SELECT rowid FROM tracks_fts WHERE tracks_fts MATCH ? LIMIT ?)",
+                    (expression, self.scan + 1)
+                ).fetchone()[0]
+                if matches > self.scan:
+                    return []
+            # Обход FTS по rowid без ранжирования быстрый; bm25 по всем совпадениям - нет.
+            # Из окна совпадений кандидатами становятся самые популярные, а не самые новые
+            rows = reader.execute(
+                "SELECT id, title, artist, duration, artwork_url, permalink_url, playback_count, selections "
+                "FROM tracks WHERE id IN ("
+                "SELECT rowid FROM tracks_fts WHERE tracks_fts MATCH ? ORDER BY rowid DESC LIMIT ?) "
+                "ORDER BY selections DESC, playback_count DESC LIMIT ?",
+                (expression, self.scan, self.candidates)
+            ).fetchall()
+            phrase = " ".join(tokens)
+            rows.sort(key=lambda row: score(tokens, phrase, row[1], row[2], row[6], row[7]), reverse=True)
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Ошибка поиска по локальному индексу: {e}")
+            return []
+        finally:
+            self.queries += 1
+            self.query_time += time.perf_counter() - started
+
+        return [TrackInfo(*row[:7]) for row in rows[:limit]]
+
+    async def flush(self):
+        """Дожидается записи всех накопленных изменений"""
+        while self._flush_task is not None:
+            await asyncio.shield(self._flush_task)
+
+    def stats(self):
+        return {
+            "indexed": self.indexed,
+            "pending": len(self._pending),
+            "queries": self.queries,
+            "avg_query_ms": self.query_time / self.queries * 1000 if self.queries else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            for reader in self._readers:
+                reader.close()
+            self._readers.clear()
+            self._writer.close()
+
+    def _reader(self):
+        """Соединение только для чтения текущего потока"""
+        reader = getattr(self._local, "reader", None)
+        if reader is None:
+            reader = sqlite3.connect(self._read_uri, uri=True, check_same_thread=False)
+            self._local.reader = reader
+            with self._lock:
+                self._readers.append(reader)
+        return reader
+
+    def _schedule_flush(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        try:
+            while self._pending or self._pending_selections:
+                tracks = list(self._pending.values())
+                selections = list(self._pending_selections.items())
+                self._pending = {}
+                self._pending_selections = {}
+                try:
+                    await asyncio.to_thread(self._write, tracks, selections)
+                except Exception as e:
+                    logger.error(f"Не удалось обновить индекс треков: {e}")
+                    return
+        finally:
+            self._flush_task = None
+
+    def _write(self, tracks, selections):
+        with self._lock:
+            self._writer.executemany(
+                "INSERT INTO tracks "
+                "(id, title, artist, duration, artwork_url, permalink_url, playback_count, seen_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET "
+                "title = excluded.title, artist = excluded.artist, duration = excluded.duration, "
+                "artwork_url = excluded.artwork_url, permalink_url = excluded.permalink_url, "
+                "playback_count = excluded.playback_count, seen_at = excluded.seen_at",
+                tracks
+            )
+            self._writer.executemany(
+                "UPDATE tracks SET selections = selections + ? WHERE id = ?",
+                [(count, track_id) for track_id, count in selections]
+            )
+            self._writer.commit()
+            self.indexed += len(tracks)
+
+            self._written_since_prune += len(tracks)
+            if self._written_since_prune >= 10000:
+                self._written_since_prune = 0
+                self._prune()
+
+    def _prune(self):
+        # Давно не встречавшиеся треки вытесняются, когда индекс превышает лимит
+        total = self._writer.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+        overflow = total - self.max_tracks
+        if overflow <= 0:
+            return
+        self._writer.execute(
+            "DELETE FROM tracks WHERE id IN (SELECT id FROM tracks ORDER BY seen_at LIMIT ?)",
+            (overflow,)
+        )
+        self._writer.commit()
+        logger.info(f"Из индекса треков удалено {overflow} старых записей")
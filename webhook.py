@@ -0,0 +1,127 @@
+import asyncio
+import hashlib
+import os
+import signal
+
+from aiogram import BaseMiddleware
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+from loguru import logger
+
+
+class UpdateLimiter(BaseMiddleware):
+    """Ограничивает число одновременно обрабатываемых апдейтов"""
+
+    def __init__(self, limit=None):
+        self.limit = limit or int(os.getenv("UPDATE_CONCURRENCY", "64"))
+        self._semaphore = asyncio.Semaphore(self.limit)
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.in_flight = 0
+        self.waiting = 0
+        self.processed = 0
+
+    async def __call__(self, handler, event, data):
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.in_flight += 1
+        self._idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self.in_flight -= 1
+            self.processed += 1
+            self._semaphore.release()
+            if self.in_flight == 0 and self.waiting == 0:
+                self._idle.set()
+
+    async def drain(self, timeout=None):
+        """Ждет завершения обрабатываемых апдейтов (в том числе загрузок)"""
+        if self._idle.is_set():
+            return True
+
+        timeout = timeout or float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "60"))
+        logger.info(f"Ожидание завершения {self.in_flight + self.waiting} апдейтов...")
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            logger.warning(f"Не дождались завершения {self.in_flight} апдейтов за {timeout:.0f} с")
+            return False
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "processed": self.processed,
+        }
+
+
+async def run_webhook(bot, dp, limiter, drain_hooks=()):
+    """Принимает апдейты через вебхук на aiohttp-сервере до получения сигнала остановки
+
+    drain_hooks - корутинные функции, которые дожидаются фоновой работы
+    (например, очереди загрузок) перед закрытием сессии бота.
+    """
+    webhook_url = os.getenv("WEBHOOK_URL")
+    webhook_path = os.getenv("WEBHOOK_PATH", "/webhook")
+    host = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+    port = int(os.getenv("WEBHOOK_PORT", "8080"))
+    # Telegram присылает секрет в заголовке. Без явного секрета он выводится из
+    # токена бота, а не генерируется случайно: у всех процессов за одним адресом
+    # он совпадает с тем, что зарегистрировал последний вызвавший set_webhook
+    secret_token = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(
+        f"webhook:{bot.token}".encode()
+    ).hexdigest()
+
+    app = web.Application()
+
+    async def health(request):
+        return web.json_response({"status": "ok", "updates": limiter.stats()})
+
+    app.router.add_get("/health", health)
+
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=True,
+        secret_token=secret_token
+    ).register(app, path=webhook_path)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    site = web.TCPSite(runner, host=host, port=port)
+    await site.start()
+
+    await bot.set_webhook(
+        url=f"{webhook_url.rstrip('/')}{webhook_path}",
+        secret_token=secret_token,
+        max_connections=int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "100")),
+        drop_pending_updates=True
+    )
+    logger.info(f"Вебхук запущен на {host}:{port}{webhook_path}")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+
+    try:
+        await stop_event.wait()
+    finally:
+        logger.info("Остановка вебхука...")
+        # Прекращаем прием новых апдейтов и дожидаемся текущих загрузок
+        await site.stop()
+        await limiter.drain()
+        for drain in drain_hooks:
+            await drain()
+        await runner.cleanup()